@@ -0,0 +1,145 @@
+"""
+Compare the baseline subtraction in tools with the loop versions it replaced, and time each subtraction type.
+
+Each subtraction type is called as dataprep calls it for config.subtype. Subtype 2 (datacompsub) used a loop over
+every point, and subtypes 4 (polynomial) and 5 (Savitzky-Golay) used a loop over the windows in calc_local_mins. The
+old versions are kept here, and must give the same output. Subtype 1 (datasimpsub) had no loop and is only timed.
+
+Run with pytest or as a script. The script also prints the time for each subtype on larger spectra.
+"""
+import time
+import numpy as np
+import scipy.ndimage.filters as filt
+import unidec.tools as ud
+
+__author__ = 'Michael.Marty'
+
+seed = 2
+sizes = [2000, 200000]
+
+
+def datacompsub_loop(datatop, buff):
+    """
+    Loop version of datacompsub, as it was before the running minimum filter.
+    :param datatop: Data array
+    :param buff: Width parameter
+    :return: Subtracted data
+    """
+    length = len(datatop)
+    mins = list(range(0, length))
+    indexes = list(range(0, length))
+    for i in indexes:
+        mins[i] = np.amin(datatop[int(max([0, i - abs(buff)])):int(min([i + abs(buff), length])), 1])
+    background = filt.gaussian_filter(mins, abs(buff) * 2)
+    datatop[:, 1] = datatop[:, 1] - background
+    return datatop
+
+
+def calc_local_mins_loop(data, w):
+    """
+    Loop version of calc_local_mins, as it was before the windows were found with searchsorted.
+    :param data: Data array (N x 2)
+    :param w: Width of each window in x units
+    :return: Array of [position, value] of each local minimum (M x 2)
+    """
+    start = np.amin(data[:, 0])
+    stop = np.amax(data[:, 0])
+    windows = np.arange(start, stop, step=w)
+
+    localmins = []
+    for winstart in windows:
+        chopdata = ud.datachop(data, winstart, winstart + w)
+        localmin = np.amin(chopdata[:, 1])
+        localminpos = chopdata[np.argmin(chopdata[:, 1]), 0]
+        localmins.append([localminpos, localmin])
+    return np.array(localmins)
+
+
+def with_loop_mins(function):
+    """
+    Run a subtraction with calc_local_mins_loop in place of ud.calc_local_mins.
+    :param function: Subtraction function from tools
+    :return: Function with the same arguments
+    """
+    def run(*args):
+        new = ud.calc_local_mins
+        ud.calc_local_mins = calc_local_mins_loop
+        try:
+            return function(*args)
+        finally:
+            ud.calc_local_mins = new
+    return run
+
+
+# Subtype, buff as in config.subbuff for dataprep, new function, old function (None if unchanged)
+subtypes = [(1, 100, ud.datasimpsub, None),
+            (2, 50, ud.datacompsub, datacompsub_loop),
+            (2, 2.5, ud.datacompsub, datacompsub_loop),
+            (4, 4, ud.polynomial_background_subtract, with_loop_mins(ud.polynomial_background_subtract)),
+            (5, 20, ud.savgol_background_subtract, with_loop_mins(ud.savgol_background_subtract))]
+
+
+def make_data(rng, n):
+    """
+    Spectrum with a peak, a decaying baseline, and noise.
+    :param rng: numpy Generator
+    :param n: Number of points
+    :return: Data array (N x 2)
+    """
+    x = np.linspace(1000, 10000, n)
+    y = np.exp(-((x - 5000) / 300) ** 2) + 0.2 * np.exp(-x / 4000) + 0.05 * rng.random(n)
+    return np.column_stack((x, y))
+
+
+def test_datacompsub_matches_loop():
+    rng = np.random.default_rng(seed)
+    for buff in [1, 1.5, 2, 2.5, 3, 7.3, 100, -4]:
+        data = np.column_stack((np.arange(500.), rng.random(500)))
+        assert np.array_equal(datacompsub_loop(data.copy(), buff), ud.datacompsub(data.copy(), buff))
+
+
+def test_calc_local_mins_matches_loop():
+    rng = np.random.default_rng(seed)
+    for w in [3, 20, 50.5]:
+        data = make_data(rng, 8000)
+        assert np.array_equal(calc_local_mins_loop(data, w), ud.calc_local_mins(data, w))
+
+
+def test_subtypes_match_loop():
+    rng = np.random.default_rng(seed)
+    data = make_data(rng, sizes[0])
+    for subtype, buff, new, old in subtypes:
+        if old is not None:
+            assert np.allclose(old(data.copy(), buff), new(data.copy(), buff), rtol=0, atol=1e-12)
+
+
+def benchmark():
+    """
+    Print the time for each subtype with the old and new versions.
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    for n in sizes:
+        data = make_data(rng, n)
+        for subtype, buff, new, old in subtypes:
+            # Compile before timing
+            new(data[:1000].copy(), buff)
+            tstart = time.perf_counter()
+            b = new(data.copy(), buff)
+            tnew = time.perf_counter() - tstart
+            if old is None:
+                print("Points:", n, "Subtype:", subtype, "buff:", buff, "Time:", tnew)
+                continue
+            tstart = time.perf_counter()
+            a = old(data.copy(), buff)
+            told = time.perf_counter() - tstart
+            print("Points:", n, "Subtype:", subtype, "buff:", buff, "Old:", told, "New:", tnew, "Max Difference:",
+                  np.amax(np.abs(a - b)))
+
+
+if __name__ == "__main__":
+    test_datacompsub_matches_loop()
+    test_calc_local_mins_matches_loop()
+    test_subtypes_match_loop()
+    print("Baseline subtraction matches the loop versions")
+    benchmark()
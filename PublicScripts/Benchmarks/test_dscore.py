@@ -0,0 +1,222 @@
+"""
+Compare the batched DScore components in UniDec with the loops over peaks and charge states they replaced.
+
+LoopUniDec keeps the old get_zstack, pks_mscore, pks_csscore, get_mzstack, and pks_uscore. Each example file is
+deconvolved with the in-process core (coreflag 1), so the UniDec binary is not needed. Each engine then runs dscore()
+on the same peaks. The scores must agree to within floating point rounding. uscore can differ in the last bit because
+the batched version adds each window in a different order.
+
+Run with pytest or as a script. The script also prints the time for dscore() with each version. The nanodisc
+settings give several hundred peaks with 100 charge states.
+"""
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import unidec
+import unidec.tools as ud
+from unidec.engine import UniDec
+
+__author__ = 'Michael.Marty'
+
+example_dir = os.path.join(os.path.dirname(unidec.__file__), "bin", "Example Data")
+# Example file and config settings for it
+examples = [("BSA.txt", {}),
+            ("POPC_Nanodiscs.txt", {"massbins": 1, "peakwindow": 5, "peakthresh": 0.001, "startz": 1, "endz": 100,
+                                    "numit": 20})]
+score_names = ["dscore", "mscore", "cs_score", "uscore", "fscore", "rsquared"]
+
+
+class LoopUniDec(UniDec):
+    """
+    UniDec with the DScore components as they were before they were batched.
+    """
+
+    def get_zstack(self, xfwhm=1):
+        zarr = np.reshape(self.data.massgrid, (len(self.data.massdat), len(self.data.ztab)))
+        for i, p in enumerate(self.pks.peaks):
+            interval = np.abs(np.array(p.intervalFWHM) - p.mass) * xfwhm
+            if interval[0] == 0:
+                interval[0] = self.config.massbins * xfwhm
+            if interval[1] == 0:
+                interval[1] = self.config.massbins * xfwhm
+            interval = np.array([p.mass - interval[0], p.mass + interval[1]])
+
+            boo1 = self.data.massdat[:, 0] < interval[1]
+            boo2 = self.data.massdat[:, 0] > interval[0]
+            boo3 = np.all([boo1, boo2], axis=0)
+            top = self.data.massdat[boo3]
+
+            stack = [top[:, 0]]
+            for j, z in enumerate(self.data.ztab):
+                stack.append(zarr[boo3, j])
+            p.zstack = np.array(stack)
+
+    def pks_mscore(self, xfwhm=2, power=2):
+        self.get_zstack(xfwhm=xfwhm)
+        for p in self.pks.peaks:
+            m = p.zstack[0]
+            ints = p.zstack[1:]  # mzgrid
+            msum = np.sum(ints, axis=0)
+            zsum = np.sum(ints, axis=1)
+            msum /= np.amax(msum)
+            zsum /= np.amax(zsum)
+            p.mdist = np.transpose([m, msum])
+            p.zdist = np.transpose([self.data.ztab, zsum])
+
+            rats = []
+            weights = []
+            for i, z in enumerate(self.data.ztab):
+                Y = ints[i]  # mzgrid
+                sY = np.sum(Y)
+                X = msum * sY / np.sum(msum)  # summed decon
+                sX = np.sum(X)
+                sae = np.sum(np.abs(Y - X))
+                M = 1 - ud.safedivide1(sae, sX)
+                rats.append(M)
+                weights.append(sY)
+            rats = np.array(rats)
+            weights = np.array(weights)
+            p.mscore = ud.weighted_avg(rats, weights ** power)
+
+    def pks_csscore(self, xfwhm=2):
+        try:
+            if len(self.pks.peaks[0].zstack) < 1:
+                self.get_zstack(xfwhm=xfwhm)
+        except Exception as e:
+            print("Error in z score: Make sure you get peaks first", e)
+
+        for p in self.pks.peaks:
+            ints = p.zstack[1:]
+            sumz = np.sum(ints, axis=1)
+            sumz /= np.amax(sumz)
+            zm = np.argmax(sumz)
+
+            zs = np.sum(sumz)
+            badarea = 0
+
+            index = zm
+            low = sumz[zm]
+            while index < len(sumz) - 1:
+                index += 1
+                val = sumz[index]
+                if val < low:
+                    low = val
+                else:
+                    badarea += val - low
+
+            index = zm
+            low = sumz[zm]
+            while index > 0:
+                index -= 1
+                val = sumz[index]
+                if val < low:
+                    low = val
+                else:
+                    badarea += val - low
+
+            p.cs_score = 1 - ud.safedivide1(badarea, zs)
+
+    def get_mzstack(self, xfwhm=2):
+        zarr = np.reshape(self.data.mzgrid[:, 2], (len(self.data.data2), len(self.data.ztab)))
+        for i, p in enumerate(self.pks.peaks):
+            interval = np.abs(np.array(p.intervalFWHM) - p.mass) * xfwhm
+            if interval[0] == 0:
+                interval[0] = self.config.massbins * xfwhm
+            if interval[1] == 0:
+                interval[1] = self.config.massbins * xfwhm
+            interval = np.array([p.mass - interval[0], p.mass + interval[1]])
+
+            stack = []
+            bvals = []
+            for j, z in enumerate(self.data.ztab):
+                interval2 = (interval + z * self.config.adductmass) / z
+                boo1 = self.data.data2[:, 0] <= interval2[1]
+                boo2 = self.data.data2[:, 0] >= interval2[0]
+                boo3 = np.all([boo1, boo2], axis=0)
+                top = self.data.data2[boo3]
+                stack.append(np.transpose([top[:, 0], top[:, 1], zarr[boo3, j]]))
+                bvals.append(boo3)
+            btot = np.any(bvals, axis=0)
+            fit = self.data.fitdat[btot]
+            top = self.data.data2[btot]
+            sse = np.sum((fit - top[:, 1]) ** 2)
+            denom = np.sum((top[:, 1] - np.mean(top[:, 1])) ** 2)
+            p.rsquared = 1 - ud.safedivide1(sse, denom)
+            p.mzstack = np.array(stack, dtype='object')
+
+    def pks_uscore(self, xfwhm=2, power=1):
+        self.get_mzstack(xfwhm=xfwhm)
+        for p in self.pks.peaks:
+            rats = []
+            weights = []
+            for i, zval in enumerate(self.data.ztab):
+                v = p.mzstack[i]
+                X = v[:, 1]  # spectrum
+                Y = v[:, 2]  # mzgrid
+                if self.config.orbimode == 1:
+                    Y = Y * zval
+                sx = np.sum(X)
+                sy = np.sum(Y)
+                sae = np.sum(np.abs(X - Y))
+                U = 1 - ud.safedivide1(sae, sx)
+                rats.append(U)
+                weights.append(sy)
+            rats = np.array(rats)
+            weights = np.array(weights)
+            p.uscore = ud.weighted_avg(rats, weights ** power)
+
+
+def run_dscore(engine_class, fname, settings, directory):
+    """
+    Deconvolve an example file with the core, pick peaks, and time dscore().
+    :param engine_class: UniDec or LoopUniDec
+    :param fname: Example file name
+    :param settings: Dictionary of config settings
+    :param directory: Folder to copy the file to
+    :return: Scores for each peak (peaks x score_names), UniScore, time for dscore()
+    """
+    path = os.path.join(directory, fname)
+    shutil.copy(os.path.join(example_dir, fname), path)
+    eng = engine_class()
+    eng.open_file(path, refresh=True)
+    for key, value in settings.items():
+        setattr(eng.config, key, value)
+    eng.config.coreflag = 1
+    eng.process_data()
+    eng.run_unidec(silent=True)
+    eng.pick_peaks(calc_dscore=False)
+    tstart = time.perf_counter()
+    eng.dscore()
+    runtime = time.perf_counter() - tstart
+    scores = np.array([[getattr(p, name) for name in score_names] for p in eng.pks.peaks], dtype=float)
+    return scores, eng.pks.uniscore, runtime
+
+
+def compare(fname, settings):
+    """
+    Check that the batched and loop versions give the same scores on an example file.
+    :param fname: Example file name
+    :param settings: Dictionary of config settings
+    :return: Time for dscore() with the loop and batched versions
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        old, olduni, told = run_dscore(LoopUniDec, fname, settings, directory)
+        new, newuni, tnew = run_dscore(UniDec, fname, settings, directory)
+    assert old.shape == new.shape
+    assert np.allclose(old, new, rtol=0, atol=1e-12)
+    assert np.isclose(olduni, newuni, rtol=0, atol=1e-12)
+    return len(new), told, tnew
+
+
+def test_dscore_matches_loop():
+    fname, settings = examples[0]
+    compare(fname, settings)
+
+
+if __name__ == "__main__":
+    for f, s in examples:
+        npeaks, t1, t2 = compare(f, s)
+        print(f, "Peaks:", npeaks, "Loop:", t1, "Batched:", t2, "Speedup:", t1 / t2)
+    print("Batched DScore matches the loop version")
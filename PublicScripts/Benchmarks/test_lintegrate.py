@@ -0,0 +1,135 @@
+"""
+Compare the vectorized tools.lintegrate with the loop version it replaced.
+
+Random spectra are integrated onto random axes, onto axes that share points with the data, and onto the linear and
+nonlinear axes that tools.linearize makes. Both versions must agree to within floating point rounding, and the total
+intensity inside the new axis must be conserved.
+
+Run with pytest or as a script. The script also prints the time for each version on larger spectra.
+"""
+import time
+import numpy as np
+import unidec.tools as ud
+
+__author__ = 'Michael.Marty'
+
+seed = 0
+sizes = [10 ** 3, 10 ** 4, 10 ** 5]
+
+
+def lintegrate_loop(datatop, intx, fastmode=False):
+    """
+    Loop version of lintegrate, as it was before it was vectorized.
+    :param datatop: Data array
+    :param intx: New x-axis for data
+    :param fastmode: If True, just adds each point to the nearest point.
+    :return: Integration of intensity from original data onto the new x-axis.
+    """
+    length = len(datatop)
+    l2 = len(intx)
+    inty = np.zeros_like(intx)
+    for i in range(0, length):
+        x = datatop[i, 0]
+        y = datatop[i, 1]
+        if intx[0] < x < intx[len(intx) - 1]:
+            index = ud.nearest(intx, x)
+            if fastmode:
+                inty[index] += y
+            else:
+                if intx[index] == x:
+                    inty[index] += y
+                elif intx[index] < x and index < l2 - 1:
+                    index2 = index + 1
+                    interpos = ud.linear_interpolation(intx[index], intx[index2], x)
+                    inty[index] += (1 - interpos) * y
+                    inty[index2] += interpos * y
+                elif intx[index] > x and index > 0:
+                    index2 = index - 1
+                    interpos = ud.linear_interpolation(intx[index], intx[index2], x)
+                    inty[index] += (1 - interpos) * y
+                    inty[index2] += interpos * y
+    newdat = np.column_stack((intx, inty))
+    return newdat
+
+
+def make_data(rng, n, rounded=False):
+    """
+    Random sorted spectrum.
+    :param rng: numpy Generator
+    :param n: Number of points
+    :param rounded: Round the x values so that many of them fall on integer axes
+    :return: Data array (N x 2)
+    """
+    x = np.sort(rng.uniform(1000, 5000, n))
+    if rounded:
+        x = np.round(x)
+    return np.column_stack((x, rng.random(n)))
+
+
+def compare(datatop, intx):
+    """
+    Check that both versions agree on one axis, with and without fastmode.
+    :param datatop: Data array
+    :param intx: New x-axis
+    :return: None
+    """
+    for fastmode in [False, True]:
+        old = lintegrate_loop(datatop, intx, fastmode)
+        new = ud.lintegrate(datatop, intx, fastmode)
+        assert old.shape == new.shape
+        assert np.allclose(old, new, rtol=1e-12, atol=1e-12)
+    inside = (datatop[:, 0] > intx[0]) & (datatop[:, 0] < intx[-1])
+    assert np.isclose(np.sum(new[:, 1]), np.sum(datatop[inside, 1]))
+
+
+def test_random_axes():
+    rng = np.random.default_rng(seed)
+    for trial in range(50):
+        datatop = make_data(rng, rng.integers(1, 300), rounded=trial % 3 == 0)
+        intx = np.sort(rng.uniform(900, 5100, rng.integers(2, 60)))
+        compare(datatop, intx)
+
+
+def test_shared_points():
+    rng = np.random.default_rng(seed)
+    datatop = make_data(rng, 2000, rounded=True)
+    compare(datatop, np.arange(1000, 5001, 2.0))
+    intx = np.unique(np.concatenate([np.round(datatop[::3, 0], 1), datatop[::7, 0]]))
+    compare(datatop, intx)
+
+
+def test_linearize_axes():
+    rng = np.random.default_rng(seed)
+    datatop = make_data(rng, 5000)
+    for binsize, linflag in [(0.5, 0), (1, 1)]:
+        new = ud.linearize(datatop, binsize, linflag)
+        old = lintegrate_loop(datatop, new[:, 0])
+        assert np.allclose(old, new, rtol=1e-12, atol=1e-12)
+
+
+def benchmark():
+    """
+    Print the time for each version on linear and nonlinear axes.
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    for n in sizes:
+        datatop = make_data(rng, n)
+        for binsize, linflag in [(0.5, 0), (1, 1)]:
+            intx = ud.linearize(datatop, binsize, linflag)[:, 0]
+            tstart = time.perf_counter()
+            old = lintegrate_loop(datatop, intx)
+            told = time.perf_counter() - tstart
+            tstart = time.perf_counter()
+            new = ud.lintegrate(datatop, intx)
+            tnew = time.perf_counter() - tstart
+            print("Points:", n, "linflag:", linflag, "Loop:", told, "Vectorized:", tnew, "Speedup:", told / tnew,
+                  "Max Difference:", np.amax(np.abs(old - new)))
+
+
+if __name__ == "__main__":
+    test_random_axes()
+    test_shared_points()
+    test_linearize_axes()
+    print("Vectorized lintegrate matches the loop version")
+    benchmark()
@@ -0,0 +1,127 @@
+"""
+Compare the compiled tools.peakdetect with the loop version it replaced, and time it on a 2M-point mass axis.
+
+Random and quantized spectra are checked with point and ppm windows. Both versions must return the same peaks. The
+loop version raised an error on an empty ppm window. peakdetect now returns that point as a peak, and the loop version
+here does the same.
+
+Run with pytest or as a script. The script also runs the benchmark. The loop version is timed on the first tenth of
+the mass axis and scaled up, because it takes tens of seconds on the full axis.
+"""
+import time
+import numpy as np
+import unidec.tools as ud
+
+__author__ = 'Michael.Marty'
+
+seed = 1
+benchmark_length = 2000000
+settings = [dict(window=3), dict(window=2.5, threshold=0.3), dict(window=0), dict(window=10, norm=False, threshold=0.5),
+            dict(ppm=20.), dict(ppm=200., threshold=0.2), dict(ppm=5000.)]
+
+
+def peakdetect_loop(data, window=10, threshold=0, ppm=None, norm=True):
+    """
+    Loop version of peakdetect, as it was before it was compiled, except that a point with an empty window is a peak.
+    :param data: Mass data array (N x 2) (mass intensity)
+    :param window: Tolerance window of the x values
+    :param threshold: Threshold of the y values
+    :param ppm: Tolerance window in ppm
+    :param norm: Whether to normalize the data before peak detection
+    :return: Array of peaks positions and intensities (P x 2) (mass intensity)
+    """
+    peaks = []
+    length = len(data)
+    shape = np.shape(data)
+    if length == 0 or shape[1] != 2:
+        return np.array(peaks)
+
+    if norm:
+        maxval = np.amax(data[:, 1])
+    else:
+        maxval = 1
+    for i in range(0, length):
+        if data[i, 1] > maxval * threshold:
+            if ppm is not None:
+                ptmass = data[i, 0]
+                newwin = ppm * 1e-6 * ptmass
+                start = ud.nearest(data[:, 0], ptmass - newwin)
+                end = ud.nearest(data[:, 0], ptmass + newwin)
+            else:
+                start = i - window
+                end = i + window
+
+                start = int(start)
+                end = int(end) + 1
+
+                if start < 0:
+                    start = 0
+                if end > length:
+                    end = length
+
+            if end <= start:
+                peaks.append([data[i, 0], data[i, 1]])
+                continue
+            testmax = np.amax(data[start:end, 1])
+            if data[i, 1] == testmax and np.all(data[i, 1] != data[start:i, 1]):
+                peaks.append([data[i, 0], data[i, 1]])
+
+    return np.array(peaks)
+
+
+def make_data(rng, n, quantized=False):
+    """
+    Smoothed random spectrum on a linear mass axis, or on a random m/z axis with rounded intensities to make ties.
+    :param rng: numpy Generator
+    :param n: Number of points
+    :param quantized: Use a random axis and rounded intensities
+    :return: Data array (N x 2)
+    """
+    if quantized:
+        x = np.sort(rng.uniform(500, 3000, n))
+    else:
+        x = np.linspace(1000, 200000, n)
+    y = np.convolve(rng.random(n), np.ones(5), "same")
+    if quantized:
+        y = np.round(y, 1)
+    return np.column_stack((x, y))
+
+
+def test_peakdetect_matches_loop():
+    rng = np.random.default_rng(seed)
+    for n in [5, 6, 50, 2000, 20000]:
+        for quantized in [False, True]:
+            data = make_data(rng, n, quantized)
+            for kwargs in settings:
+                old = peakdetect_loop(data, **kwargs)
+                new = ud.peakdetect(data, **kwargs)
+                assert old.shape == new.shape
+                assert np.array_equal(old, new)
+
+
+def benchmark():
+    """
+    Print the time for each version on a 2M-point mass axis with point and ppm windows.
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    data = make_data(rng, benchmark_length)
+    part = data[:benchmark_length // 10]
+    # Compile before timing
+    ud.peakdetect(data[:100], window=10)
+    ud.peakdetect(data[:100], ppm=50.)
+    for kwargs in [dict(window=10), dict(ppm=50.)]:
+        tstart = time.perf_counter()
+        peaks = ud.peakdetect(data, **kwargs)
+        tnew = time.perf_counter() - tstart
+        tstart = time.perf_counter()
+        peakdetect_loop(part, **kwargs)
+        told = (time.perf_counter() - tstart) * 10
+        print("Points:", len(data), kwargs, "Peaks:", len(peaks), "Compiled:", tnew, "Loop (scaled):", told,
+              "Speedup:", told / tnew)
+
+
+if __name__ == "__main__":
+    test_peakdetect_matches_loop()
+    print("Compiled peakdetect matches the loop version")
+    benchmark()
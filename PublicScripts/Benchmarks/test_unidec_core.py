@@ -0,0 +1,111 @@
+"""
+Compare the in-process deconvolution core (modules.unidec_core) with the external UniDec binary.
+
+Each example data file is copied to a temporary folder and deconvolved twice with the default settings, once with
+the binary (coreflag 0) and once with the core (coreflag 1). The mass axes must be identical, and the mass data,
+fit, and R squared must agree to within single precision rounding.
+
+Run with pytest or as a script. The binary path can be given as the first argument to the script. Otherwise, the
+default UniDecPath from the config is used, and the test is skipped if it cannot be run on this machine.
+"""
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+import unidec
+
+__author__ = 'Michael.Marty'
+
+example_dir = os.path.join(os.path.dirname(unidec.__file__), "bin", "Example Data")
+example_files = ["BSA.txt", "POPC_Nanodiscs.txt"]
+# Path of the binary. None for the default from the config.
+binary_path = None
+
+
+def binary_works(path):
+    """
+    Check that the UniDec binary can be started on this machine.
+    :param path: Binary path
+    :return: True if it runs. The binary exits with code 88 when it is not given a config file.
+    """
+    if not os.path.isfile(path):
+        return False
+    try:
+        return subprocess.run([path], capture_output=True, timeout=60).returncode == 88
+    except Exception:
+        return False
+
+
+def run_both(fname, directory, binpath):
+    """
+    Deconvolve an example file with the binary and with the core.
+    :param fname: Example file name
+    :param directory: Folder to copy the file to
+    :param binpath: Binary path
+    :return: Dictionary of results for each coreflag (massdat, fitdat, rsquared, runtime)
+    """
+    path = os.path.join(directory, fname)
+    shutil.copy(os.path.join(example_dir, fname), path)
+    results = {}
+    for coreflag in [0, 1]:
+        eng = unidec.engine.UniDec()
+        eng.open_file(path, refresh=True)
+        eng.config.coreflag = coreflag
+        eng.config.cacheflag = 0
+        eng.config.UniDecPath = binpath
+        eng.process_data()
+        tstart = time.perf_counter()
+        eng.run_unidec(silent=True)
+        results[coreflag] = {"massdat": np.array(eng.data.massdat), "fitdat": np.array(eng.data.fitdat),
+                             "rsquared": eng.config.error, "runtime": time.perf_counter() - tstart}
+    return results
+
+
+def compare(fname, binpath):
+    """
+    Check that the core matches the binary on an example file.
+    :param fname: Example file name
+    :param binpath: Binary path
+    :return: None
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_both(fname, directory, binpath)
+    binary = results[0]
+    core = results[1]
+    print(fname, "Mass axis length:", len(binary["massdat"]), len(core["massdat"]), "R Squared:",
+          binary["rsquared"], core["rsquared"], "Time:", binary["runtime"], core["runtime"])
+    assert np.array_equal(binary["massdat"][:, 0], core["massdat"][:, 0])
+    assert abs(binary["rsquared"] - core["rsquared"]) < 1e-5
+    maxint = np.amax(binary["massdat"][:, 1])
+    assert np.amax(np.abs(binary["massdat"][:, 1] - core["massdat"][:, 1])) < 0.01 * maxint
+    assert np.amax(np.abs(binary["fitdat"] - core["fitdat"])) < 0.001 * np.amax(binary["fitdat"])
+
+
+def get_binary_path():
+    if binary_path is not None:
+        return binary_path
+    return unidec.engine.UniDec().config.UniDecPath
+
+
+def test_core_matches_binary():
+    import pytest
+    binpath = get_binary_path()
+    if not binary_works(binpath):
+        pytest.skip("UniDec binary is not available: " + binpath)
+    for fname in example_files:
+        compare(fname, binpath)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        binary_path = sys.argv[1]
+    binpath = get_binary_path()
+    if not binary_works(binpath):
+        print("UniDec binary is not available:", binpath)
+    else:
+        for f in example_files:
+            compare(f, binpath)
+        print("Core matches binary")
@@ -876,14 +876,14 @@ class DataCollector(wx.Frame):
                 if self.filetype == 1:
                     data = get_dataset(msdata, "raw_data")
                 else:
-                    data = np.loadtxt(filename)
+                    data = ud.load_mz_file(filename)
                 self.xlabel = "m/z (Th)"
             elif self.datachoice == 1:
                 filename = os.path.join(header + "_unidecfiles", subheader + "_input.dat")
                 if self.filetype == 1:
                     data = get_dataset(msdata, "processed_data")
                 else:
-                    data = np.loadtxt(filename)
+                    data = ud.load_txt_cached(filename)
                 self.xlabel = "m/z (Th)"
             elif self.datachoice == 2:
                 self.xlabel = "Mass (Da)"
@@ -892,7 +892,7 @@ class DataCollector(wx.Frame):
                 if self.filetype == 1:
                     data = get_dataset(msdata, "mass_data")
                 else:
-                    data = np.loadtxt(filename)
+                    data = ud.load_txt_cached(filename)
                 if not zstate == 'All':
                     try:
                         filename = os.path.join(header + "_unidecfiles", subheader + "_massgrid.bin")
@@ -941,7 +941,7 @@ class DataCollector(wx.Frame):
                 if self.filetype == 1:
                     print("ERROR: HDF5 Files not supported with IMMS data")
                 else:
-                    data = np.loadtxt(filename)
+                    data = ud.load_txt_cached(filename)
                 self.xlabel = "CCS (A^2)"
 
             elif self.datachoice == 4:
@@ -950,7 +950,7 @@ class DataCollector(wx.Frame):
                 if self.filetype == 1:
                     data = get_dataset(msdata, "mass_data_dd")
                 else:
-                    data = np.loadtxt(filename)
+                    data = ud.load_txt_cached(filename)
 
             if not ud.isempty(self.range):
                 bool1 = data[:, 0] >= self.range[0]
@@ -1219,7 +1219,7 @@ class DataCollector(wx.Frame):
             else:
                 file2 = filename
                 print("Undefined choice for data type", self.datachoice, type(self.datachoice))
-            data = np.loadtxt(file2)
+            data = ud.load_txt_cached(file2)
             massgrid = np.fromfile(filename, dtype=self.config.dtype)
             configfile = os.path.join(header + "_unidecfiles", subheader + "_conf.dat")
             f = open(configfile, 'r')
@@ -1380,7 +1380,7 @@ class DataCollector(wx.Frame):
             if self.filetype == 1:
                 data = get_dataset(msdata, "mass_data")
             else:
-                data = np.loadtxt(filename)
+                data = ud.load_txt_cached(filename)
 
             self.paths.append(filename)
             self.headers.append(header)
@@ -1270,6 +1270,7 @@ class UniDecApp(UniDecPres):
                 # Write New Config and Run It
                 self.export_config(self.eng.config.confname)
 
+                ud.export_txt_from_cache(self.eng.config.infname)
                 ud.unidec_call(self.eng.config)
 
                 tend = time.perf_counter()
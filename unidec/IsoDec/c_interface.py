@@ -75,7 +75,16 @@ class IsoDecWrapper:
         print(charge.value)
         return charge.value
 
-    def process_spectrum(self, centroids, pks=None, config=None):
+    def process_spectrum(self, centroids, pks=None, config=None, aggregate=True):
+        """
+        Find the peaks in a centroided spectrum with the C library and add them to a MatchedCollection.
+        :param centroids: Centroid data, m/z in first column, intensity in second
+        :param pks: MatchedCollection to add the peaks to. Default is a new one.
+        :param config: IsoDecConfig object with the scan info for the peaks
+        :param aggregate: Whether to group the peaks into masses. Set to False when processing many scans into the
+        same collection, and call pks.aggregate_masses once at the end.
+        :return: MatchedCollection of peaks
+        """
         #print("Running C Interface")
         cmz = centroids[:, 0].astype(np.float32)
         cint = centroids[:, 1].astype(np.float32)
@@ -121,7 +130,8 @@ class IsoDecWrapper:
             #pk.isodist[:,0] /= float(p.z)
             pk.isodist[:,1] *= p.peakint
             pks.add_peak(pk)
-            pks.add_pk_to_masses(pk, 10)
+        if aggregate:
+            pks.aggregate_masses(10)
         return pks
 
 
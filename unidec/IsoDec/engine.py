@@ -11,6 +11,7 @@ from unidec.IsoDec.encoding import data_dirs, encode_noise, encode_phase_all, sm
     encode_double
 import os
 import math
+import multiprocessing
 from copy import deepcopy
 import unidec.tools as ud
 import pickle as pkl
@@ -19,6 +20,81 @@ from unidec.IsoDec.c_interface import IsoDecWrapper
 from unidec.IsoDec.plots import *
 import platform
 import numba as nb
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# File types picked up by IsoDecEngine.process_directory
+data_extensions = [".raw", ".mzml", ".mzml.gz", ".mzxml"]
+
+# Each worker process keeps its own engine, loaded model, and reader between tasks
+worker_engine = None
+worker_config = None
+
+
+def init_isodec_worker(phaseres, config, file=None, nthreads=1):
+    """
+    Set up an IsoDec worker process. Loads the phase model once and opens the file if given.
+    :param phaseres: Bit depth of the phase encoding
+    :param config: IsoDecConfig object copied to the engine before each task
+    :param file: Data file to open for scan chunks. None for directory mode.
+    :param nthreads: Number of torch threads for each worker
+    :return: None
+    """
+    global worker_engine, worker_config
+    torch.set_num_threads(nthreads)
+    worker_engine = IsoDecEngine(phaseres=phaseres)
+    worker_config = config
+    if not worker_engine.use_wrapper:
+        worker_engine.phasemodel.setup_model()
+    if file is not None:
+        worker_engine.reader = ud.get_importer(file)
+
+
+def run_isodec_scans(scans, centroided, ext):
+    """
+    Process a chunk of scans from the file opened in init_isodec_worker.
+    :param scans: List of scans
+    :param centroided: Whether the data is already centroided
+    :param ext: File extension
+    :return: List of MatchedPeak objects, Number of accepted clusters
+    """
+    eng = worker_engine
+    eng.config = deepcopy(worker_config)
+    eng.pks = MatchedCollection()
+    eng.process_scans(eng.reader, scans, centroided, ext, verbose=False)
+    return eng.pks.peaks, eng.config.acceptedclusters
+
+
+def run_isodec_file(file, outfile, exporttype):
+    """
+    Process one file in a worker and export the peaks.
+    :param file: Data file
+    :param outfile: Output file for export_peaks
+    :param exporttype: Export type for export_peaks
+    :return: File, Output file, Number of peaks, Error string or None
+    """
+    return process_and_export(worker_engine, worker_config, file, outfile, exporttype)
+
+
+def process_and_export(eng, config, file, outfile, exporttype):
+    """
+    Process a file with a fresh copy of the config and export the peaks.
+    :param eng: IsoDecEngine object
+    :param config: IsoDecConfig object
+    :param file: Data file
+    :param outfile: Output file for export_peaks
+    :param exporttype: Export type for export_peaks
+    :return: File, Output file, Number of peaks, Error string or None
+    """
+    try:
+        eng.config = deepcopy(config)
+        eng.pks = MatchedCollection()
+        reader = eng.process_file(file, nworkers=1)
+        if isinstance(reader, list):
+            return file, "", 0, "Could not open file"
+        eng.export_peaks(type=exporttype, filename=outfile, reader=reader)
+        return file, outfile, len(eng.pks.peaks), None
+    except Exception as e:
+        return file, "", 0, str(e) or repr(e)
 
 
 class IsoDecDataset(torch.utils.data.Dataset):
@@ -83,6 +159,7 @@ class IsoDecEngine:
             self.wrapper = None
 
         self.reader = None
+        self.nworkers = 1  # Number of worker processes for process_file and process_directory. 1 runs serially.
 
     def add_noise(self, noise_percent):
         """
@@ -392,51 +469,87 @@ class IsoDecEngine:
         :param centroided: Whether the data is already centroided. If not, it will centroid it.
         :return: MatchedCollection of peaks
         """
+        self.batch_process_spectra([data], window=window, threshold=threshold, centroided=centroided)
+        if self.use_wrapper:
+            self.pks.aggregate_masses(10)
+        return self.pks
+
+    def batch_process_spectra(self, spectra, scaninfo=None, window=None, threshold=0.001, centroided=False):
+        """
+        Process several spectra together and add the peaks to self.pks in the order of the spectra.
+
+        The knockdown rounds run in step across the spectra. In each round, the encoded peaks from every spectrum
+        are predicted together in one call to the phase model, and the charges are routed back to their spectra
+        for matching and knockdown.
+        :param spectra: List of spectra, m/z in first column, intensity in second
+        :param scaninfo: List of (scan, retention time, MS order) for each spectrum. Default is the active scan info.
+        :param window: Window for peak selection
+        :param threshold: Threshold for peak selection
+        :param centroided: Whether the data is already centroided. If not, it will centroid it.
+        :return: MatchedCollection of peaks
+        """
         starttime = time.perf_counter()
         if window is None:
             window = self.config.peakwindow
+        if scaninfo is None:
+            scaninfo = [self.config.get_scan_info()] * len(spectra)
 
         # TODO: Need a way to test for whether data is centroided already
         if centroided:
-            centroids = data
+            centroids = list(spectra)
         else:
-            centroids = deepcopy(get_all_centroids(data, window=5, threshold=threshold * 0.1))
+            centroids = [deepcopy(get_all_centroids(data, window=5, threshold=threshold * 0.1)) for data in spectra]
 
         if self.use_wrapper:
-            self.pks = self.wrapper.process_spectrum(centroids, self.pks, self.config)
-        else:
-            kwindow = window
-            threshold = threshold
-            for i in range(self.config.knockdown_rounds):
-
-                if i <= 5:
-                    self.config.css_thresh = 0.85
-                else:
-                    self.config.css_thresh = 0.75
-
-                if i > 0:
-                    kwindow = kwindow * 0.5
-                self.config.current_KD_round = i
-                peaks = fastpeakdetect(centroids, window=kwindow, threshold=threshold)
+            for k in range(len(centroids)):
+                self.config.set_scan_info_values(*scaninfo[k])
+                self.pks = self.wrapper.process_spectrum(centroids[k], self.pks, self.config, aggregate=False)
+            return self.pks
+
+        # Peaks for each spectrum, merged into self.pks at the end so they are in spectrum order
+        pkslist = [MatchedCollection() for _ in centroids]
+        active = list(range(len(centroids)))
+        kwindow = window
+        for i in range(self.config.knockdown_rounds):
+            if len(active) == 0:
+                break
+
+            if i <= 5:
+                self.config.css_thresh = 0.85
+            else:
+                self.config.css_thresh = 0.75
+
+            if i > 0:
+                kwindow = kwindow * 0.5
+            self.config.current_KD_round = i
+
+            # Find and encode the peaks in each spectrum
+            rounddata = []
+            for k in active:
+                peaks = fastpeakdetect(centroids[k], window=kwindow, threshold=threshold)
                 # print("Knockdown:", i, "Peaks:", len(peaks))
-                #print("Knockdown:", i, "Peaks:", peaks)
                 if len(peaks) == 0:
-                    break
-
-                emats, peaks, centlist, indexes = encode_phase_all(centroids, peaks, lowmz=self.config.mzwindow[0],
-                                                                   highmz=self.config.mzwindow[1], phaseres=self.phaseres)
-
-
-                emats = [torch.as_tensor(e, dtype=torch.float32) for e in emats]
-                # emats = torch.as_tensor(emats, dtype=torch.float32).to(self.phasemodel.device)
-                data_loader = DataLoader(emats, batch_size=1024, shuffle=False, pin_memory=True)
-                preds = self.phasemodel.batch_predict(data_loader)
+                    continue
+                emats, peaks, centlist, indexes = encode_phase_all(centroids[k], peaks, lowmz=self.config.mzwindow[0],
+                                                                   highmz=self.config.mzwindow[1],
+                                                                   phaseres=self.phaseres)
+                rounddata.append((k, emats, peaks, centlist, indexes))
+
+            # Predict the charges for all spectra at once
+            preds = self.phasemodel.predict_batch([e for r in rounddata for e in r[1]])
+
+            nextactive = []
+            pindex = 0
+            for k, emats, peaks, centlist, indexes in rounddata:
+                zs = preds[pindex:pindex + len(emats)]
+                pindex += len(emats)
+                self.config.set_scan_info_values(*scaninfo[k])
                 knockdown = []
                 ngood = 0
                 # print(peaks, len(peaks))
                 for j, p in enumerate(peaks):
-                    z = preds[j]
-                    kindex = fastnearest(centroids[:, 0], p[0])
+                    z = zs[j]
+                    kindex = fastnearest(centroids[k][:, 0], p[0])
 
                     if kindex in knockdown:
                         continue
@@ -444,10 +557,8 @@ class IsoDecEngine:
                         knockdown.append(kindex)
                         continue
 
-
                     # Get the centroids around the peak
-                    matchedindexes, peaks = self.get_matches(centlist[j], z, p[0], pks=self.pks)
-
+                    matchedindexes, mpeaks = self.get_matches(centlist[j], z, p[0], pks=pkslist[k])
 
                     if len(matchedindexes) > 0:
                         ngood += 1
@@ -460,14 +571,22 @@ class IsoDecEngine:
                 self.config.acceptedclusters += ngood
                 #print("NGood:", ngood)
                 if len(knockdown) == 0:
+                    nextactive.append(k)
                     continue
                 knockdown = np.array(knockdown)
-                centroids = np.delete(centroids, knockdown, axis=0)
+                centroids[k] = np.delete(centroids[k], knockdown, axis=0)
 
-                if len(centroids) < 3:
-                    break
+                if len(centroids[k]) < 3:
+                    continue
                 #centroids = centroids[centroids[:, 1] > 0]
-            # print("Time:", time.perf_counter() - starttime)
+                nextactive.append(k)
+            active = nextactive
+
+        for pks in pkslist:
+            for p in pks.peaks:
+                self.pks.add_peak(p)
+        self.config.set_scan_info_values(*scaninfo[-1])
+        # print("Time:", time.perf_counter() - starttime)
         return self.pks
 
     def perform_modelling_kd(self, centroids, indval, peaks):
@@ -512,7 +631,15 @@ class IsoDecEngine:
 
 
 
-    def process_file(self, file, scans=None):
+    def process_file(self, file, scans=None, nworkers=None, chunksize=None):
+        """
+        Process all scans in a file and add the peaks to self.pks.
+        :param file: Data file path
+        :param scans: List of scans to process. None processes all scans.
+        :param nworkers: Number of worker processes. Default is self.nworkers. 1 processes the scans serially.
+        :param chunksize: Number of scans sent to a worker at a time. Default is four chunks per worker.
+        :return: Data reader object
+        """
         starttime = time.perf_counter()
         self.config.filepath = file
         # Get importer and check it
@@ -531,13 +658,40 @@ class IsoDecEngine:
         else:
             centroided = False
 
+        if scans is not None:
+            scans = set(scans)
+            scanlist = [s for s in reader.scans if s in scans]
+        else:
+            scanlist = list(reader.scans)
+
+        if nworkers is None:
+            nworkers = self.nworkers
+        if nworkers is not None and nworkers > 1 and len(scanlist) > 1:
+            self.process_scans_parallel(file, scanlist, centroided, ext, nworkers, chunksize=chunksize)
+        else:
+            self.process_scans(reader, scanlist, centroided, ext)
+
+        print("Time:", time.perf_counter() - starttime)
+        print("N Peaks:", len(self.pks.peaks))
+
+        #self.pks.save_pks()
+        return reader
+
+    def process_scans(self, reader, scans, centroided=False, ext="", verbose=True):
+        """
+        Process a list of scans in order and add the peaks to self.pks.
+        :param reader: Data reader object
+        :param scans: List of scans
+        :param centroided: Whether the data is already centroided
+        :param ext: File extension. Centroids are read directly from .raw files.
+        :param verbose: Whether to print the time per scan
+        :return: None
+        """
         t2 = time.perf_counter()
+        spectra = []
+        scaninfo = []
         # Loop over all scans
-        for s in reader.scans:
-            if scans is not None:
-                if s not in scans:
-                    continue
-
+        for n, s in enumerate(scans):
             # Open the scan and get the spectrum
             try:
                 if ext == ".raw":
@@ -547,29 +701,153 @@ class IsoDecEngine:
                     spectrum = reader.grab_scan_data(s)
             except Exception as e:
                 print("Error Reading Scan", s, e)
-                continue
+                spectrum = []
             # If the spectrum is too short, skip it
-            if len(spectrum) < 3:
-                continue
+            if spectrum is not None and len(spectrum) >= 3:
+                self.config.set_scan_info(s, reader)
+                # b1 = spectrum[:,1] > 0
+                # spectrum = spectrum[b1]
+                spectra.append(spectrum)
+                scaninfo.append(self.config.get_scan_info())
+
+            # Process the scans in groups so that the phase model predictions are batched across scans
+            if len(spectra) >= self.config.scanbatch or (n == len(scans) - 1 and len(spectra) > 0):
+                self.batch_process_spectra(spectra, scaninfo=scaninfo, centroided=centroided)
+                if verbose:
+                    print("Scan:", s, "N Scans:", len(spectra), "Avg. Time per scan:",
+                          (time.perf_counter() - t2) / len(spectra))
+                    t2 = time.perf_counter()
+                spectra = []
+                scaninfo = []
+
+        # Group the peaks from the C library into masses once, after all scans
+        if self.use_wrapper:
+            self.pks.aggregate_masses(10)
+
+    def process_scans_parallel(self, file, scans, centroided=False, ext="", nworkers=2, chunksize=None):
+        """
+        Process a list of scans in a process pool and add the peaks to self.pks in scan order.
+
+        The scans are split into contiguous chunks. Workers are spawned rather than forked, so they can set up
+        CUDA even if this process has already used it. Each worker opens the file and loads the model once, and
+        each chunk starts from a copy of the current config. This engine processes the first chunk itself while
+        the workers start. A chunk that fails in a worker is processed again here, so no scans are dropped.
+        :param file: Data file path
+        :param scans: List of scans
+        :param centroided: Whether the data is already centroided
+        :param ext: File extension
+        :param nworkers: Number of worker processes
+        :param chunksize: Number of scans per chunk. Default is four chunks per worker.
+        :return: None
+        """
+        if chunksize is None:
+            chunksize = int(math.ceil(len(scans) / (nworkers * 4)))
+        chunksize = max(1, int(chunksize))
+        chunks = [scans[i:i + chunksize] for i in range(0, len(scans), chunksize)]
+        config = deepcopy(self.config)
 
-            self.config.set_scan_info(s, reader)
-            # b1 = spectrum[:,1] > 0
-            # spectrum = spectrum[b1]
-            self.batch_process_spectrum(spectrum, centroided=centroided)
+        t2 = time.perf_counter()
+        if len(chunks) == 1:
+            self.process_scans(self.reader, chunks[0], centroided, ext, verbose=False)
+            return
+
+        nthreads = max(1, (os.cpu_count() or 1) // nworkers)
+        with ProcessPoolExecutor(max_workers=nworkers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_isodec_worker,
+                                 initargs=(self.phaseres, config, file, nthreads)) as executor:
+            futures = [executor.submit(run_isodec_scans, c, centroided, ext) for c in chunks[1:]]
+            self.process_scans(self.reader, chunks[0], centroided, ext, verbose=False)
+            print("Chunk:", 1, "of", len(chunks), "Avg. Time per scan:", (time.perf_counter() - t2) / len(chunks[0]))
+            # Merge in submission order so the peaks stay in scan order
+            for i, f in enumerate(futures):
+                try:
+                    peaks, accepted = f.result()
+                except Exception as e:
+                    print("Error processing scans", chunks[i + 1][0], "to", chunks[i + 1][-1], e,
+                          "Processing them in this process.")
+                    self.process_scans(self.reader, chunks[i + 1], centroided, ext, verbose=False)
+                else:
+                    for p in peaks:
+                        self.pks.add_peak(p)
+                    self.config.acceptedclusters += accepted
+                print("Chunk:", i + 2, "of", len(chunks), "Avg. Time per scan:",
+                      (time.perf_counter() - t2) / sum([len(c) for c in chunks[:i + 2]]))
 
-            if s % 10 == 0:
-                print("Scan:", s, "Length:", len(spectrum), "Avg. Time per scan:", (time.perf_counter() - t2) / 10.)
-                t2 = time.perf_counter()
+        # Group the merged peaks into masses, so they cover the chunks from the workers too
+        if self.use_wrapper:
+            self.pks.aggregate_masses(10)
 
-        print("Time:", time.perf_counter() - starttime)
-        print("N Peaks:", len(self.pks.peaks))
+    def process_directory(self, directory, outdir=None, exporttype="pkl", extensions=None, nworkers=None):
+        """
+        Process every data file in a directory and export the peaks for each file.
+        Files are split over a process pool with at most nworkers processes, and each file is processed serially.
+        :param directory: Directory of data files
+        :param outdir: Output directory. Default is the data directory.
+        :param exporttype: Export type for export_peaks. Default is pkl.
+        :param extensions: List of file extensions to process. Default is data_extensions.
+        :param nworkers: Number of worker processes. Default is self.nworkers. 1 processes files serially.
+        :return: List of (file, output file, number of peaks, error or None) for each file
+        """
+        starttime = time.perf_counter()
+        if extensions is None:
+            extensions = data_extensions
+        extensions = [e.lower() for e in extensions]
+        if outdir is None:
+            outdir = directory
+        os.makedirs(outdir, exist_ok=True)
+        outext = {"pkl": ".pkl", "npz": ".npz", "prosightlite": ".txt", "msalign": ".msalign"}.get(exporttype, ".txt")
+
+        files = []
+        outfiles = []
+        names = sorted(os.listdir(directory))
+        for f in names:
+            path = os.path.join(directory, f)
+            matches = [e for e in extensions if f.lower().endswith(e)]
+            if not os.path.isfile(path) or len(matches) == 0:
+                continue
+            # Skip the gzip copies that the mzML importer makes next to the original files
+            if f.lower().endswith(".gz") and f[:-3] in names:
+                continue
+            files.append(path)
+            outfiles.append(os.path.join(outdir, f[:-len(matches[0])] + "_isodec" + outext))
+        print("Directory:", directory, "N Files:", len(files))
+
+        if nworkers is None:
+            nworkers = self.nworkers
+        config = deepcopy(self.config)
+        if nworkers is not None and nworkers > 1 and len(files) > 1:
+            results = [None] * len(files)
+            nthreads = max(1, (os.cpu_count() or 1) // nworkers)
+            with ProcessPoolExecutor(max_workers=min(nworkers, len(files)),
+                                     mp_context=multiprocessing.get_context("spawn"), initializer=init_isodec_worker,
+                                     initargs=(self.phaseres, config, None, nthreads)) as executor:
+                futures = {executor.submit(run_isodec_file, f, o, exporttype): i
+                           for i, (f, o) in enumerate(zip(files, outfiles))}
+                for f in as_completed(futures):
+                    i = futures[f]
+                    try:
+                        results[i] = f.result()
+                    except Exception as e:
+                        results[i] = (files[i], "", 0, str(e) or repr(e))
+                    print("Finished:", results[i][0], "N Peaks:", results[i][2])
+        else:
+            results = [process_and_export(self, config, f, o, exporttype) for f, o in zip(files, outfiles)]
+            self.config = config
 
-        #self.pks.save_pks()
-        return reader
+        for r in results:
+            if r[3] is not None:
+                print("Error processing", r[0], r[3])
+        print("Directory Time:", time.perf_counter() - starttime)
+        return results
 
     def export_peaks(self, type="prosightlite", filename=None, reader=None, max_precursors=None):
         if filename is None:
-            filename = "peaks.csv"
+            if type == "pkl":
+                filename = "peaks.pkl"
+            elif type == "npz":
+                filename = "peaks.npz"
+            else:
+                filename = "peaks.csv"
 
         if reader is None:
             reader = self.reader
@@ -578,8 +856,8 @@ class IsoDecEngine:
             self.pks.export_prosightlite(filename)
         elif type == "msalign":
             self.pks.export_msalign(reader, filename, max_precursors=max_precursors)
-        elif type == "pkl":
-            self.pks.save_pks()
+        elif type == "pkl" or type == "npz":
+            self.pks.save_pks(filename)
         else:
             raise ValueError("Unknown Export Type", type)
 
@@ -606,6 +884,7 @@ class IsoDecConfig:
         self.activescan = -1
         self.activescanrt = -1
         self.activescanorder = -1
+        self.scanbatch = 64  # Number of scans processed together to batch the phase model predictions
 
     def set_scan_info(self, s, reader=None):
         """
@@ -619,6 +898,25 @@ class IsoDecConfig:
             self.activescanrt = reader.get_scan_time(s)
             self.activescanorder = reader.get_ms_order(s)
 
+    def get_scan_info(self):
+        """
+        Gets the active scan info
+        :return: Tuple of scan, retention time, and MS order
+        """
+        return self.activescan, self.activescanrt, self.activescanorder
+
+    def set_scan_info_values(self, s, rt, order):
+        """
+        Sets the active scan info from values returned by get_scan_info
+        :param s: The scan
+        :param rt: The retention time
+        :param order: The MS order
+        :return: None
+        """
+        self.activescan = s
+        self.activescanrt = rt
+        self.activescanorder = order
+
 
 if __name__ == "__main__":
     starttime = time.perf_counter()
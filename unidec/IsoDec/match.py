@@ -1,4 +1,5 @@
 import numpy as np
+import os
 import time
 import matchms
 from copy import deepcopy
@@ -23,10 +24,48 @@ class MatchedCollection:
     """
 
     def __init__(self):
-        self.peaks = []
+        self._peaks = []
+        self.table = None
         self.masses = []
         self.monoisos = np.array([])
         self.colormap = mpl.colormaps.get_cmap("tab10")
+        self.massagg = None
+        self.nmassagg = 0
+
+    @property
+    def peaks(self):
+        """
+        List of MatchedPeak objects. If the collection was loaded as a PeakTable, the objects are created on first use.
+        """
+        if self._peaks is None:
+            self._peaks = self.table.to_peaks(self.colormap)
+            self.table = None
+        return self._peaks
+
+    @peaks.setter
+    def peaks(self, peaks):
+        self._peaks = peaks
+        self.table = None
+
+    def get_table(self, ragged=None):
+        """
+        Get the peaks as a PeakTable.
+        :param ragged: Names of the array attributes to keep. Default is PeakTable.defaultragged.
+        :return: PeakTable object
+        """
+        if self._peaks is None and (ragged is None or set(ragged) <= set(self.table.ragged)):
+            return self.table
+        return PeakTable.from_peaks(self.peaks, ragged=ragged)
+
+    def set_table(self, table):
+        """
+        Use a PeakTable as the peaks without creating MatchedPeak objects.
+        :param table: PeakTable object
+        :return: self
+        """
+        self.table = table
+        self._peaks = None
+        return self
 
     def __str__(self):
         outstring = ""
@@ -35,7 +74,9 @@ class MatchedCollection:
         return outstring
 
     def __len__(self):
-        return len(self.peaks)
+        if self._peaks is None:
+            return len(self.table)
+        return len(self._peaks)
 
     def __getitem__(self, item):
         return self.peaks[item]
@@ -55,11 +96,29 @@ class MatchedCollection:
         return self
 
     def save_pks(self, filename="peaks.pkl"):
+        """
+        Save the peaks. Files ending in .npz are saved as a binary PeakTable, everything else is pickled.
+        :param filename: Output file name
+        :return: None
+        """
+        if os.path.splitext(filename)[1].lower() == ".npz":
+            self.get_table().save(filename)
+            print(f"Saved {len(self)} peaks to {filename}")
+            return
         with open(filename, "wb") as f:
             pkl.dump(self.peaks, f)
             print(f"Saved {len(self.peaks)} peaks to {filename}")
 
     def load_pks(self, filename="peaks.pkl"):
+        """
+        Load peaks saved with save_pks. Binary .npz files are loaded as a PeakTable without creating peak objects.
+        :param filename: Input file name
+        :return: self
+        """
+        if os.path.splitext(filename)[1].lower() == ".npz":
+            self.set_table(PeakTable.load(filename))
+            print(f"Loaded {len(self)} peaks from {filename}")
+            return self
         with open(filename, "rb") as f:
             self.peaks = pkl.load(f)
             print(f"Loaded {len(self.peaks)} peaks from {filename}")
@@ -101,6 +160,25 @@ class MatchedCollection:
                     self.monoisos = np.insert(self.monoisos, idx, pk.monoiso)
                     self.masses.insert(idx, MatchedMass(pk))
 
+    def aggregate_masses(self, ppmtol=10, maxscangap=100):
+        """
+        Group all peaks into masses with a MassAggregator. Gives the same masses as calling add_pk_to_masses for each
+        peak in order, but in O(n log n). Peaks added since the last call are appended to the existing aggregator.
+        :param ppmtol: Tolerance in ppm between the monoisotopic masses
+        :param maxscangap: Maximum number of scans from the last peak of a mass
+        :return: List of MatchedMass objects, also set as self.masses
+        """
+        agg = self.massagg
+        if agg is None or agg.ppmtol != ppmtol or agg.maxscangap != maxscangap or self.nmassagg > len(self.peaks):
+            agg = MassAggregator(ppmtol=ppmtol, maxscangap=maxscangap)
+            self.nmassagg = 0
+        agg.add_peaks(self.peaks[self.nmassagg:])
+        self.massagg = agg
+        self.nmassagg = len(self.peaks)
+        self.masses = agg.get_masses()
+        self.monoisos = agg.monoisos
+        return self.masses
+
     def export_prosightlite(self, filename="prosight.txt"):
         with open(filename, "w") as f:
             for p in self.masses:
@@ -147,12 +225,9 @@ class MatchedCollection:
         :param pks: MatchedCollection object
         :return: Pandas dataframe
         """
-        data = []
-        for p in self.peaks:
-            d = {"Charge": p.z, "Most Abundant m/z": p.mz, "Monoisotopic Mass": p.monoiso, "Scan": p.scan,
-                 "Most Abundant Mass": p.peakmass, "Abundance": p.matchedintensity}
-            data.append(d)
-        df = pd.DataFrame(data)
+        columns = {"z": "Charge", "mz": "Most Abundant m/z", "monoiso": "Monoisotopic Mass", "scan": "Scan",
+                   "peakmass": "Most Abundant Mass", "matchedintensity": "Abundance"}
+        df = self.get_table(ragged=[]).to_df(columns)
         return df
 
     def export_tsv(self, filename="export.tsv"):
@@ -165,7 +240,9 @@ class MatchedMass:
     Matched mass object for collecting data on MatchedPeaks with matched masses.
     """
 
-    def __init__(self, pk):
+    def __init__(self, pk=None):
+        if pk is None:
+            return
         self.monoiso = pk.monoiso
         self.scans = np.array([pk.scan])
         self.maxintensity = pk.matchedintensity
@@ -175,6 +252,288 @@ class MatchedMass:
         self.zs = np.array([pk.z])
 
 
+@njit(fastmath=True)
+def _bit_add(tree, i, v):
+    i += 1
+    while i < len(tree):
+        tree[i] += v
+        i += i & -i
+
+
+@njit(fastmath=True)
+def _bit_count(tree, i):
+    # Number of items in positions [0, i)
+    total = 0
+    while i > 0:
+        total += tree[i]
+        i -= i & -i
+    return total
+
+
+@njit(fastmath=True)
+def _bit_find(tree, k, topbit):
+    # Position of the item with k items before it
+    pos = 0
+    bit = topbit
+    while bit > 0:
+        nxt = pos + bit
+        if nxt < len(tree) and tree[nxt] <= k:
+            pos = nxt
+            k -= tree[nxt]
+        bit >>= 1
+    return pos
+
+
+@njit(fastmath=True)
+def _group_masses(monoiso, scans, intensity, hasint, rts, sortedvals, sortpos, ppmtol, maxscangap):
+    """
+    Replay add_pk_to_masses on columns of peaks.
+
+    The sorted list of mass monoisos in add_pk_to_masses only ever gains the monoiso of the peak that starts a mass,
+    and it is placed after smaller values and before equal ones. Each peak therefore has a fixed position in the
+    final order (sortpos, sorting by monoiso then newest first), and a Fenwick tree over those positions gives the
+    same bisect and nearest lookups as the list without inserting into an array.
+    :return: Mass of each peak (in order of creation), sort position of each mass, max intensity, max scan, max rt,
+        whether each mass has an intensity, number of masses
+    """
+    n = len(monoiso)
+    tree = np.zeros(n + 1, dtype=np.int64)
+    topbit = 1
+    while topbit * 2 <= n:
+        topbit *= 2
+    massofpos = np.full(n, -1, dtype=np.int64)
+    massindex = np.zeros(n, dtype=np.int64)
+    masspos = np.zeros(n, dtype=np.int64)
+    massmono = np.zeros(n)
+    masslast = np.zeros(n)
+    maxint = np.zeros(n)
+    maxscan = np.zeros(n)
+    maxrt = np.zeros(n)
+    masshasint = np.zeros(n, dtype=np.bool_)
+    nmass = 0
+    for i in range(n):
+        t = monoiso[i]
+        m = -1
+        if nmass > 0:
+            # Same as fastnearest on the sorted list of mass monoisos
+            b = _bit_count(tree, np.searchsorted(sortedvals, t))
+            if b <= 0:
+                j = 0
+            elif b >= nmass - 1:
+                j = nmass - 1
+            else:
+                vb = massmono[massofpos[_bit_find(tree, b, topbit)]]
+                vnext = massmono[massofpos[_bit_find(tree, b + 1, topbit)]]
+                vprev = massmono[massofpos[_bit_find(tree, b - 1, topbit)]]
+                j = b
+                if np.abs(vb - t) > np.abs(vnext - t):
+                    j = b + 1
+                elif np.abs(vb - t) > np.abs(vprev - t):
+                    j = b - 1
+            m = massofpos[_bit_find(tree, j, topbit)]
+            if scans[i] - masslast[m] <= maxscangap and np.abs((massmono[m] - t) / massmono[m]) * 1e6 <= ppmtol:
+                massindex[i] = m
+                masslast[m] = scans[i]
+                if hasint[i] and (not masshasint[m] or intensity[i] > maxint[m]):
+                    maxint[m] = intensity[i]
+                    maxscan[m] = scans[i]
+                    maxrt[m] = rts[i]
+                    masshasint[m] = True
+                continue
+
+        # Start a new mass
+        m = nmass
+        nmass += 1
+        pos = sortpos[i]
+        massofpos[pos] = m
+        _bit_add(tree, pos, 1)
+        massindex[i] = m
+        masspos[m] = pos
+        massmono[m] = t
+        masslast[m] = scans[i]
+        maxint[m] = intensity[i]
+        maxscan[m] = scans[i]
+        maxrt[m] = rts[i]
+        masshasint[m] = hasint[i]
+    return massindex, masspos[:nmass], maxint[:nmass], maxscan[:nmass], maxrt[:nmass], masshasint[:nmass], nmass
+
+
+class MassAggregator:
+    """
+    Columnar grouping of MatchedPeaks into masses.
+
+    Peaks are appended as columns (monoiso, scan, intensity, rt, z, m/z) and grouped when the results are needed.
+    The masses are the same as adding the peaks one at a time with MatchedCollection.add_pk_to_masses, in the same
+    order, but without inserting into arrays for each peak.
+    """
+    columns = ["monoiso", "scan", "intensity", "rt", "z", "mz"]
+
+    def __init__(self, ppmtol=10, maxscangap=100):
+        """
+        :param ppmtol: Tolerance in ppm between the monoisotopic masses
+        :param maxscangap: Maximum number of scans from the last peak of a mass
+        """
+        self.ppmtol = ppmtol
+        self.maxscangap = maxscangap
+        self.chunks = []
+        self.pending = []
+        self.hasint = []
+        self.data = np.zeros((0, len(self.columns)))
+        self.hasintensity = np.zeros(0, dtype=bool)
+        self.grouped = False
+
+        self.monoisos = np.array([])
+        self.massindex = np.array([], dtype=np.int64)
+        self.maxintensity = np.array([])
+        self.maxscan = np.array([])
+        self.maxrt = np.array([])
+        self.masshasintensity = np.array([], dtype=bool)
+        self.peakptr = np.zeros(1, dtype=np.int64)
+        self.peakorder = np.array([], dtype=np.int64)
+        self.zptr = np.zeros(1, dtype=np.int64)
+        self.zorder = np.array([], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.data) + len(self.pending) + int(np.sum([len(c) for c in self.chunks]))
+
+    def add_peak(self, pk):
+        """
+        Append one peak.
+        :param pk: MatchedPeak object
+        :return: None
+        """
+        intensity = pk.matchedintensity
+        self.hasint.append(intensity is not None)
+        self.pending.append((pk.monoiso, pk.scan, 0 if intensity is None else intensity, pk.rt, pk.z, pk.mz))
+        self.grouped = False
+
+    def add_peaks(self, peaks):
+        """
+        Append a list of peaks.
+        :param peaks: List of MatchedPeak objects
+        :return: None
+        """
+        for pk in peaks:
+            self.add_peak(pk)
+
+    def add_arrays(self, monoiso, scan, intensity, rt, z, mz):
+        """
+        Append peaks from arrays of equal length. Intensities of NaN are treated as missing.
+        :return: None
+        """
+        block = np.column_stack([monoiso, scan, intensity, rt, z, mz]).astype(float)
+        if len(self.pending) > 0:
+            self.flush()
+        self.chunks.append(block)
+        self.hasint.extend(list(np.isfinite(block[:, 2])))
+        block[~np.isfinite(block[:, 2]), 2] = 0
+        self.grouped = False
+
+    def flush(self):
+        """
+        Move appended peaks into the column array.
+        :return: None
+        """
+        if len(self.pending) > 0:
+            self.chunks.append(np.array(self.pending, dtype=float).reshape(-1, len(self.columns)))
+            self.pending = []
+        if len(self.chunks) > 0:
+            self.data = np.concatenate([self.data] + self.chunks)
+            self.hasintensity = np.concatenate([self.hasintensity, np.array(self.hasint, dtype=bool)])
+            self.chunks = []
+            self.hasint = []
+
+    def group(self):
+        """
+        Group the peaks into masses. Runs again only if peaks were added.
+        :return: None
+        """
+        if self.grouped:
+            return
+        self.flush()
+        n = len(self.data)
+        monoiso = np.ascontiguousarray(self.data[:, 0])
+        scans = np.ascontiguousarray(self.data[:, 1])
+        # Position of each peak sorting by monoiso, with the newest first for equal values
+        sortorder = np.lexsort((-np.arange(n), monoiso))
+        sortpos = np.empty(n, dtype=np.int64)
+        sortpos[sortorder] = np.arange(n)
+        sortedvals = monoiso[sortorder]
+
+        massindex, masspos, maxint, maxscan, maxrt, hasint, nmass = _group_masses(
+            monoiso, scans, np.ascontiguousarray(self.data[:, 2]), self.hasintensity,
+            np.ascontiguousarray(self.data[:, 3]), sortedvals, sortpos, float(self.ppmtol),
+            float(self.maxscangap))
+
+        # Renumber the masses in order of monoiso
+        massorder = np.argsort(masspos)
+        rank = np.empty(nmass, dtype=np.int64)
+        rank[massorder] = np.arange(nmass)
+        self.massindex = rank[massindex]
+        self.monoisos = monoiso[sortorder[masspos[massorder]]]
+        self.maxintensity = maxint[massorder]
+        self.maxscan = maxscan[massorder]
+        self.maxrt = maxrt[massorder]
+        self.masshasintensity = hasint[massorder]
+
+        # Peaks of each mass in the order they were added
+        self.peakorder = np.argsort(self.massindex, kind="stable")
+        self.peakptr = np.concatenate([[0], np.cumsum(np.bincount(self.massindex, minlength=nmass))])
+
+        # First peak of each charge state within each mass
+        z = self.data[:, 4]
+        zsort = np.lexsort((np.arange(n), z, self.massindex))
+        first = np.ones(n, dtype=bool)
+        if n > 1:
+            first[1:] = (self.massindex[zsort][1:] != self.massindex[zsort][:-1]) | (z[zsort][1:] != z[zsort][:-1])
+        zfirst = np.sort(zsort[first])
+        self.zorder = zfirst[np.argsort(self.massindex[zfirst], kind="stable")]
+        self.zptr = np.concatenate([[0], np.cumsum(np.bincount(self.massindex[zfirst], minlength=nmass))])
+        self.grouped = True
+
+    def get_scans(self, i):
+        """
+        :param i: Mass index
+        :return: Scans of the peaks in mass i, in the order they were added
+        """
+        self.group()
+        return self.data[self.peakorder[self.peakptr[i]:self.peakptr[i + 1]], 1].astype(np.int64)
+
+    def get_zs(self, i):
+        """
+        :param i: Mass index
+        :return: Charge states of mass i and the m/z of the first peak for each, in the order they were added
+        """
+        self.group()
+        index = self.zorder[self.zptr[i]:self.zptr[i + 1]]
+        return self.data[index, 4].astype(np.int64), self.data[index, 5]
+
+    def get_masses(self):
+        """
+        Create MatchedMass objects for all masses.
+        :return: List of MatchedMass objects sorted by monoisotopic mass
+        """
+        self.group()
+        scans = self.data[self.peakorder, 1].astype(np.int64)
+        zs = self.data[self.zorder, 4].astype(np.int64)
+        mzs = self.data[self.zorder, 5]
+        peakptr = self.peakptr.tolist()
+        zptr = self.zptr.tolist()
+        maxscans = self.maxscan.astype(np.int64).tolist()
+        masses = []
+        for i in range(len(self.monoisos)):
+            m = MatchedMass()
+            m.monoiso = self.monoisos[i]
+            m.scans = scans[peakptr[i]:peakptr[i + 1]]
+            m.maxintensity = self.maxintensity[i] if self.masshasintensity[i] else None
+            m.maxscan = maxscans[i]
+            m.maxrt = self.maxrt[i]
+            m.zs = zs[zptr[i]:zptr[i + 1]]
+            m.mzs = mzs[zptr[i]:zptr[i + 1]]
+            masses.append(m)
+        return masses
+
+
 '''@nb.experimental.jitclass([("centroids", nb.types.Array(nb.float64, 2, "C")),
                            ("isodist", nb.types.Array(nb.float64, 2, "C")),
                            ("matchedcentroids", nb.types.Array(nb.float64, 2, "C")),
@@ -210,6 +569,10 @@ class MatchedPeak:
     endindex: int
     matchedion: str
 
+    __slots__ = ("mz", "z", "centroids", "isodist", "matchedintensity", "matchedcentroids", "matchedisodist",
+                 "matchedindexes", "isomatches", "color", "scan", "rt", "ms_order", "massdist", "monoiso", "peakmass",
+                 "avgmass", "startindex", "endindex", "matchedion")
+
     def __init__(self, z, mz, centroids=None, isodist=None, matchedindexes=None, isomatches=None):
         self.mz = mz
         self.z = z
@@ -243,6 +606,190 @@ class MatchedPeak:
     def __str__(self):
         return f"MatchedPeak: mz={self.mz}, z={self.z}, monoiso={self.monoiso}\n"
 
+    def __getstate__(self):
+        return {k: getattr(self, k, None) for k in self.__slots__}
+
+    def __setstate__(self, state):
+        # Peaks pickled before __slots__ have a plain dictionary state
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+        for k in self.__slots__:
+            setattr(self, k, state.get(k, None))
+
+
+class PeakTable:
+    """
+    Columnar table of MatchedPeaks.
+
+    Scalar values are stored as one array per column. Optional ragged arrays (isotope distributions, matched
+    centroids, and matched indexes) are stored flat with a pointer array, so the rows for peak i are
+    data[ptr[i]:ptr[i + 1]]. Tables can be saved to an uncompressed .npz file and converted to pandas or Arrow
+    without copying the columns.
+    """
+    version = 1
+    columns = {"z": np.int64, "mz": float, "monoiso": float, "peakmass": float, "avgmass": float,
+               "matchedintensity": float, "scan": np.int64, "rt": float, "ms_order": np.int64,
+               "startindex": np.int64, "endindex": np.int64}
+    raggednames = ["isodist", "massdist", "matchedcentroids", "matchedisodist", "matchedindexes", "isomatches",
+                   "centroids"]
+    defaultragged = ["isodist", "massdist", "matchedcentroids", "matchedisodist", "matchedindexes", "isomatches"]
+
+    def __init__(self):
+        self.data = {}
+        self.matchedion = np.array([], dtype=str)
+        self.ragged = {}
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    @classmethod
+    def from_peaks(cls, peaks, ragged=None):
+        """
+        Create a table from MatchedPeak objects.
+        :param peaks: List of MatchedPeak objects
+        :param ragged: Names of the array attributes to keep. Default is PeakTable.defaultragged. The full centroids
+            around each peak are only kept if "centroids" is included.
+        :return: PeakTable object
+        """
+        if ragged is None:
+            ragged = cls.defaultragged
+        table = cls()
+        table.length = len(peaks)
+        for name, dtype in cls.columns.items():
+            values = [getattr(p, name) for p in peaks]
+            if name == "matchedintensity":
+                values = [np.nan if v is None else v for v in values]
+            table.data[name] = np.array(values, dtype=dtype).reshape(len(peaks))
+        table.matchedion = np.array(["" if p.matchedion is None else str(p.matchedion) for p in peaks], dtype=str)
+        for name in ragged:
+            arrays = [getattr(p, name) for p in peaks]
+            table.ragged[name] = cls.pack(arrays)
+        return table
+
+    @staticmethod
+    def pack(arrays):
+        """
+        Flatten a list of arrays that can have different lengths.
+        :param arrays: List of arrays or None
+        :return: Dictionary with the flat data, pointers, and a mask of which entries are not None
+        """
+        mask = np.array([a is not None for a in arrays], dtype=bool)
+        arrays = [np.asarray(a) for a in arrays if a is not None]
+        lengths = np.zeros(len(mask), dtype=np.int64)
+        lengths[mask] = [len(a) for a in arrays]
+        ptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        if len(arrays) > 0:
+            data = np.concatenate(arrays)
+        else:
+            data = np.zeros(0)
+        return {"data": data, "ptr": ptr, "mask": mask}
+
+    def get_ragged(self, name, i):
+        """
+        Get one ragged array entry.
+        :param name: Name of the ragged array
+        :param i: Peak index
+        :return: Array for peak i, or None
+        """
+        r = self.ragged[name]
+        if not r["mask"][i]:
+            return None
+        return r["data"][r["ptr"][i]:r["ptr"][i + 1]]
+
+    def to_peaks(self, colormap=None):
+        """
+        Create MatchedPeak objects from the table.
+        :param colormap: Colormap for the peak colors, as in MatchedCollection.add_peak. Default is tab10.
+        :return: List of MatchedPeak objects
+        """
+        if colormap is None:
+            colormap = mpl.colormaps.get_cmap("tab10")
+        colors = [colormap(i) for i in range(10)]
+        values = {name: self.data[name].tolist() for name in self.columns}
+        matchedion = self.matchedion.tolist()
+        ragged = {}
+        for name, r in self.ragged.items():
+            data = r["data"]
+            ptr = r["ptr"].tolist()
+            ragged[name] = [data[ptr[i]:ptr[i + 1]] if m else None for i, m in enumerate(r["mask"].tolist())]
+        peaks = []
+        for i in range(self.length):
+            p = MatchedPeak(values["z"][i], values["mz"][i])
+            for name in self.columns:
+                setattr(p, name, values[name][i])
+            if p.matchedintensity != p.matchedintensity:
+                p.matchedintensity = None
+            p.matchedion = matchedion[i]
+            for name in ragged:
+                setattr(p, name, ragged[name][i])
+            p.color = colors[i % 10]
+            peaks.append(p)
+        return peaks
+
+    def save(self, filename):
+        """
+        Save the table to an uncompressed .npz file.
+        :param filename: Output file name
+        :return: None
+        """
+        arrays = {name: self.data[name] for name in self.columns}
+        arrays["matchedion"] = self.matchedion
+        for name, r in self.ragged.items():
+            for k in ["data", "ptr", "mask"]:
+                arrays[name + "_" + k] = r[k]
+        arrays["meta"] = np.array([self.version, self.length], dtype=np.int64)
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a table saved with PeakTable.save.
+        :param filename: .npz file name
+        :return: PeakTable object
+        """
+        table = cls()
+        with np.load(filename, allow_pickle=False) as npz:
+            files = set(npz.files)
+            table.length = int(npz["meta"][1])
+            for name in cls.columns:
+                table.data[name] = npz[name]
+            table.matchedion = npz["matchedion"]
+            for name in cls.raggednames:
+                if name + "_ptr" in files:
+                    table.ragged[name] = {k: npz[name + "_" + k] for k in ["data", "ptr", "mask"]}
+        return table
+
+    def to_df(self, columns=None):
+        """
+        Convert the table to a pandas DataFrame without copying the columns.
+        :param columns: Dictionary of {table column: DataFrame column}. Default is all scalar columns by name.
+        :return: Pandas DataFrame
+        """
+        if columns is None:
+            columns = {name: name for name in self.columns}
+        data = {v: (self.matchedion if k == "matchedion" else self.data[k]) for k, v in columns.items()}
+        return pd.DataFrame(data, copy=False)
+
+    def to_arrow(self):
+        """
+        Convert the table to a pyarrow Table. Numeric columns are not copied.
+        Ragged arrays are included as list columns of their flattened values.
+        :return: pyarrow Table
+        """
+        import pyarrow as pa
+        arrays = {name: pa.array(self.data[name]) for name in self.columns}
+        arrays["matchedion"] = pa.array(self.matchedion.tolist(), type=pa.string())
+        for name, r in self.ragged.items():
+            flat = r["data"]
+            if flat.ndim > 1:
+                flat = pa.FixedSizeListArray.from_arrays(pa.array(flat.ravel()), flat.shape[1])
+            else:
+                flat = pa.array(flat)
+            arrays[name] = pa.LargeListArray.from_arrays(pa.array(r["ptr"]), flat,
+                                                         mask=pa.array(~r["mask"]))
+        return pa.table(arrays)
+
 
 def df_to_matchedcollection(df, monoiso="Monoisotopic Mass", peakmz="Most Abundant m/z", peakmass="Most Abundant Mass",
                             scan="Scan", z="Charge", intensity="Abundance", ion="Ion"):
@@ -108,6 +108,11 @@ class PhaseModel:
         self.dims = [50, 8]
         self.class_weights = None
 
+        # Reused input buffers for predict_batch
+        self.inference_batch_size = 4096
+        self.inputbuffer = None
+        self.devicebuffer = None
+
         self.modelid = 0
         # self.get_model(self.modelid)
 
@@ -213,7 +218,7 @@ class PhaseModel:
         """
         if os.path.isfile(self.savepath):
             try:
-                self.model.load_state_dict(torch.load(self.savepath, weights_only=True))
+                self.model.load_state_dict(torch.load(self.savepath, weights_only=True, map_location=self.device))
                 print("Model loaded:", self.savepath)
                 # print_model(self.model)
             except Exception as e:
@@ -354,6 +359,41 @@ class PhaseModel:
         output = output.cpu().numpy()
         return output
 
+    def predict_batch(self, emats, batchsize=None):
+        """
+        Predict charge states for a list of encoded peaks without a DataLoader.
+        The data are copied into a float32 buffer that is kept between calls and run through the model in batches.
+        :param emats: List or array of encoded data, each of size dims[0] x dims[1]
+        :param batchsize: Maximum number of peaks per model call. Default is self.inference_batch_size.
+        :return: Output charge state predictions
+        """
+        n = len(emats)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        if self.model is None:
+            self.setup_model()
+        if batchsize is None:
+            batchsize = self.inference_batch_size
+        shape = (batchsize,) + np.shape(emats[0])
+        if self.inputbuffer is None or self.inputbuffer.shape != shape:
+            self.inputbuffer = np.empty(shape, dtype=np.float32)
+            if self.device is not None and self.device != "cpu":
+                self.devicebuffer = torch.empty(shape, dtype=torch.float32, device=self.device)
+            else:
+                self.devicebuffer = None
+
+        self.model.eval()
+        output = np.zeros(n, dtype=np.int64)
+        with torch.inference_mode():
+            for start in range(0, n, batchsize):
+                end = min(n, start + batchsize)
+                self.inputbuffer[:end - start] = emats[start:end]
+                x = torch.from_numpy(self.inputbuffer[:end - start])
+                if self.devicebuffer is not None:
+                    x = self.devicebuffer[:end - start].copy_(x)
+                output[start:end] = self.model(x).argmax(dim=1).cpu().numpy()
+        return output
+
     def encode(self, centroids):
         """
         Encode the centroids into a format for the model.
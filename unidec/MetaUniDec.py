@@ -1323,7 +1323,8 @@ class UniDecApp(MetaUniDecBase):
         for p in paths:
             dirname = os.path.dirname(p)
             filename = os.path.basename(p)
-            self.eng.data.add_file(filename, dirname)
+            self.eng.data.add_file(filename, dirname, export=False)
+        self.eng.data.export_hdf5()
         self.view.ypanel.list.populate(self.eng.data)
         self.makeplot1()
 
@@ -8,6 +8,10 @@ import time
 import webbrowser
 import sys
 import re
+import queue
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 basic_parameters = [["Sample name", True, "The File Name or Path. File extensions are optional."],
                     ["Data Directory", False, "The directory of the data files. If you do not specify this, "
@@ -414,6 +418,84 @@ def remove_columns(df, key):
     return df
 
 
+def empty_row_result(i):
+    return {"index": i, "path": "", "newrow": None, "npeaks": 0, "htmlfile": "", "html_str": "", "pks": None,
+            "error": None}
+
+
+def failed_row_result(i, row, error):
+    result = empty_row_result(i)
+    try:
+        result["path"] = str(row["Sample name"])
+    except Exception:
+        pass
+    result["error"] = str(error) or repr(error)
+    return result
+
+
+# Each worker process keeps its own batch processor and engine between rows
+worker_batch = None
+worker_settings = None
+
+
+def init_batch_worker(settings, pids=None):
+    global worker_batch, worker_settings
+    if pids is not None:
+        # Send the process ID back so that the pool can be stopped if it gets stuck
+        pids.put(os.getpid())
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+    except Exception:
+        pass
+    worker_batch = UniDecBatchProcessor()
+    worker_batch.correct_pair_mode = settings["correct_pair_mode"]
+    worker_batch.dar_mode = settings["dar_mode"]
+    worker_settings = settings
+
+
+def read_batch_worker_pids(pids, timeout=0):
+    """
+    Read the process IDs that workers have sent from init_batch_worker.
+    :param pids: Queue of process IDs
+    :param timeout: Time in seconds to wait for each ID. 0 returns only the IDs already sent.
+    :return: List of process IDs
+    """
+    out = []
+    while True:
+        try:
+            if timeout > 0:
+                out.append(pids.get(timeout=timeout))
+            else:
+                out.append(pids.get_nowait())
+        except queue.Empty:
+            return out
+
+
+def stop_batch_workers(workers):
+    """
+    Terminate worker processes.
+    :param workers: List of process IDs
+    :return: None
+    """
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            # Already exited
+            pass
+
+
+def run_batch_worker(i, row):
+    try:
+        return worker_batch.run_row(i, row, decon=worker_settings["decon"],
+                                    use_converted=worker_settings["use_converted"],
+                                    interactive=worker_settings["interactive"],
+                                    duplicate_paths=worker_settings["duplicate_paths"])
+    except Exception as e:
+        return failed_row_result(i, row, e)
+
+
 class UniDecBatchProcessor(object):
     def __init__(self, parent=None):
         self.eng = UniDec()
@@ -438,6 +520,9 @@ class UniDecBatchProcessor(object):
         self.parent = parent
         self.runtime = -1
         self.pks = None
+        self.nworkers = 1  # Number of worker processes for run_df. 1 runs serially with self.eng.
+        self.timeout = None  # Per file time limit in seconds for parallel runs
+        self.failures = []
 
     def run_file(self, file=None, decon=True, use_converted=True, interactive=False):
         self.filename = file
@@ -447,7 +532,7 @@ class UniDecBatchProcessor(object):
         self.run_df(decon=decon, use_converted=use_converted, interactive=interactive)
 
     def run_df(self, df=None, decon=True, use_converted=True, interactive=False, write_html=True, write_xlsx=True,
-               write_peaks=True):
+               write_peaks=True, nworkers=None, timeout=None):
         self.global_html_str = ""
         self.pks = peakstructure.Peaks()
         # Print the data directory and start the clock
@@ -474,131 +559,44 @@ class UniDecBatchProcessor(object):
         duplicate_paths = self.check_duplicate_filenames(use_converted=use_converted)
 
         total_n = len(self.rundf)
-        # Loop through the DataFrame
-        for i, row in self.rundf.iterrows():
-            if self.parent is not None:
-                self.parent.update_progress(i, total_n)
-
-            self.autopw = True
-            self.eng.reset_config()
-            path = self.get_file_path(row, use_converted=use_converted)
-
-            # Get the time range
-            self.time_range = get_time_range(row)
-
-            # If the file exists, open it
-            if os.path.exists(path):
-                print("Opening:", path)
-                if not use_converted:
-                    print("Refreshing")
-                self.eng.open_file(path, time_range=self.time_range, refresh=not use_converted, silent=True)
-
-                # If the config file is specified, load it
-                if "Config File" in row:
-                    try:
-                        self.eng.load_config(row["Config File"])
-                        print("Loaded Config File:", row["Config File"])
-                        # If a config file is loaded, it will not use the auto peak width
-                        self.autopw = False
-                    except Exception as e:
-                        print("Error loading config file", row["Config File"], e)
-
-                # Set the deconvolution parameters from the DataFrame
-                self.eng = set_param_from_row(self.eng, row, self.data_dir)
-
-                # Check whether to integrate or use peak height
-                self.integrate = False
-                if "Quant Mode" in row:
-                    if row["Quant Mode"] == "Integral":
-                        self.integrate = True
-                        print("Using Integral Mode")
-
-                # Run the deconvolution or import the prior deconvolution results
-                if decon:
-                    # If the Config m/z Peak FWHM is specified, do not use the auto peak width
-                    if "Config m/z Peak FWHM" in row:
-                        self.autopw = not check_for_floatable(row, "Config m/z Peak FWHM")
-                    print("Auto Peak Width", self.autopw)
-                    self.eng.autorun(auto_peak_width=self.autopw, silent=True)
-                else:
-                    try:
-                        self.eng.unidec_imports(efficiency=False)
-                        self.eng.pick_peaks()
-                    except FileNotFoundError:
-                        # If the Config m/z Peak FWHM is specified, do not use the auto peak width
-                        if "Config m/z Peak FWHM" in row:
-                            self.autopw = not check_for_floatable(row, "Config m/z Peak FWHM")
-                        print("Auto Peak Width", self.autopw)
-                        self.eng.autorun(auto_peak_width=self.autopw, silent=True)
-
-                # Integrate the peaks
-                if self.integrate:
-                    try:
-                        self.eng.autointegrate()
-                    except Exception as err:
-                        print("Error in integrating", err)
-                        self.integrate = False
-
-                npeaks.append(len(self.eng.pks.peaks))
-
-                results_string = None
-
-                # The First Recipe, correct pair mode
-                if self.correct_pair_mode:
-                    # Run correct pair mode
-                    newrow = self.run_correct_pair(row)
-
-                    # Merge the row back in the df
-                    self.rundf = set_row_merge(self.rundf, newrow, [i])
-
-                    # Add the results string
-                    if "BsAb Pairing Calculated (%)" in newrow.keys():
-                        results_string = "The BsAb Pairing Calculated is: " + str(newrow["BsAb Pairing Calculated (%)"])
-
-                if self.dar_mode:
-                    # Run DAR mode
-                    newrow = self.run_dar(row)
-
-                    # Merge the row back in the df
-                    self.rundf = set_row_merge(self.rundf, newrow, [i])
-                    try:
-                        results_string = "The Drug-to-Antibody Ratio (DAR) is: " + str(newrow["DAR"])
-                    except Exception:
-                        results_string = None
-
-                ##################
-                #
-                # Insert your own workflow here
-                #
-                ###############################
-
-                for c in row.keys():
-                    if "Notes" in c:
-                        notes_string = row[c]
-                        notes_string = "<strong>" + c + ": </strong>" + notes_string
-                        if results_string is None:
-                            results_string = notes_string
-                        else:
-                            results_string += "<br><br>" + notes_string
-
-                del_columns = ["LowValFWHM", "HighValFWHM"]
-                # Generate the HTML report
-                if path in duplicate_paths:
-                    findex = i
-                else:
-                    findex = None
-                outfile = self.eng.gen_html_report(open_in_browser=False, interactive=interactive, findex=findex,
-                                                   results_string=results_string, del_columns=del_columns)
-                htmlfiles.append(outfile)
-
-                # Add the HTML report to the global HTML string
-                self.global_html_str += self.eng.html_str
-                # Add the peaks to the global peaks
-                self.pks.merge_in_peaks(self.eng.pks, filename=path, filenumber=i)
-            else:
-                # When files are not found, print the error and add empty results
-                print("File not found:", path)
-                htmlfiles.append("")
+        if nworkers is None:
+            nworkers = self.nworkers
+        if timeout is None:
+            timeout = self.timeout
+        self.failures = []
+
+        if nworkers is not None and nworkers > 1 and total_n > 1:
+            # Run the rows in a process pool, each worker with its own engine
+            results = self.run_rows_parallel(decon, use_converted, interactive, duplicate_paths, nworkers, timeout)
+        else:
+            # Loop through the DataFrame
+            results = []
+            for i, row in self.rundf.iterrows():
+                if self.parent is not None:
+                    self.parent.update_progress(i, total_n)
+                try:
+                    result = self.run_row(i, row, decon=decon, use_converted=use_converted, interactive=interactive,
+                                          duplicate_paths=duplicate_paths)
+                except Exception as e:
+                    result = failed_row_result(i, row, e)
+                results.append(result)
+
+        # Merge the results back in the order of the DataFrame
+        for result in results:
+            i = result["index"]
+            if result["error"] is not None:
+                self.failures.append((i, result["path"], result["error"]))
+                print("Error processing row", i, result["path"], result["error"])
+            if result["newrow"] is not None:
+                # Merge the row back in the df
+                self.rundf = set_row_merge(self.rundf, result["newrow"], [i])
+            npeaks.append(result["npeaks"])
+            htmlfiles.append(result["htmlfile"])
+            # Add the HTML report to the global HTML string
+            self.global_html_str += result["html_str"]
+            # Add the peaks to the global peaks
+            if result["pks"] is not None:
+                self.pks.merge_in_peaks(result["pks"], filename=result["path"], filenumber=i)
 
         # Write the number of peaks IDed
         self.rundf["NumPeaks"] = npeaks
@@ -642,6 +640,216 @@ class UniDecBatchProcessor(object):
         print("Batch Run Time:", self.runtime)
         return self.rundf
 
+    def run_row(self, i, row, decon=True, use_converted=True, interactive=False, duplicate_paths=None):
+        """
+        Open, deconvolve, match, and write the report for a single row of the DataFrame.
+        :param i: Index of the row in the DataFrame
+        :param row: The row from the rundf
+        :param decon: Whether to run the deconvolution or import prior results
+        :param use_converted: Whether to use converted files
+        :param interactive: Whether to make interactive HTML plots
+        :param duplicate_paths: List of paths that appear more than once in the DataFrame
+        :return: Dictionary of results for the row, see empty_row_result
+        """
+        if duplicate_paths is None:
+            duplicate_paths = []
+        result = empty_row_result(i)
+        self.autopw = True
+        self.eng.reset_config()
+        path = self.get_file_path(row, use_converted=use_converted)
+        result["path"] = path
+
+        # Get the time range
+        self.time_range = get_time_range(row)
+
+        # If the file exists, open it
+        if os.path.exists(path):
+            print("Opening:", path)
+            if not use_converted:
+                print("Refreshing")
+            self.eng.open_file(path, time_range=self.time_range, refresh=not use_converted, silent=True)
+
+            # If the config file is specified, load it
+            if "Config File" in row:
+                try:
+                    self.eng.load_config(row["Config File"])
+                    print("Loaded Config File:", row["Config File"])
+                    # If a config file is loaded, it will not use the auto peak width
+                    self.autopw = False
+                except Exception as e:
+                    print("Error loading config file", row["Config File"], e)
+
+            # Set the deconvolution parameters from the DataFrame
+            self.eng = set_param_from_row(self.eng, row, self.data_dir)
+
+            # Check whether to integrate or use peak height
+            self.integrate = False
+            if "Quant Mode" in row:
+                if row["Quant Mode"] == "Integral":
+                    self.integrate = True
+                    print("Using Integral Mode")
+
+            # Run the deconvolution or import the prior deconvolution results
+            if decon:
+                # If the Config m/z Peak FWHM is specified, do not use the auto peak width
+                if "Config m/z Peak FWHM" in row:
+                    self.autopw = not check_for_floatable(row, "Config m/z Peak FWHM")
+                print("Auto Peak Width", self.autopw)
+                self.eng.autorun(auto_peak_width=self.autopw, silent=True)
+            else:
+                try:
+                    self.eng.unidec_imports(efficiency=False)
+                    self.eng.pick_peaks()
+                except FileNotFoundError:
+                    # If the Config m/z Peak FWHM is specified, do not use the auto peak width
+                    if "Config m/z Peak FWHM" in row:
+                        self.autopw = not check_for_floatable(row, "Config m/z Peak FWHM")
+                    print("Auto Peak Width", self.autopw)
+                    self.eng.autorun(auto_peak_width=self.autopw, silent=True)
+
+            # Integrate the peaks
+            if self.integrate:
+                try:
+                    self.eng.autointegrate()
+                except Exception as err:
+                    print("Error in integrating", err)
+                    self.integrate = False
+
+            result["npeaks"] = len(self.eng.pks.peaks)
+
+            results_string = None
+
+            # The First Recipe, correct pair mode
+            if self.correct_pair_mode:
+                # Run correct pair mode
+                newrow = self.run_correct_pair(row)
+                result["newrow"] = newrow
+
+                # Add the results string
+                if "BsAb Pairing Calculated (%)" in newrow.keys():
+                    results_string = "The BsAb Pairing Calculated is: " + str(newrow["BsAb Pairing Calculated (%)"])
+
+            if self.dar_mode:
+                # Run DAR mode
+                newrow = self.run_dar(row)
+                result["newrow"] = newrow
+                try:
+                    results_string = "The Drug-to-Antibody Ratio (DAR) is: " + str(newrow["DAR"])
+                except Exception:
+                    results_string = None
+
+            ##################
+            #
+            # Insert your own workflow here
+            #
+            ###############################
+
+            for c in row.keys():
+                if "Notes" in c:
+                    notes_string = row[c]
+                    notes_string = "<strong>" + c + ": </strong>" + notes_string
+                    if results_string is None:
+                        results_string = notes_string
+                    else:
+                        results_string += "<br><br>" + notes_string
+
+            del_columns = ["LowValFWHM", "HighValFWHM"]
+            # Generate the HTML report
+            if path in duplicate_paths:
+                findex = i
+            else:
+                findex = None
+            outfile = self.eng.gen_html_report(open_in_browser=False, interactive=interactive, findex=findex,
+                                               results_string=results_string, del_columns=del_columns)
+            result["htmlfile"] = outfile
+            result["html_str"] = self.eng.html_str
+            result["pks"] = self.eng.pks
+        else:
+            # When files are not found, print the error and add empty results
+            print("File not found:", path)
+        return result
+
+    def run_rows_parallel(self, decon=True, use_converted=True, interactive=False, duplicate_paths=None,
+                          nworkers=2, timeout=None):
+        """
+        Run all rows of the rundf in a process pool. Each worker process has its own UniDecBatchProcessor and engine.
+        Failed or timed out rows are returned as empty results with the error recorded, so the rest of the batch runs.
+        :param decon: Whether to run the deconvolution or import prior results
+        :param use_converted: Whether to use converted files
+        :param interactive: Whether to make interactive HTML plots
+        :param duplicate_paths: List of paths that appear more than once in the DataFrame
+        :param nworkers: Number of worker processes
+        :param timeout: Maximum time in seconds for each file. None for no limit.
+        :return: List of row results in the order of the DataFrame
+        """
+        total_n = len(self.rundf)
+        nworkers = int(min(nworkers, total_n))
+        print("Running batch with", nworkers, "workers")
+        settings = {"correct_pair_mode": self.correct_pair_mode, "dar_mode": self.dar_mode, "decon": decon,
+                    "use_converted": use_converted, "interactive": interactive, "duplicate_paths": duplicate_paths}
+
+        rows = list(self.rundf.iterrows())
+        results = [None] * len(rows)
+        todo = list(range(len(rows)))
+        ndone = 0
+        while len(todo) > 0:
+            # Spawn rather than fork, so the workers do not inherit threads from Numba or OpenMP in this process
+            context = multiprocessing.get_context("spawn")
+            pids = context.Queue()
+            executor = ProcessPoolExecutor(max_workers=nworkers, mp_context=context, initializer=init_batch_worker,
+                                           initargs=(settings, pids))
+            futures = {}
+            for n in todo:
+                i, row = rows[n]
+                futures[executor.submit(run_batch_worker, i, row)] = n
+
+            workers = []
+            starts = {}
+            timedout = set()
+            pending = set(futures.keys())
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for f in done:
+                    n = futures[f]
+                    i, row = rows[n]
+                    try:
+                        results[n] = f.result()
+                    except Exception as e:
+                        results[n] = failed_row_result(i, row, e)
+                    ndone += 1
+                    if self.parent is not None:
+                        self.parent.update_progress(ndone, total_n)
+
+                if timeout is not None:
+                    # Start timing once all workers are running, because spawning them can take several seconds
+                    workers += read_batch_worker_pids(pids)
+                    if len(workers) < min(nworkers, len(futures)):
+                        continue
+                    now = time.perf_counter()
+                    # Futures show as running once queued for a worker, so only the first nworkers are executing
+                    executing = [f for f in futures if f.running()][:nworkers]
+                    for f in executing:
+                        if f in pending:
+                            start = starts.setdefault(f, now)
+                            if now - start > timeout:
+                                n = futures[f]
+                                i, row = rows[n]
+                                results[n] = failed_row_result(i, row, "Timed out after " + str(timeout) + " s")
+                                pending.discard(f)
+                                timedout.add(f)
+                                ndone += 1
+
+                    # Workers cannot be stopped individually. If all are stuck on timed out files, restart the pool.
+                    if len([f for f in timedout if not f.done()]) >= nworkers:
+                        break
+
+            todo = [futures[f] for f in pending]
+            if any(f.running() for f in futures):
+                stop_batch_workers(workers + read_batch_worker_pids(pids, timeout=1))
+            executor.shutdown(wait=True, cancel_futures=True)
+            pids.close()
+        return results
+
     def write_peaks(self, outfile=None):
         # Write the peaks to a file
         if outfile is None:
@@ -8,7 +8,8 @@ from copy import deepcopy
 import zipfile
 import fnmatch
 import numpy as np
-from unidec.modules import unidecstructure, peakstructure, MassFitter
+from unidec.modules import unidecstructure, peakstructure, MassFitter, unidec_core
+from unidec.modules.decon_cache import DeconCache
 import unidec.tools as ud
 import unidec.modules.IM_functions as IM_func
 import unidec.modules.MassSpecBuilder as MSBuild
@@ -19,6 +20,18 @@ from unidec.modules.unidec_enginebase import UniDecEngine
 __author__ = 'Michael.Marty'
 
 
+def safedivide_array(a, b):
+    """
+    Element-wise version of ud.safedivide1. Returns 0 where b is 0.
+    :param a: Numerator array
+    :param b: Denominator array
+    :return: a / b with 0 where b is 0
+    """
+    out = np.zeros(np.shape(a), dtype=np.result_type(a, b))
+    np.divide(a, b, out=out, where=b != 0)
+    return out
+
+
 def score_minimum(height, minimum):
     x2 = height
     x1 = height / 2.
@@ -46,6 +59,7 @@ class UniDec(UniDecEngine):
         self.errorgrid = None
         self.infile = None
         self.outfile = None
+        self.decon_cache = None
         opts = None
         if "ignore_args" in kwargs:
             ignore_args = kwargs["ignore_args"]
@@ -139,8 +153,17 @@ class UniDec(UniDecEngine):
         self.config.extension = os.path.splitext(self.config.filename)[1]
         self.config.default_file_names()
 
-        # Import Data
-        self.data.rawdata = ud.load_mz_file(self.config.filename, self.config, time_range, imflag=self.config.imflag)
+        # Import Data, using the binary cache of the raw data if the source file has not changed
+        rawname = self.config.outfname + "_rawdata.txt"
+        rawkey = ud.get_file_stamp(file_path) + "_" + str(time_range) + "_" + str(self.config.imflag)
+        self.data.rawdata = None
+        if not refresh:
+            self.data.rawdata = ud.load_cache(rawname, rawkey)
+        if self.data.rawdata is None:
+            self.data.rawdata = ud.load_mz_file(self.config.filename, self.config, time_range,
+                                                imflag=self.config.imflag)
+            if not ud.isempty(self.data.rawdata):
+                ud.save_cache(rawname, self.data.rawdata, rawkey)
 
         if ud.isempty(self.data.rawdata):
             print("Error: Data Array is Empty")
@@ -156,21 +179,8 @@ class UniDec(UniDecEngine):
         else:
             self.config.imflag = 0
 
-        if self.config.imflag == 0:
-            newname = self.config.outfname + "_rawdata.txt"
-            outputdata = self.data.rawdata
-        else:
-            newname = self.config.outfname + "_imraw.txt"
-            outputdata = ud.sparse(self.data.rawdata3)
-        if not os.path.isfile(newname):
-            try:
-                # shutil.copy(file_directory, newname)
-                np.savetxt(newname, outputdata)
-            except Exception as e:
-                pass
-
-        if os.path.isfile(self.config.infname) and not refresh and self.config.imflag == 0:
-            self.data.data2 = np.loadtxt(self.config.infname)
+        if ud.cached_file_exists(self.config.infname) and not refresh and self.config.imflag == 0:
+            self.data.data2 = ud.load_txt_cached(self.config.infname)
             self.config.procflag = 1
         else:
             self.data.data2 = self.data.rawdata
@@ -192,6 +202,23 @@ class UniDec(UniDecEngine):
         if "silent" not in kwargs or not kwargs["silent"]:
             print("Loading Time: %.2gs" % (tend - tstart))
 
+    def export_text(self):
+        """
+        Write the raw, processed, and mass data as text files in the _unidecfiles folder.
+        These are otherwise kept only in the binary caches unless the external UniDec binary needs them.
+
+        _rawdata.txt or _imraw.txt for the raw data, _input.dat for the processed data, and _mass.txt for the mass data.
+        :return: None
+        """
+        if self.config.imflag == 0:
+            ud.savetxt(self.config.outfname + "_rawdata.txt", self.data.rawdata)
+            if not ud.isempty(self.data.data2):
+                ud.dataexport_cached(self.data.data2, self.config.infname)
+        else:
+            ud.savetxt(self.config.outfname + "_imraw.txt", ud.sparse(self.data.rawdata3))
+        if not ud.isempty(self.data.massdat):
+            ud.dataexport_cached(self.data.massdat, self.config.massdatfile)
+
     def raw_process(self, dirname, inflag=False, binsize=1):
         """
         Processes Water's Raw files into .txt using external calls to:
@@ -316,7 +343,8 @@ class UniDec(UniDecEngine):
                         np.random.normal(0, 100 * np.amax(self.data.data2[:, 1]), len(self.data.data2)))
                     self.data.data2[:, 1] /= np.amax(self.data.data2[:, 1])
                     print("Added noise to data")
-            ud.dataexport(self.data.data2, self.config.infname)
+            # The external binary reads the text file. The in-process core only needs the binary cache.
+            ud.dataexport_cached(self.data.data2, self.config.infname, text=self.config.coreflag != 1)
         else:
             tstart2 = time.perf_counter()
             mz, dt, i3 = IM_func.process_data_2d(self.data.rawdata3[:, 0], self.data.rawdata3[:, 1],
@@ -345,6 +373,9 @@ class UniDec(UniDecEngine):
             self.config.UniDecPath for MS
             self.config.UniDecIMPath for IM-MS
 
+        If self.config.coreflag is 1 and the settings are supported by modules.unidec_core, the deconvolution is
+        run in process on self.data.data2 instead and the results are loaded with self.core_imports().
+
         If successful, calls self.unidec_imports()
         If not, prints the error code.
         :param silent: If True, it will suppress printing the output from unidec
@@ -370,6 +401,37 @@ class UniDec(UniDecEngine):
         self.export_config()
         tstart = time.perf_counter()
 
+        cachekey = None
+        if self.config.cacheflag == 1 and self.config.imflag == 0:
+            cache = self.get_decon_cache()
+            cachekey = cache.make_key(self.data.data2, self.config)
+            result = cache.get(cachekey)
+            if result is not None:
+                self.config.runtime = (time.perf_counter() - tstart)
+                if not silent:
+                    print("Loaded cached deconvolution %.2gs" % self.config.runtime)
+                self.core_imports(result, efficiency)
+                if not silent:
+                    print("File Name: ", self.config.filename, "R Squared: ", self.config.error)
+                return 0
+
+        if self.config.coreflag == 1 and unidec_core.core_supported(self.config):
+            result = unidec_core.run_core(self.data.data2, self.config, silent=silent)
+            self.config.runtime = (time.perf_counter() - tstart)
+            if not silent:
+                print("unidec core run %.2gs" % self.config.runtime)
+            self.core_imports(result, efficiency)
+            if not silent:
+                print("File Name: ", self.config.filename, "R Squared: ", self.config.error)
+            if cachekey is not None:
+                self.decon_cache.put(cachekey, result)
+            return 0
+        elif self.config.coreflag == 1 and not silent:
+            print("Settings not supported by in-process core. Using binary.")
+
+        if self.config.imflag == 0:
+            # process_data skips the text input for the in-process core
+            ud.export_txt_from_cache(self.config.infname)
         out = ud.unidec_call(self.config, silent=silent)
 
         tend = time.perf_counter()
@@ -381,11 +443,43 @@ class UniDec(UniDecEngine):
             self.unidec_imports(efficiency)
             if not silent:
                 print("File Name: ", self.config.filename, "R Squared: ", self.config.error)
+            if cachekey is not None and not efficiency and self.config.aggressiveflag == 0:
+                self.cache_results(cachekey)
             return out
         else:
             print("unidec Run Error:", out)
             return out
 
+    def get_decon_cache(self):
+        """
+        Get the deconvolution result cache, creating it if needed and updating its size from self.config.cachesize.
+        :return: DeconCache object
+        """
+        if self.decon_cache is None:
+            self.decon_cache = DeconCache(maxsize=self.config.cachesize)
+        self.decon_cache.maxsize = self.config.cachesize
+        return self.decon_cache
+
+    def cache_results(self, key):
+        """
+        Save the results imported from the UniDec binary to the deconvolution cache.
+        Stored in the same format as the dictionary from unidec_core.run_core so that core_imports can load it.
+        :param key: Cache key from DeconCache.make_key
+        :return: None
+        """
+        try:
+            mean = np.mean(self.data.data2[:, 1])
+            sse = (1 - self.config.error) * np.sum((self.data.data2[:, 1] - mean) ** 2)
+            try:
+                iterations = int(np.genfromtxt(self.config.errorfile, dtype='str')[2, 2])
+            except Exception:
+                iterations = 0
+            result = {"massdat": self.data.massdat, "massgrid": self.data.massgrid, "fitdat": self.data.fitdat,
+                      "mzgrid": self.data.mzgrid[:, 2], "error": sse, "iterations": iterations}
+            self.get_decon_cache().put(key, result)
+        except Exception as e:
+            print("Could not cache results:", e)
+
     def unidec_imports(self, efficiency=False, everything=False):
         """
         Imports files output from the unidec core executable into self.data.
@@ -394,11 +488,11 @@ class UniDec(UniDecEngine):
         :return: None
         """
         if everything:
-            self.data.data2 = np.loadtxt(self.config.infname)
+            self.data.data2 = ud.load_txt_cached(self.config.infname)
 
         # Import Results
         self.pks = peakstructure.Peaks()
-        self.data.massdat = np.loadtxt(self.config.massdatfile)
+        self.data.massdat = ud.load_txt_cached(self.config.massdatfile)
 
         self.data.ztab = np.arange(self.config.startz, self.config.endz + 1)
 
@@ -485,6 +579,39 @@ class UniDec(UniDecEngine):
                 xv = np.c_[np.ravel(yv), np.ravel(xv)]
                 self.data.mzgrid = np.c_[xv, np.ravel(self.data.mzgrid)]
 
+    def core_imports(self, result, efficiency=False):
+        """
+        Imports the results of the in-process core from modules.unidec_core.run_core into self.data.
+        Matches the outputs of self.unidec_imports() for MS data.
+        :param result: Dictionary returned by unidec_core.run_core
+        :param efficiency: If True, it will ignore the larger grids to speed up the run.
+        :return: None
+        """
+        self.pks = peakstructure.Peaks()
+        self.data.massdat = result["massdat"]
+        self.data.ztab = np.arange(self.config.startz, self.config.endz + 1)
+        self.config.massdatnormtop = np.amax(self.data.massdat[:, 1])
+        self.data.baseline = np.array([])
+
+        mean = np.mean(self.data.data2[:, 1])
+        self.config.error = 1 - result["error"] / np.sum((self.data.data2[:, 1] - mean) ** 2)
+        # Keep the results on disk so unidec_imports can reload them. The mass data is also written as text because
+        # DataCollector, kernel files, and the external binary read _mass.txt.
+        ud.dataexport_cached(self.data.massdat, self.config.massdatfile)
+        with open(self.config.errorfile, "w") as f:
+            f.write("error = %f\n" % result["error"])
+            f.write("time = %f\n" % self.config.runtime)
+            f.write("iterations = %d\n" % result["iterations"])
+        if not efficiency:
+            self.data.massgrid = result["massgrid"]
+            self.data.fitdat = result["fitdat"]
+            ud.dataexportbin(self.data.massgrid, self.config.massgridfile)
+            ud.dataexportbin(self.data.fitdat, self.config.fitdatfile)
+            ud.dataexportbin(result["mzgrid"], self.config.mzgridfile)
+            xv, yv = np.meshgrid(self.data.ztab, self.data.data2[:, 0])
+            xv = np.c_[np.ravel(yv), np.ravel(xv)]
+            self.data.mzgrid = np.c_[xv, result["mzgrid"]]
+
     def pick_peaks(self, calc_dscore=True):
         """
         Detect, Normalize, and Output Peaks
@@ -567,6 +694,7 @@ class UniDec(UniDecEngine):
             convdata = ud.makeconvspecies(self.data.data2, self.pks, self.config)
         else:
             # TODO: There's no reason this shouldn't work for CD-MS data, but we'd need to include a write to _grid.bin
+            ud.export_txt_from_cache(self.config.infname)
             ud.unidec_call(self.config, conv=True)
 
             convdata = np.fromfile(self.config.outfname + "_conv.bin", dtype=self.config.dtype)
@@ -905,6 +1033,8 @@ class UniDec(UniDecEngine):
             return None
 
     def save_state(self, file_name):
+        # The saved state is read back from text files, so make sure they are written
+        self.export_text()
         ud.zip_folder(file_name, directory=self.config.udir)
 
     def load_state(self, load_path):
@@ -969,9 +1099,9 @@ class UniDec(UniDecEngine):
         self.open_file(filename2, self.config.dirname)
 
         # Import Processed Data
-        if os.path.isfile(self.config.infname):
+        if ud.cached_file_exists(self.config.infname):
             if self.config.imflag == 0:
-                self.data.data2 = np.loadtxt(self.config.infname)
+                self.data.data2 = ud.load_txt_cached(self.config.infname)
             else:
                 self.data.data3 = np.loadtxt(self.config.infname)
                 i3 = self.data.data3[:, 2].reshape(
@@ -1042,33 +1172,34 @@ class UniDec(UniDecEngine):
         #        p.fitarea /= fnorm
         #        p.fitareaerr /= fnorm
 
+    def get_peak_windows(self, xfwhm=2):
+        """
+        Get the mass window around each peak used for scoring.
+        The window is the FWHM interval scaled by xfwhm, or massbins * xfwhm if a side of the interval is missing.
+        :param xfwhm: Scaling of the FWHM interval
+        :return: Array of [lower, upper] masses for each peak in self.pks.peaks
+        """
+        masses = np.array([p.mass for p in self.pks.peaks])
+        interval = np.abs(np.array([p.intervalFWHM for p in self.pks.peaks]) - masses[:, None]) * xfwhm
+        interval[interval == 0] = self.config.massbins * xfwhm
+        return np.transpose([masses - interval[:, 0], masses + interval[:, 1]])
+
     def get_zstack(self, xfwhm=1):
         zarr = np.reshape(self.data.massgrid, (len(self.data.massdat), len(self.data.ztab)))
         # zarr = zarr / np.amax(np.sum(zarr, axis=1)) * np.amax(self.data.massdat[:, 1])
 
+        # Mass windows, exclusive of the bounds, from one search of the sorted mass axis
+        windows = self.get_peak_windows(xfwhm)
+        lows = np.searchsorted(self.data.massdat[:, 0], windows[:, 0], side="right")
+        highs = np.searchsorted(self.data.massdat[:, 0], windows[:, 1], side="left")
+        highs = np.maximum(lows, highs)
+
+        dtype = np.result_type(self.data.massdat, zarr)
         for i, p in enumerate(self.pks.peaks):
-            # fwhm = p.errorFWHM
-            # if fwhm == 0:
-            #    fwhm = self.config.massbins
-            # width = fwhm / 2. * xfwhm
-            # interval = [p.mass - width, p.mass + width]
-
-            interval = np.abs(np.array(p.intervalFWHM) - p.mass) * xfwhm
-            if interval[0] == 0:
-                interval[0] = self.config.massbins * xfwhm
-            if interval[1] == 0:
-                interval[1] = self.config.massbins * xfwhm
-            interval = np.array([p.mass - interval[0], p.mass + interval[1]])
-
-            boo1 = self.data.massdat[:, 0] < interval[1]
-            boo2 = self.data.massdat[:, 0] > interval[0]
-            boo3 = np.all([boo1, boo2], axis=0)
-            top = self.data.massdat[boo3]
-
-            stack = [top[:, 0]]
-            for j, z in enumerate(self.data.ztab):
-                stack.append(zarr[boo3, j])
-            p.zstack = np.array(stack)
+            lo, hi = lows[i], highs[i]
+            p.zstack = np.empty((len(self.data.ztab) + 1, hi - lo), dtype=dtype)
+            p.zstack[0] = self.data.massdat[lo:hi, 0]
+            p.zstack[1:] = zarr[lo:hi].T
 
     def pks_mscore(self, xfwhm=2, power=2):
         self.get_zstack(xfwhm=xfwhm)
@@ -1077,27 +1208,17 @@ class UniDec(UniDecEngine):
             ints = p.zstack[1:]  # mzgrid
             msum = np.sum(ints, axis=0)
             zsum = np.sum(ints, axis=1)
+            weights = deepcopy(zsum)
             msum /= np.amax(msum)
             zsum /= np.amax(zsum)
             p.mdist = np.transpose([m, msum])
-            # mmax = np.argmax(msum)
-            # sumz = np.sum(ints, axis=1)
-            # zsum = deepcopy(ints[:, mmax])
             p.zdist = np.transpose([self.data.ztab, zsum])
 
-            rats = []
-            weights = []
-            for i, z in enumerate(self.data.ztab):
-                Y = ints[i]  # mzgrid
-                sY = np.sum(Y)
-                X = msum * sY / np.sum(msum)  # summed decon
-                sX = np.sum(X)
-                sae = np.sum(np.abs(Y - X))
-                M = 1 - ud.safedivide1(sae, sX)
-                rats.append(M)
-                weights.append(sY)
-            rats = np.array(rats)
-            weights = np.array(weights)
+            # Compare each charge state to the summed decon scaled to the same total, all at once
+            X = np.outer(weights, msum) / np.sum(msum)  # summed decon
+            sX = np.sum(X, axis=1)
+            sae = np.sum(np.abs(ints - X), axis=1)
+            rats = 1 - safedivide_array(sae, sX)
             avg = ud.weighted_avg(rats, weights ** power)
             # print("Peak Mass:", p.mass, "Peak Shape Score", avg, p.mscore)
             p.mscore = avg
@@ -1111,104 +1232,95 @@ class UniDec(UniDecEngine):
 
         for p in self.pks.peaks:
             ints = p.zstack[1:]
-            msum = np.sum(ints, axis=0)
-            # mmax = np.argmax(msum)
             sumz = np.sum(ints, axis=1)
-            # sumz = deepcopy(ints[:, mmax]) # Switch to peak center only
             sumz /= np.amax(sumz)
-            # sumz = deepcopy(p.pca_zdist[:, 1])
-            # sumz -= np.amin(sumz)
             zm = np.argmax(sumz)
-
             zs = np.sum(sumz)
-            badarea = 0
-
-            index = zm
-            low = sumz[zm]
-            while index < len(sumz) - 1:
-                index += 1
-                val = sumz[index]
-                if val < low:
-                    low = val
-                else:
-                    badarea += val - low
-
-            index = zm
-            low = sumz[zm]
-            while index > 0:
-                index -= 1
-                val = sumz[index]
-                if val < low:
-                    low = val
-                else:
-                    badarea += val - low
+
+            # Area above the running minimum walking out from the max charge state in each direction
+            upper = sumz[zm + 1:]
+            lower = sumz[zm - 1::-1] if zm > 0 else sumz[:0]
+            upper = upper - np.minimum(np.minimum.accumulate(upper), sumz[zm])
+            lower = lower - np.minimum(np.minimum.accumulate(lower), sumz[zm])
+            # Running sum to add up the area in the same order as walking out
+            badarea = np.cumsum(np.concatenate([[0], upper, lower]).astype(sumz.dtype))[-1]
 
             p.cs_score = 1 - ud.safedivide1(badarea, zs)
             # print(badarea, zs, p.cs_score)
 
+    def get_mz_windows(self, xfwhm=2):
+        """
+        Get the index ranges in self.data.data2 for each peak window at each charge state.
+        :param xfwhm: Scaling of the FWHM interval
+        :return: lows, highs. Arrays of shape (number of peaks, number of charge states).
+        """
+        windows = self.get_peak_windows(xfwhm)
+        adducts = self.data.ztab * self.config.adductmass
+        lower = (windows[:, 0, None] + adducts) / self.data.ztab
+        upper = (windows[:, 1, None] + adducts) / self.data.ztab
+        lows = np.searchsorted(self.data.data2[:, 0], lower, side="left")
+        highs = np.searchsorted(self.data.data2[:, 0], upper, side="right")
+        return lows, np.maximum(lows, highs)
+
     def get_mzstack(self, xfwhm=2):
         zarr = np.reshape(self.data.mzgrid[:, 2], (len(self.data.data2), len(self.data.ztab)))
         # zarr = zarr / np.amax(np.sum(zarr, axis=1)) * np.amax(self.data.data2[:, 1])
+        lows, highs = self.get_mz_windows(xfwhm=xfwhm)
         for i, p in enumerate(self.pks.peaks):
-            # fwhm = p.errorFWHM
-            # if fwhm == 0:
-            #    fwhm = self.config.massbins
-            # width = fwhm / 2. * xfwhm
-            # interval = np.array([p.mass - width, p.mass + width])
-
-            interval = np.abs(np.array(p.intervalFWHM) - p.mass) * xfwhm
-            if interval[0] == 0:
-                interval[0] = self.config.massbins * xfwhm
-            if interval[1] == 0:
-                interval[1] = self.config.massbins * xfwhm
-            interval = np.array([p.mass - interval[0], p.mass + interval[1]])
-
             stack = []
-            bvals = []
             for j, z in enumerate(self.data.ztab):
-                interval2 = (interval + z * self.config.adductmass) / z
-                boo1 = self.data.data2[:, 0] <= interval2[1]
-                boo2 = self.data.data2[:, 0] >= interval2[0]
-                boo3 = np.all([boo1, boo2], axis=0)
-                top = self.data.data2[boo3]
-                stack.append(np.transpose([top[:, 0], top[:, 1], zarr[boo3, j]]))
-                bvals.append(boo3)
-            btot = np.any(bvals, axis=0)
-            fit = self.data.fitdat[btot]
-            top = self.data.data2[btot]
-            sse = np.sum((fit - top[:, 1]) ** 2)
-            denom = np.sum((top[:, 1] - np.mean(top[:, 1])) ** 2)
-            p.rsquared = 1 - ud.safedivide1(sse, denom)
+                lo, hi = lows[i, j], highs[i, j]
+                stack.append(np.transpose([self.data.data2[lo:hi, 0], self.data.data2[lo:hi, 1], zarr[lo:hi, j]]))
+            p.rsquared = self.window_rsquared(lows[i], highs[i])
             p.mzstack = np.array(stack, dtype='object')
+        return lows, highs
+
+    def window_rsquared(self, lows, highs):
+        """
+        Calculate the R squared of the fit over the union of several index ranges in self.data.data2.
+        :param lows: Start indexes of the ranges
+        :param highs: End indexes of the ranges (exclusive)
+        :return: R squared
+        """
+        start = np.amin(lows)
+        end = max(np.amax(highs), start)
+        # Count how many ranges cover each point to get the union
+        cover = np.zeros(end - start + 1, dtype=int)
+        np.add.at(cover, lows - start, 1)
+        np.add.at(cover, highs - start, -1)
+        btot = np.cumsum(cover[:-1]) > 0
+        fit = self.data.fitdat[start:end][btot]
+        top = self.data.data2[start:end][btot]
+        sse = np.sum((fit - top[:, 1]) ** 2)
+        denom = np.sum((top[:, 1] - np.mean(top[:, 1])) ** 2)
+        return 1 - ud.safedivide1(sse, denom)
 
     def pks_uscore(self, xfwhm=2, power=1):
-        self.get_mzstack(xfwhm=xfwhm)
-        for p in self.pks.peaks:
-            rats = []
-            weights = []
-            for i, zval in enumerate(self.data.ztab):
-                v = p.mzstack[i]
-                X = v[:, 1]  # spectrum
-                Y = v[:, 2]  # mzgrid
-                if self.config.orbimode == 1:
-                    Y = Y * zval
-                sx = np.sum(X)
-                sy = np.sum(Y)
-                # r = 1 - ud.safedivide1(np.abs(sy - sz), sy)
-                sae = np.sum(np.abs(X - Y))  # ** 2)
-                U = 1 - ud.safedivide1(sae, sx)
-                rats.append(U)
-                weights.append(sy)
-                # try:
-                #    print(sse, r, sz, sy, z[0], z[-1])
-                # except:
-                # //    print(z)
-            rats = np.array(rats)
-
-            weights = np.array(weights)
-            avg = ud.weighted_avg(rats, weights ** power)
+        lows, highs = self.get_mzstack(xfwhm=xfwhm)
+        zarr = np.reshape(self.data.mzgrid[:, 2], (len(self.data.data2), len(self.data.ztab)))
+        npeaks, nz = lows.shape
+
+        # Gather every peak and charge state window into one flat array with a segment number for each point
+        lows = np.ravel(lows)
+        lens = np.ravel(highs) - lows
+        segments = np.repeat(np.arange(len(lows)), lens)
+        offsets = np.cumsum(lens) - lens
+        index = np.arange(len(segments)) - np.repeat(offsets - lows, lens)
+        zindex = segments % nz
+
+        X = self.data.data2[index, 1]  # spectrum
+        Y = zarr[index, zindex]  # mzgrid
+        if self.config.orbimode == 1:
+            Y = Y * self.data.ztab[zindex]
+        sx = np.bincount(segments, weights=X, minlength=len(lows))
+        sy = np.bincount(segments, weights=Y, minlength=len(lows))
+        sae = np.bincount(segments, weights=np.abs(X - Y), minlength=len(lows))
+
+        rats = np.reshape(1 - safedivide_array(sae, sx), (npeaks, nz))
+        weights = np.reshape(sy, (npeaks, nz)) ** power
+        for i, p in enumerate(self.pks.peaks):
+            p.uscore = ud.weighted_avg(rats[i], weights[i])
             # print("Peak Mass:", p.mass, "Uniqueness Score", avg)
-            p.uscore = avg
 
     def pks_fscore(self):
         for p in self.pks.peaks:
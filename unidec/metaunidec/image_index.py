@@ -0,0 +1,117 @@
+"""
+Indexes of imaging grids for fast extraction of images and region spectra (ImagingWindow).
+
+Band sums use prefix sums along the mass or m/z axis, so the image for any band is the difference of two rows.
+Band maxima use the maximum of each block of columns, so only the partial blocks at the ends of the band are read.
+Region sums use the summed spectra of square tiles of pixels, so only the pixels in tiles at the edge of the region
+are added one at a time.
+
+The prefix sums are float64 and have one more row than the grid, so an index needs about as much memory again as a
+float64 grid, or twice as much as a float32 grid. They stay in float64 because a band image is the difference of two
+large running sums, which would lose the small values in single precision.
+"""
+import numpy as np
+import unidec.tools as ud
+
+__author__ = 'Michael.Marty'
+
+
+def get_band(erange):
+    """
+    Midpoint and half width of a band, as ImagingWindow.extract uses them.
+    :param erange: [low, high] of the band
+    :return: midpoint, window
+    """
+    midpoint = np.mean(erange)
+    return midpoint, midpoint - erange[0]
+
+
+class ImageIndex(object):
+    def __init__(self, axis, grid, x, y, blocksize=32, tilesize=8, chunksize=256):
+        """
+        Build the band and region indexes for one grid. The prefix sums take (M + 1) x N float64 values.
+        :param axis: Mass or m/z axis (M)
+        :param grid: Intensity of each pixel on the axis (N x M), such as massgrid[:, :, 1]
+        :param x: x position of each pixel (N)
+        :param y: y position of each pixel (N)
+        :param blocksize: Number of columns in each block for band maxima
+        :param tilesize: Number of x and y positions in each tile for region sums
+        :param chunksize: Number of columns or pixels to copy at a time while building
+        :return: ImageIndex object
+        """
+        self.axis = np.asarray(axis)
+        self.grid = grid
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        n, m = grid.shape
+
+        # Prefix sums along the axis, stored with the axis first so that each band image is two contiguous rows
+        self.cumsum = np.empty((m + 1, n))
+        self.cumsum[0] = 0
+        for j0 in range(0, m, chunksize):
+            j1 = min(j0 + chunksize, m)
+            self.cumsum[j0 + 1:j1 + 1] = np.cumsum(np.transpose(grid[:, j0:j1]), axis=0) + self.cumsum[j0]
+
+        # Maximum of each full block of columns
+        self.blocksize = blocksize
+        self.blockmax = np.empty((m // blocksize, n), dtype=grid.dtype)
+        for b in range(len(self.blockmax)):
+            self.blockmax[b] = np.amax(grid[:, b * blocksize:(b + 1) * blocksize], axis=1)
+
+        # Tiles of pixels by rank of x and y, so any spacing of positions works
+        xrank = np.unique(self.x, return_inverse=True)[1].ravel() // tilesize
+        yrank = np.unique(self.y, return_inverse=True)[1].ravel() // tilesize
+        self.tiles = xrank * (np.amax(yrank) + 1 if n > 0 else 1) + yrank
+        ntiles = np.amax(self.tiles) + 1 if n > 0 else 0
+        self.tilecounts = np.bincount(self.tiles, minlength=ntiles)
+        self.tilesums = np.zeros((ntiles, m))
+        for i0 in range(0, n, chunksize):
+            ids = self.tiles[i0:i0 + chunksize]
+            order = np.argsort(ids, kind="stable")
+            uniq, starts = np.unique(ids[order], return_index=True)
+            self.tilesums[uniq] += np.add.reduceat(grid[i0:i0 + chunksize][order], starts, axis=0)
+
+    def extract(self, midpoint, window=0, extract_method=0):
+        """
+        Image of a band, the same as ud.extract_from_data_matrix on the grid.
+        :param midpoint: Middle of the band
+        :param window: Half width of the band
+        :param extract_method: 0 for the value nearest the midpoint, 1 for the maximum, 2 for the sum
+        :return: Value for each pixel
+        """
+        if extract_method == 0:
+            return self.grid[:, ud.nearest(self.axis, midpoint)]
+        start = ud.nearest(self.axis, midpoint - window)
+        end = ud.nearest(self.axis, midpoint + window)
+        if end <= start or extract_method not in [1, 2]:
+            return ud.extract_from_data_matrix(self.axis, self.grid, midpoint, extract_method=extract_method,
+                                              window=window)
+        if extract_method == 2:
+            return self.cumsum[end] - self.cumsum[start]
+
+        b0 = -(-start // self.blocksize)
+        b1 = end // self.blocksize
+        if b1 <= b0:
+            return np.amax(self.grid[:, start:end], axis=1)
+        data = np.amax(self.blockmax[b0:b1], axis=0)
+        if start < b0 * self.blocksize:
+            data = np.maximum(data, np.amax(self.grid[:, start:b0 * self.blocksize], axis=1))
+        if b1 * self.blocksize < end:
+            data = np.maximum(data, np.amax(self.grid[:, b1 * self.blocksize:end], axis=1))
+        return data
+
+    def region_sum(self, xrange, yrange):
+        """
+        Summed spectrum of the pixels in a rectangle, the same as summing the grid over the selected pixels.
+        :param xrange: [low, high] x, both included
+        :param yrange: [low, high] y, both included
+        :return: Summed intensity on the axis
+        """
+        ball = (self.x >= xrange[0]) * (self.x <= xrange[1]) * (self.y >= yrange[0]) * (self.y <= yrange[1])
+        selected = np.bincount(self.tiles[ball], minlength=len(self.tilecounts))
+        full = (selected == self.tilecounts) & (selected > 0)
+        partial = np.flatnonzero(ball & ~full[self.tiles])
+        data = np.sum(self.tilesums[full], axis=0)
+        if len(partial) > 0:
+            data += np.sum(self.grid[partial], axis=0)
+        return data
@@ -1,5 +1,6 @@
 import time
 import os
+import threading
 import numpy as np
 from pubsub import pub
 import wx
@@ -7,6 +8,7 @@ from scipy.spatial.distance import cosine
 from unidec.modules import PlottingWindow, unidecstructure
 import unidec.tools as ud
 from unidec.metaunidec import mudstruct
+from unidec.metaunidec.image_index import ImageIndex, get_band
 
 __author__ = 'Michael.Marty'
 
@@ -40,6 +42,10 @@ class ImagingWindow(wx.Frame):
         self.exchoice = 2
         self.mass_extracted = None
         self.mz_extracted = None
+        # Built in the background by build_index
+        self.indexes = {}
+        self.peakimages = {}
+        self.peakindex = -1
 
     def init(self, data, config=None):
         """
@@ -62,6 +68,9 @@ class ImagingWindow(wx.Frame):
         menu_analyze = analysismenu.Append(wx.ID_ANY, "Cosine Similarity Mass vs. m/z",
                                            "Print the Cosine Similarity of the Mass vs. m/z images")
         self.Bind(wx.EVT_MENU, self.on_cosine, menu_analyze)
+        menu_peak = analysismenu.Append(wx.ID_ANY, "Next Peak Image",
+                                        "Show the mass image of the next peak in the peak list")
+        self.Bind(wx.EVT_MENU, self.on_next_peak, menu_peak)
         menu_bar.Append(analysismenu, "&Analysis")
 
         self.SetMenuBar(menu_bar)
@@ -121,7 +130,7 @@ class ImagingWindow(wx.Frame):
         self.CenterOnParent()
         try:
             self.load()
-            self.extract(no_face=True)
+            self.extract_first(no_face=True)
         except:
             pass
         self.Show()
@@ -132,14 +141,79 @@ class ImagingWindow(wx.Frame):
         self.y = np.array(self.data.var2)
         self.mass_extracted = None
         self.mz_extracted = None
+        self.indexes = {}
+        self.peakimages = {}
+        self.peakindex = -1
+        thread = threading.Thread(target=self.build_index, args=(data,), daemon=True)
+        thread.start()
+
+    def build_index(self, data):
+        """
+        Index the mass and m/z grids for fast extraction and region sums, then make the mass images of the peaks in
+        the peak list. Runs in the background, and extraction uses the full grids until it is done.
+        The indexes keep float64 prefix sums the size of each grid, so they need about as much memory again as the
+        grids, or twice as much for single precision grids.
+        Peak images are keyed by mass, extraction choice, and extraction window, so they are not used after either
+        setting changes.
+        :param data: MetaDataSet for the window
+        :return: None
+        """
+        tstart = time.perf_counter()
+        exchoice = self.exchoice
+        exwindow = self.config.exwindow
+        indexes = {}
+        for dtype, dat, grid in [("mass", data.massdat, data.massgrid), ("mz", data.mzdat, data.mzgrid)]:
+            try:
+                if np.ndim(grid) == 3 and len(grid) == len(self.x):
+                    indexes[dtype] = ImageIndex(dat[:, 0], grid[:, :, 1], self.x, self.y)
+            except Exception as e:
+                print("Error indexing", dtype, "grid:", e)
+        if data is not self.data:
+            return
+        self.indexes = indexes
+
+        peakimages = {}
+        if "mass" in indexes and not ud.isempty(data.peaks):
+            for p in data.peaks:
+                midpoint, window = get_band([p[0] - exwindow, p[0] + exwindow])
+                peakimages[(p[0], exchoice, exwindow)] = indexes["mass"].extract(midpoint, window, exchoice)
+        if data is self.data:
+            self.peakimages = peakimages
+            print("Imaging index time:", time.perf_counter() - tstart)
+
+    def extract_grid(self, dtype, midpoint, window):
+        if dtype in self.indexes:
+            return self.indexes[dtype].extract(midpoint, window=window, extract_method=self.exchoice)
+        if dtype == "mass":
+            grid = self.data.massgrid[:, :, 1]
+            dat = self.data.massdat[:, 0]
+        else:
+            grid = self.data.mzgrid[:, :, 1]
+            dat = self.data.mzdat[:, 0]
+        return ud.extract_from_data_matrix(dat, grid, midpoint=midpoint, window=window, extract_method=self.exchoice)
+
+    def region_grid(self, dtype, ball, xrange, yrange):
+        if dtype in self.indexes:
+            return self.indexes[dtype].region_sum(xrange, yrange)
+        if dtype == "mass":
+            return np.sum(self.data.massgrid[ball, :, 1], axis=0)
+        return np.sum(self.data.mzgrid[ball, :, 1], axis=0)
 
     def update(self, e=None):
         self.exchoice = self.ctletype.GetSelection()
 
     def load(self, e=None):
-        self.load_plot1()
+        # Imaging files that have not been run through UniDec only have m/z data
+        if not ud.isempty(self.data.massdat):
+            self.load_plot1()
         self.load_plot4()
 
+    def extract_first(self, no_face=False):
+        if not ud.isempty(self.data.massdat):
+            self.extract(no_face=no_face)
+        else:
+            self.extract(erange=self.plot4.subplot1.get_xlim(), dtype="mz", plot=self.plot5)
+
     def load_plot4(self, e=None):
         self.plot4.plotrefreshtop(self.data.mzdat[:, 0], self.data.mzdat[:, 1], xlabel="m/z (Th)",
                                   ylabel="Intensity")
@@ -157,21 +231,15 @@ class ImagingWindow(wx.Frame):
                 self.plot1.add_rect(erange[0], 0, erange[1] - erange[0], np.amax(self.data.massdat[:, 1]),
                                     facecolor="y")
         if dtype == "mass":
-            grid = self.data.massgrid[:, :, 1]
-            dat = self.data.massdat[:, 0]
             self.massrange = erange
         elif dtype == "mz":
-            grid = self.data.mzgrid[:, :, 1]
-            dat = self.data.mzdat[:, 0]
             self.mzrange = erange
         else:
             return
 
         print("Extracting in Range:", erange)
-        midpoint = np.mean(erange)
-        window = midpoint - erange[0]
-        self.exdata = ud.extract_from_data_matrix(dat, grid, midpoint=midpoint, window=window,
-                                                  extract_method=self.exchoice)
+        midpoint, window = get_band(erange)
+        self.exdata = self.extract_grid(dtype, midpoint, window)
         self.image_plot(plot=plot)
 
         if dtype == "mass":
@@ -198,12 +266,12 @@ class ImagingWindow(wx.Frame):
 
         ball = b1 * b2 * b3 * b4
 
-        regiondat = np.sum(self.data.massgrid[ball, :, 1], axis=0)
+        regiondat = self.region_grid("mass", ball, xrange, yrange)
         regiondat = np.transpose([self.data.massdat[:, 0], regiondat])
         self.plot3.plotrefreshtop(regiondat[:, 0], regiondat[:, 1], xlabel="Mass (Da)", ylabel="Intensity")
         self.region_massdat = regiondat
 
-        regiondat2 = np.sum(self.data.mzgrid[ball, :, 1], axis=0)
+        regiondat2 = self.region_grid("mz", ball, xrange, yrange)
         regiondat2 = np.transpose([self.data.mzdat[:, 0], regiondat2])
         self.plot6.plotrefreshtop(regiondat2[:, 0], regiondat2[:, 1], xlabel="m/z (Th)", ylabel="Intensity")
         self.region_mzdat = regiondat2
@@ -249,6 +317,26 @@ class ImagingWindow(wx.Frame):
         for i, z in enumerate(ztab):
             self.plot4.addtext(str(z), mztab[i], 0.95 * np.amax(self.data.mzdat[:, 1]), vlines=True)
 
+    def on_next_peak(self, e=None):
+        if ud.isempty(self.data.peaks) or ud.isempty(self.data.massdat):
+            print("No peaks to show")
+            return
+        self.update()
+        self.peakindex = (self.peakindex + 1) % len(self.data.peaks)
+        mass = self.data.peaks[self.peakindex][0]
+        erange = [mass - self.config.exwindow, mass + self.config.exwindow]
+        print("Peak", self.peakindex, "Mass:", mass)
+        self.load_plot1()
+        self.plot1.add_rect(erange[0], 0, erange[1] - erange[0], np.amax(self.data.massdat[:, 1]), facecolor="y")
+        key = (mass, self.exchoice, self.config.exwindow)
+        if key in self.peakimages:
+            self.massrange = erange
+            self.exdata = self.peakimages[key]
+            self.image_plot()
+            self.mass_extracted = self.exdata
+        else:
+            self.extract(erange=erange)
+
     def on_open_hdf5(self, e=None):
         dlg = wx.FileDialog(self, "Choose a data file in HDF5 format", '', "", "*.hdf5*")
         if dlg.ShowModal() == wx.ID_OK:
@@ -263,7 +351,7 @@ class ImagingWindow(wx.Frame):
         data.import_grids()
         self.init_data(data)
         self.load()
-        self.extract()
+        self.extract_first()
 
     def on_cosine(self, event=None):
         print("Calculating Cosine Similarity")
@@ -5,6 +5,7 @@ from pyimzml.ImzMLWriter import ImzMLWriter
 import h5py
 import unidec.tools as ud
 from unidec.modules.hdf5_tools import replace_dataset
+from unidec.metaunidec import pixel_store
 
 
 class Imzml_Reader:
@@ -63,6 +64,28 @@ class Imzml_Reader:
         msdataset.attrs["num"] = num
         hdf.close()
 
+    def write_to_hdf5_stream(self, outfile=None, layout=None, chunksize=256, compression="gzip"):
+        """
+        Write the pixels to a single pixel-major group in the HDF5 file (see pixel_store), reading a chunk of pixels
+        at a time instead of loading them all with get_data.
+        :param outfile: HDF5 file. Default is the imzML file name with .hdf5.
+        :param layout: "dense" or "csr". Default is dense for continuous imzML, where all pixels share the m/z values,
+        and csr for processed imzML.
+        :param chunksize: Number of pixels to read at a time
+        :param compression: HDF5 compression filter for the spectra
+        :return: Number of pixels with data
+        """
+        if outfile is None:
+            outfile = self.header + ".hdf5"
+        if layout is None:
+            try:
+                layout = "dense" if len(set(self.msrun.mzOffsets)) == 1 else "csr"
+            except AttributeError:
+                layout = "csr"
+        print("Writing pixels to", outfile, "with layout:", layout)
+        return pixel_store.write_pixels(outfile, self.msrun.getspectrum, self.coords, layout=layout,
+                                        chunksize=chunksize, compression=compression)
+
 def hdf5_to_imzml(path, outpath):
     from unidec.metaunidec.mudeng import MetaUniDec
     eng = MetaUniDec()
@@ -83,10 +106,13 @@ def hdf5_to_imzml(path, outpath):
             print(i, coords)
             w.addSpectrum(mzs, intensities, coords)
 
-def imzml_to_hdf5(infile, outfile):
+def imzml_to_hdf5(infile, outfile, stream=True):
     r = Imzml_Reader(infile)
-    data = r.get_data()
-    r.write_to_hdf5(outfile)
+    if stream:
+        r.write_to_hdf5_stream(outfile)
+    else:
+        data = r.get_data()
+        r.write_to_hdf5(outfile)
 
 
 if __name__ == '__main__':
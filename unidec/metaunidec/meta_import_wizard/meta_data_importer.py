@@ -39,7 +39,7 @@ def auto_from_wizard(data, filename, mode):
         path = d[5]
 
         if start is None or stop is None:
-            eng.data.add_file(path=path)
+            eng.data.add_file(path=path, export=False)
         else:
             print(start, stop)
             importer = get_importer(path)
@@ -47,7 +47,7 @@ def auto_from_wizard(data, filename, mode):
                 data = importer.get_data(scan_range=(start, stop))
             elif mode == 0:
                 data = importer.get_data(time_range=(start, stop))
-            eng.data.add_data(data, path)
+            eng.data.add_data(data, path, export=False)
         eng.data.spectra[-1].var1 = v1
         eng.data.spectra[-1].var2 = v2
         eng.data.spectra[-1].name = f
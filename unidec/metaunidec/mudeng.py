@@ -84,6 +84,7 @@ class MetaUniDec(unidec_enginebase.UniDecEngine):
     def process_data(self):
         self.pks.peaks = []
         self.config.write_hdf5()
+        self.data.unpack_pixels()
         self.out = metaunidec_call(self.config, "-proc")
         self.data.import_hdf5()
         self.update_history()
@@ -92,11 +93,13 @@ class MetaUniDec(unidec_enginebase.UniDecEngine):
         if not self.check_badness():
             self.pks.peaks = []
             self.config.write_hdf5()
+            self.data.unpack_pixels()
             self.out = metaunidec_call(self.config)
             self.data.import_hdf5()
             self.update_history()
 
     def make_grids(self):
+        self.data.unpack_pixels()
         self.out = metaunidec_call(self.config, "-grids")
 
     def sum_masses(self, refresh=True):
@@ -133,6 +136,7 @@ class MetaUniDec(unidec_enginebase.UniDecEngine):
 
     def pick_scanpeaks(self):
         self.config.write_hdf5()
+        self.data.unpack_pixels()
         self.out = metaunidec_call(self.config, "-scanpeaks")
         self.data.import_hdf5()
         self.sum_masses()
@@ -217,6 +221,7 @@ class MetaUniDec(unidec_enginebase.UniDecEngine):
         if ud.isempty(self.data.exgrid):
             print("Empty extract grid, running UniDec...")
             self.sum_masses()
+            self.data.unpack_pixels()
             self.out = metaunidec_call(self.config, "-scanpeaks")
             self.data.import_hdf5()
 
@@ -1,11 +1,97 @@
 import numpy as np
-from unidec.modules.hdf5_tools import replace_dataset, get_dataset
+from unidec.modules.hdf5_tools import replace_dataset, get_dataset, fingerprint
 import h5py
 import pandas as pd
 import unidec.tools as ud
 import os
+from collections import OrderedDict
 from copy import deepcopy
 from unidec.modules.peakstructure import Peaks
+from unidec.metaunidec import pixel_store
+
+
+# HDF5 dataset name and Spectrum attribute for each array saved with a spectrum
+spectrum_datasets = [("raw_data", "rawdata"), ("processed_data", "data2"), ("mass_data", "massdat"),
+                     ("mz_grid", "mzgrid"), ("mass_grid", "massgrid"), ("charge_data", "zdata")]
+dataset_names = {attr: name for name, attr in spectrum_datasets}
+# Spectrum arrays that can be left in the file until they are used
+lazy_arrays = ["rawdata", "data2", "massdat", "mzgrid", "massgrid", "zdata", "ztab", "peaks"]
+
+
+def same_value(a, b):
+    """
+    Check if two HDF5 attribute values are the same.
+    :param a: Value
+    :param b: Value
+    :return: True if equal, including type
+    """
+    if type(a) is not type(b):
+        return False
+    try:
+        return np.shape(a) == np.shape(b) and bool(np.all(a == b))
+    except Exception:
+        return False
+
+
+class SpectrumData(object):
+    def __init__(self, name):
+        """
+        Attribute of a Spectrum that is read from the HDF5 file the first time it is used.
+        :param name: Attribute name
+        :return: SpectrumData object
+        """
+        self.name = name
+        self.key = "_" + name
+
+    def __get__(self, s, objtype=None):
+        if s is None:
+            return self
+        if self.key not in s.__dict__:
+            s.load(self.name)
+        if s.lru is not None:
+            s.lru.touch(s)
+        return s.__dict__[self.key]
+
+    def __set__(self, s, value):
+        s.__dict__[self.key] = value
+        # Set directly, so it is no longer a copy of the file and is kept in memory
+        s.loaded.pop(self.name, None)
+
+
+class ResidentSpectra(object):
+    def __init__(self, maxsize=256):
+        """
+        Least recently used list of the spectra with arrays read from the file. When there are more than maxsize,
+        the oldest spectra drop their unchanged arrays, which are read again if they are used.
+        :param maxsize: Maximum number of spectra to keep in memory
+        :return: ResidentSpectra object
+        """
+        self.maxsize = maxsize
+        self.spectra = OrderedDict()
+        self.hold = False
+
+    def __len__(self):
+        return len(self.spectra)
+
+    def touch(self, s):
+        key = id(s)
+        if key in self.spectra:
+            self.spectra.move_to_end(key)
+            return
+        self.spectra[key] = s
+        self.trim()
+
+    def trim(self):
+        if self.hold:
+            return
+        while len(self.spectra) > max(self.maxsize, 1):
+            self.spectra.popitem(last=False)[1].unload()
+
+    def discard(self, s):
+        self.spectra.pop(id(s), None)
+
+    def clear(self):
+        self.spectra = OrderedDict()
 
 
 class MetaDataSet:
@@ -31,9 +117,25 @@ class MetaDataSet:
         self.eng = engine
         self.fitgrid = []
         self.fits = []
+        # Read spectrum arrays from the file when they are used, keeping at most maxsize spectra in memory
+        maxresident = engine.config.maxresident if engine is not None else 0
+        self.lazy = maxresident > 0
+        self.resident = ResidentSpectra(maxsize=maxresident)
+        # Imaging spectra read from a pixel-major group (see pixel_store) rather than one group per spectrum
+        self.pixels = None
         pass
 
-    def import_hdf5(self, file=None, speedy=False):
+    def import_hdf5(self, file=None, speedy=False, lazy=None):
+        """
+        Read the spectra from the HDF5 file.
+        :param file: HDF5 file. Default is self.filename.
+        :param speedy: If True, only read the attributes of each spectrum
+        :param lazy: If True, read the attributes now and each array when it is first used. Default is self.lazy.
+        :return: None
+        """
+        if lazy is None:
+            lazy = self.lazy
+        lazy = lazy and not speedy
         if file is None:
             file = self.filename
         else:
@@ -51,14 +153,27 @@ class MetaDataSet:
         self.indexes = sorted(self.indexes)
         self.len = len(self.indexes)
 
-        if ud.isempty(self.spectra):
+        self.resident.clear()
+        self.pixels = None
+        if self.len == 0 and pixel_store.PixelStore.exists(hdf):
+            self.pixels = pixel_store.PixelStore(hdf[pixel_store.group_name])
+            self.len = len(self.pixels)
+            self.spectra = []
+            for n, i in enumerate(self.pixels.indexes):
+                s = Spectrum(self.topname, n, self.eng)
+                s.lru = self.resident
+                s.read_pixel(self.pixels, i, speedy=speedy, lazy=lazy)
+                self.spectra.append(s)
+        elif ud.isempty(self.spectra):
             for i in self.indexes:
                 s = Spectrum(self.topname, i, self.eng)
-                s.read_hdf5(file, speedy=speedy, hdfobj=hdf)
+                s.lru = self.resident
+                s.read_hdf5(file, speedy=speedy, hdfobj=hdf, lazy=lazy)
                 self.spectra.append(s)
         else:
             for s in self.spectra:
-                s.read_hdf5(file, speedy=speedy, hdfobj=hdf)
+                s.lru = self.resident
+                s.read_hdf5(file, speedy=speedy, hdfobj=hdf, lazy=lazy)
 
         if not ud.isempty(self.spectra):
             self.data2 = self.spectra[0].data2
@@ -70,7 +185,15 @@ class MetaDataSet:
             #    pass
         hdf.close()
 
-    def export_hdf5(self, file=None, vars_only=False, delete=False):
+    def export_hdf5(self, file=None, vars_only=False, delete=False, indexes=None):
+        """
+        Write the spectra to the HDF5 file. Each spectrum only writes the datasets and attributes that have changed.
+        :param file: HDF5 file. Default is self.filename.
+        :param vars_only: If True, only write the attributes
+        :param delete: If True, delete and rewrite the whole data set
+        :param indexes: Indexes of the spectra to write. Default is all spectra.
+        :return: None
+        """
         if file is None:
             file = self.filename
         else:
@@ -80,6 +203,12 @@ class MetaDataSet:
             print("Error: No HDF5 file present. Please create an HDF5 file first")
             return
 
+        if delete:
+            # Read any arrays still in the file before the group is deleted and keep them until they are rewritten
+            self.resident.hold = True
+            for s in self.spectra:
+                s.load_all()
+
         # Clear Group
         hdf = h5py.File(file, 'a')
         if delete:
@@ -88,6 +217,8 @@ class MetaDataSet:
                 pass
             except:
                 pass
+            for s in self.spectra:
+                s.clear_written()
         group = hdf.require_group(self.topname)
         group.attrs["num"] = len(self.spectra)
         group.attrs["v1name"] = self.v1name
@@ -104,12 +235,15 @@ class MetaDataSet:
             s.attrs["name"] = s.name
             self.var1.append(s.var1)
             self.var2.append(s.var2)
-            s.write_hdf5(self.filename, vars_only=vars_only, hdfobj=hdf)
+            if indexes is None or i in indexes:
+                s.write_hdf5(self.filename, vars_only=vars_only, hdfobj=hdf)
         self.var1 = np.array(self.var1)
         # print("Variable 1:", self.var1)
         self.var2 = np.array(self.var2)
         self.len = len(self.spectra)
         hdf.close()
+        self.resident.hold = False
+        self.resident.trim()
 
     def export_vars(self, file=None):
         for s in self.spectra:
@@ -138,6 +272,15 @@ class MetaDataSet:
         axis = get_dataset(msdataset, "mz_axis")
         sum = get_dataset(msdataset, "mz_sum")
         grid = get_dataset(msdataset, "mz_grid")
+        if ud.isempty(axis) and self.pixels is not None:
+            # Imaging data that has not been run through UniDec, so take the m/z grid from the pixels
+            hdf.close()
+            axis, grid = self.pixels.get_grid()
+            self.mzdat = np.transpose([axis, np.sum(grid, axis=0)])
+            self.mzgrid = np.empty((len(grid), len(axis), 2))
+            self.mzgrid[:, :, 0] = axis
+            self.mzgrid[:, :, 1] = grid
+            return len(grid)
         self.mzdat = np.transpose([axis, sum])
         try:
             num = int(len(grid) / len(sum))
@@ -178,6 +321,20 @@ class MetaDataSet:
                 self.import_grids()
                 self.import_peaks()
 
+    def unpack_pixels(self):
+        """
+        Write the spectra from a pixel-major imaging file to one group per spectrum, which is what the UniDec core reads.
+        The pixel group is then removed so the spectra are not stored twice.
+        :return: None
+        """
+        if self.pixels is not None and len(self.spectra) > 0:
+            print("Writing pixels to spectrum groups:", len(self.spectra))
+            self.export_hdf5()
+            self.pixels = None
+            # Spectra imported with speedy are not read, so keep the pixel group for them
+            if all([s.pixel is None for s in self.spectra]):
+                pixel_store.drop_pixels(self.filename)
+
     def new_file(self, path):
         self.__init__(self.eng)
         if os.path.isfile(path):
@@ -189,14 +346,14 @@ class MetaDataSet:
         config.attrs["metamode"] = -1
         hdf.close()
 
-    def add_file(self, filename=None, dirname=None, path=None):
+    def add_file(self, filename=None, dirname=None, path=None, export=True):
         if path is None:
             path = os.path.join(dirname, filename)
         else:
             dirname, filename = os.path.split(path)
 
         data = ud.load_mz_file(path)
-        self.add_data(data, name=filename)
+        self.add_data(data, name=filename, export=export)
 
     def add_data(self, data, name="", attrs=None, export=True):
         print("Adding:", name, "to", self.topname)
@@ -212,6 +369,7 @@ class MetaDataSet:
         snew.name = name
         if attrs is not None:
             snew.attrs = attrs
+        v1name = self.v1name
 
         try:
             if "CID" in name or "SID" in name or "TEMP" in name:
@@ -242,16 +400,34 @@ class MetaDataSet:
         self.spectra.append(snew)
         self.len = len(self.spectra)
         if export:
-            self.export_hdf5()
+            # Only new spectra have changed unless the variable name was changed for all spectra. Spectra added
+            # earlier with export=False are not yet in the file, so they are new too.
+            if v1name == self.v1name and self.filename is not None:
+                self.export_hdf5(indexes=self.unwritten_indexes())
+            else:
+                self.export_hdf5()
+
+    def unwritten_indexes(self):
+        """
+        Find the spectra that have not been written to their group in the file.
+        :return: Set of indexes
+        """
+        indexes = set()
+        for i, s in enumerate(self.spectra):
+            if s.writtenpath != (os.path.abspath(self.filename), self.topname + "/" + str(i)):
+                indexes.add(i)
+        return indexes
 
     def remove_data(self, indexes):
         for i in sorted(indexes, reverse=True):
+            self.resident.discard(self.spectra[i])
             del self.spectra[i]
         self.export_hdf5(delete=True)
         print("Removed")
 
     def clear(self):
         self.spectra = []
+        self.resident.clear()
         self.export_hdf5(delete=True)
 
     def get_spectra(self):
@@ -365,7 +541,23 @@ class MetaDataSet:
 
 
 class Spectrum:
+    rawdata = SpectrumData("rawdata")
+    data2 = SpectrumData("data2")
+    massdat = SpectrumData("massdat")
+    mzgrid = SpectrumData("mzgrid")
+    massgrid = SpectrumData("massgrid")
+    ztab = SpectrumData("ztab")
+    zdata = SpectrumData("zdata")
+    peaks = SpectrumData("peaks")
+    pks = SpectrumData("pks")
+
     def __init__(self, topname, index, eng):
+        # Where to read arrays that have not been read yet, and fingerprints of the arrays as read from there
+        self.source = None
+        self.loaded = {}
+        self.lru = None
+        # Index in the pixel group if read from a pixel-major imaging file
+        self.pixel = None
         # self.fitdat = np.array([])
         # self.baseline = np.array([])
         # self.fitdat2d = np.array([])
@@ -388,8 +580,34 @@ class Spectrum:
         self.var1 = 0
         self.var2 = 0
         self.eng = eng
+        # What is in the file for this spectrum, so that write_hdf5 only writes what has changed
+        self.writtenpath = None
+        self.written = {}
+        self.writtenattrs = {}
+
+    def clear_written(self):
+        self.writtenpath = None
+        self.written = {}
+        self.writtenattrs = {}
+
+    def check_written(self, hdf):
+        """
+        Forget what was written if the spectrum is now in a different file or group.
+        :param hdf: Open HDF5 file
+        :return: Group name for the spectrum
+        """
+        path = self.topname + "/" + str(self.index)
+        fileid = (os.path.abspath(hdf.filename), path)
+        if self.writtenpath != fileid:
+            self.clear_written()
+            self.writtenpath = fileid
+        return path
 
     def write_hdf5(self, file=None, vars_only=False, hdfobj=None):
+        """
+        Write the spectrum to its group in the HDF5 file. Datasets and attributes that are unchanged since they were
+        last written or read are skipped.
+        """
         if hdfobj is None:
             if file is None:
                 file = self.filename
@@ -398,24 +616,49 @@ class Spectrum:
             hdf = h5py.File(file, 'a')
         else:
             hdf = hdfobj
-        msdata = hdf.require_group(self.topname + "/" + str(self.index))
+        path = self.topname + "/" + str(self.index)
+        moved = self.source is not None and self.source != (os.path.abspath(hdf.filename), path)
+        if moved and not vars_only:
+            self.load_all()
+        msdata = hdf.require_group(self.check_written(hdf))
         if not vars_only:
-            replace_dataset(msdata, "raw_data", self.rawdata.astype(self.eng.config.dtype))
-            # print(self.eng.config.dtype)
-            # replace_dataset(msdata, "fit_data", self.fitdat)
-            replace_dataset(msdata, "processed_data", self.data2.astype(self.eng.config.dtype))
-            replace_dataset(msdata, "mass_data", self.massdat.astype(self.eng.config.dtype))
-            replace_dataset(msdata, "mz_grid", self.mzgrid.astype(self.eng.config.dtype))
-            replace_dataset(msdata, "mass_grid", self.massgrid.astype(self.eng.config.dtype))
-            # replace_dataset(msdata, "baseline", self.baseline)
-            replace_dataset(msdata, "charge_data", self.zdata.astype(self.eng.config.dtype))
+            for name, attr in spectrum_datasets:
+                if name in msdata and not moved:
+                    # Not read yet, or unchanged since it was read, so still the same as in the file
+                    key = "_" + attr
+                    if key not in self.__dict__ or self.loaded.get(attr) == fingerprint(self.__dict__[key]):
+                        continue
+                value = getattr(self, attr)
+                data = value.astype(self.eng.config.dtype)
+                fp = fingerprint(data)
+                if self.written.get(name) != fp or name not in msdata:
+                    replace_dataset(msdata, name, data, compression=self.eng.config.hdf5compression, shuffle=True)
+                    self.written[name] = fp
+                if data.dtype != value.dtype:
+                    self.loaded.pop(attr, None)
+            if moved:
+                # Arrays are now read from the new group. Peaks are not written here, so keep them in memory.
+                self.source = self.writtenpath
+                self.pixel = None
+                self.loaded.pop("peaks", None)
+                self.loaded.pop("ztab", None)
         for key, value in list(self.attrs.items()):
-            msdata.attrs[key] = value
+            if key not in self.writtenattrs or not same_value(self.writtenattrs[key], value):
+                msdata.attrs[key] = value
+                self.writtenattrs[key] = deepcopy(value)
 
         if hdfobj is None:
             hdf.close()
 
-    def read_hdf5(self, file=None, speedy=False, hdfobj=None):
+    def read_hdf5(self, file=None, speedy=False, hdfobj=None, lazy=False):
+        """
+        Read the spectrum from its group in the HDF5 file.
+        :param file: HDF5 file. Default is self.filename.
+        :param speedy: If True, only read the attributes
+        :param hdfobj: Open HDF5 file to use instead of file
+        :param lazy: If True, read the attributes now and each array from the file when it is first used
+        :return: None
+        """
         if hdfobj is None:
             if file is None:
                 file = self.filename
@@ -424,20 +667,40 @@ class Spectrum:
             hdf = h5py.File(file, 'r')
         else:
             hdf = hdfobj
-        msdata = hdf.get(self.topname + "/" + str(self.index))
-        if not speedy:
+        msdata = hdf.get(self.check_written(hdf))
+        self.pixel = None
+        if lazy:
+            # Anything in memory is replaced by what is in the file, as below
+            self.source = self.writtenpath
+            self.loaded = {}
+            self.written = {}
+            for name in lazy_arrays + ["pks"]:
+                self.__dict__.pop("_" + name, None)
+        elif not speedy:
+            self.source = None
+            if "_pks" not in self.__dict__:
+                self.pks = Peaks()
             self.rawdata = get_dataset(msdata, "raw_data")
             # self.fitdat = get_dataset(msdata, "fit_data")
             self.data2 = get_dataset(msdata, "processed_data")
+            self.massdat = get_dataset(msdata, "mass_data")
+            self.zdata = get_dataset(msdata, "charge_data")
+            self.mzgrid = get_dataset(msdata, "mz_grid")
+            self.massgrid = get_dataset(msdata, "mass_grid")
+            # Record the data as read, before any changes below
+            for name, attr in spectrum_datasets:
+                if name in msdata:
+                    self.written[name] = fingerprint(getattr(self, attr))
+                else:
+                    self.written.pop(name, None)
+
             if ud.isempty(self.data2) and not ud.isempty(self.rawdata):
                 self.data2 = deepcopy(self.rawdata)
-            self.massdat = get_dataset(msdata, "mass_data")
             try:
                 if len(self.massdat) < 2 and "mass_data" in list(msdata.keys()):
                     self.massdat = np.array([[self.eng.config.masslb, 0], [self.eng.config.massub, 0]])
             except:
                 pass
-            self.zdata = get_dataset(msdata, "charge_data")
 
             if self.eng.config.datanorm == 1:
                 try:
@@ -453,9 +716,6 @@ class Spectrum:
                 except:
                     pass
 
-            self.mzgrid = get_dataset(msdata, "mz_grid")
-            self.massgrid = get_dataset(msdata, "mass_grid")
-
             try:
                 self.ztab = self.zdata[:, 0]
             except:
@@ -464,9 +724,106 @@ class Spectrum:
             self.peaks = get_dataset(msdata, "peaks")
             self.setup_peaks()
         self.attrs = dict(list(msdata.attrs.items()))
+        self.writtenattrs = deepcopy(self.attrs)
         if hdfobj is None:
             hdf.close()
 
+    def read_pixel(self, pixels, index, speedy=False, lazy=False):
+        """
+        Set up the spectrum from a pixel of a pixel-major imaging file. Nothing is written for it in the file yet.
+        :param pixels: PixelStore object
+        :param index: Pixel index
+        :param speedy: If True, only read the attributes
+        :param lazy: If True, read the data from the file when it is first used
+        :return: None
+        """
+        self.clear_written()
+        self.pixel = index
+        self.attrs = pixels.get_attrs(index)
+        self.source = None if speedy else (os.path.abspath(pixels.filename), pixel_store.group_name)
+        self.loaded = {}
+        for name in lazy_arrays + ["pks"]:
+            self.__dict__.pop("_" + name, None)
+        if not speedy and not lazy:
+            self.load_all()
+            self.loaded = {}
+
+    def load(self, name):
+        """
+        Read an array from the file the first time it is used, in the same way as read_hdf5.
+        :param name: Attribute name
+        :return: None
+        """
+        if name == "pks":
+            value = Peaks()
+            value.add_peaks(self.peaks, scores_included=True)
+            value.default_params()
+        elif name == "ztab":
+            try:
+                value = self.zdata[:, 0]
+            except:
+                value = np.array([])
+        elif self.source is None:
+            value = np.array([])
+        else:
+            hdf = h5py.File(self.source[0], 'r')
+            try:
+                value = self.read_array(name, hdf[self.source[1]])
+            finally:
+                hdf.close()
+        self.__dict__["_" + name] = value
+        if name != "pks" and self.source is not None:
+            self.loaded[name] = fingerprint(value)
+
+    def read_array(self, name, msdata):
+        if name == "peaks":
+            return get_dataset(msdata, "peaks")
+        dname = dataset_names[name]
+        if self.pixel is not None:
+            data = pixel_store.get_pixel_dataset(msdata, dname, self.pixel)
+        else:
+            data = get_dataset(msdata, dname)
+        # Record the data as read, before any changes below
+        if self.source == self.writtenpath:
+            if dname in msdata:
+                self.written[dname] = fingerprint(data)
+            else:
+                self.written.pop(dname, None)
+
+        if name == "data2" and data.size == 0 and not ud.isempty(self.rawdata):
+            data = deepcopy(self.rawdata)
+        if name == "massdat":
+            try:
+                if len(data) < 2 and "mass_data" in list(msdata.keys()):
+                    data = np.array([[self.eng.config.masslb, 0], [self.eng.config.massub, 0]])
+            except:
+                pass
+        if name in ["data2", "massdat", "zdata"] and self.eng.config.datanorm == 1:
+            try:
+                data[:, 1] /= np.amax(data[:, 1])
+            except:
+                pass
+        return data
+
+    def load_all(self):
+        """
+        Read all arrays that have not been read yet.
+        :return: None
+        """
+        for name in lazy_arrays + ["pks"]:
+            getattr(self, name)
+
+    def unload(self):
+        """
+        Drop the arrays read from the file that are unchanged, so that they are read again when next used.
+        :return: None
+        """
+        for name, fp in list(self.loaded.items()):
+            key = "_" + name
+            if key in self.__dict__ and fingerprint(self.__dict__[key]) == fp:
+                del self.__dict__[key]
+        self.loaded = {}
+
     def setup_peaks(self):
         self.pks.add_peaks(self.peaks, scores_included=True)
         self.pks.default_params()
@@ -0,0 +1,245 @@
+"""
+Pixel-major storage of imaging spectra in MetaUniDec HDF5 files.
+
+All pixels are kept in a single group rather than one group per pixel. The "dense" layout is for pixels that share an
+m/z axis, and stores the axis once with a (pixels x m/z) intensity dataset. The "csr" layout is for pixels with their
+own m/z values, and stores the m/z and intensity values of all pixels end to end. Pixel i is at offsets[i] to
+offsets[i + 1], and pixels with no data have no values. Spectra are written and read a chunk of pixels at a time, so
+memory does not grow with the size of the image.
+"""
+import os
+import numpy as np
+import h5py
+import unidec.tools as ud
+from unidec.modules.chrom_cube import get_axis
+
+__author__ = 'Michael.Marty'
+
+version = 1
+group_name = "pixel_data"
+layouts = ["dense", "csr"]
+
+
+def write_pixels(outfile, getspectrum, coords, layout="csr", chunksize=256, compression="gzip"):
+    """
+    Write the spectra of an imaging run to the pixel group of an HDF5 file, reading a chunk of pixels at a time.
+    Replaces any spectra already in the file.
+    :param outfile: HDF5 file
+    :param getspectrum: Function that returns the m/z and intensity arrays of a pixel from its index
+    :param coords: Coordinates of each pixel (N x 3)
+    :param layout: "dense" if all pixels share an m/z axis, or "csr" (default) if not
+    :param chunksize: Number of pixels to read at a time
+    :param compression: HDF5 compression filter for the spectra
+    :return: Number of pixels with data
+    """
+    if layout not in layouts:
+        raise ValueError("Unknown pixel layout: " + str(layout))
+    coords = np.array(coords, dtype=np.int64).reshape((len(coords), -1))
+    n = len(coords)
+    chunksize = max(int(chunksize), 1)
+
+    hdf = h5py.File(outfile, "a")
+    for name in ["ms_dataset", group_name]:
+        if name in hdf:
+            del hdf[name]
+    msdataset = hdf.require_group("ms_dataset")
+    msdataset.attrs["v1name"] = "xpos"
+    msdataset.attrs["v2name"] = "ypos"
+    config = hdf.require_group("config")
+    config.attrs["metamode"] = -1
+
+    pixels = hdf.require_group(group_name)
+    pixels.attrs["version"] = version
+    pixels.attrs["layout"] = layout
+    pixels.create_dataset("coords", data=coords)
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    mzrange = np.full((n, 2), np.nan)
+    axis = None
+    mzset = None
+    intset = None
+    for start in range(0, n, chunksize):
+        stop = min(start + chunksize, n)
+        mzs = []
+        ints = []
+        for i in range(start, stop):
+            mz, intensity = getspectrum(i)
+            mzs.append(np.asarray(mz))
+            ints.append(np.asarray(intensity))
+        lengths = np.array([len(mz) for mz in mzs], dtype=np.int64)
+        offsets[start + 1:stop + 1] = offsets[start] + np.cumsum(lengths)
+        for j, mz in enumerate(mzs):
+            if len(mz) > 0:
+                mzrange[start + j] = [np.amin(mz), np.amax(mz)]
+
+        if intset is None and np.any(lengths > 0):
+            first = int(np.argmax(lengths > 0))
+            if layout == "dense":
+                axis = mzs[first]
+                rows = max(1, 2 ** 18 // len(axis))
+                pixels.create_dataset("mz_axis", data=axis)
+                intset = pixels.create_dataset("intensity", shape=(n, len(axis)), dtype=ints[first].dtype,
+                                               chunks=(min(rows, n), len(axis)), compression=compression,
+                                               shuffle=compression is not None)
+            else:
+                mzset = pixels.create_dataset("mz", shape=(0,), maxshape=(None,), dtype=mzs[first].dtype,
+                                              chunks=(2 ** 16,), compression=compression,
+                                              shuffle=compression is not None)
+                intset = pixels.create_dataset("intensity", shape=(0,), maxshape=(None,), dtype=ints[first].dtype,
+                                               chunks=(2 ** 16,), compression=compression,
+                                               shuffle=compression is not None)
+        if intset is None:
+            continue
+
+        if layout == "dense":
+            block = np.zeros((stop - start, len(axis)), dtype=intset.dtype)
+            for j, mz in enumerate(mzs):
+                if len(mz) == 0:
+                    continue
+                if len(mz) != len(axis) or not np.array_equal(mz, axis):
+                    hdf.close()
+                    raise ValueError("Pixel " + str(start + j) + " does not share the m/z axis. Use the csr layout.")
+                block[j] = ints[j]
+            intset[start:stop] = block
+        else:
+            total = int(offsets[stop])
+            mzset.resize((total,))
+            intset.resize((total,))
+            mzset[offsets[start]:total] = np.concatenate(mzs)
+            intset[offsets[start]:total] = np.concatenate(ints)
+
+    pixels.create_dataset("offsets", data=offsets)
+    pixels.create_dataset("mzrange", data=mzrange)
+    num = int(np.sum(np.diff(offsets) > 0))
+    msdataset.attrs["num"] = num
+    hdf.close()
+    return num
+
+
+def drop_pixels(outfile):
+    """
+    Remove the pixel group from an HDF5 file once the spectra have been written to their own groups.
+    Deleting a group does not free its space in the file, so the rest of the file is copied to a new file that
+    replaces the old one.
+    :param outfile: HDF5 file
+    :return: None
+    """
+    tempfile = outfile + ".tmp"
+    with h5py.File(outfile, "r") as hdf, h5py.File(tempfile, "w") as new:
+        for key, value in hdf.attrs.items():
+            new.attrs[key] = value
+        for name in hdf:
+            if name != group_name:
+                hdf.copy(hdf[name], new, name=name)
+    os.replace(tempfile, outfile)
+
+
+def read_pixel(group, index):
+    """
+    Read the spectrum of one pixel.
+    :param group: Open pixel group
+    :param index: Pixel index
+    :return: N x 2 data, empty if the pixel has no data
+    """
+    i0, i1 = group["offsets"][index:index + 2]
+    if i1 <= i0:
+        return np.array([])
+    if ud.smartdecode(group.attrs["layout"]) == "dense":
+        mz = group["mz_axis"][:]
+        intensity = group["intensity"][index]
+    else:
+        mz = group["mz"][i0:i1]
+        intensity = group["intensity"][i0:i1]
+    return np.transpose([mz, intensity])
+
+
+def get_pixel_dataset(group, name, index):
+    """
+    Read a spectrum dataset of one pixel, in the same way as hdf5_tools.get_dataset reads it from a spectrum group.
+    Only raw data is stored for pixels.
+    :param group: Open pixel group
+    :param name: Dataset name
+    :param index: Pixel index
+    :return: Data, or an empty array if there is none
+    """
+    if name == "raw_data":
+        return read_pixel(group, index)
+    return np.array([])
+
+
+class PixelStore(object):
+    def __init__(self, group):
+        """
+        Read the index of the pixel group. The spectra stay in the file.
+        :param group: Open pixel group
+        :return: PixelStore object
+        """
+        self.filename = group.file.filename
+        self.layout = ud.smartdecode(group.attrs["layout"])
+        self.coords = group["coords"][:]
+        self.offsets = group["offsets"][:]
+        self.mzrange = group["mzrange"][:]
+        # Pixels with data, which are the spectra in MetaDataSet
+        self.indexes = np.flatnonzero(np.diff(self.offsets) > 0)
+
+    @staticmethod
+    def exists(hdf):
+        return group_name in hdf
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def get_attrs(self, index):
+        """
+        Spectrum attributes for a pixel, the same as Imzml_Reader.write_to_hdf5 writes.
+        :param index: Pixel index
+        :return: Dictionary of attributes
+        """
+        c = [int(v) for v in self.coords[index]] + [0] * (3 - len(self.coords[index]))
+        return {"Position": str(c[0]) + "," + str(c[1]) + "," + str(c[2]), "xpos": c[0], "ypos": c[1], "zpos": c[2]}
+
+    def get_spectrum(self, index):
+        """
+        Read the spectrum of one pixel.
+        :param index: Pixel index
+        :return: N x 2 data
+        """
+        with h5py.File(self.filename, "r") as hdf:
+            return read_pixel(hdf[group_name], index)
+
+    def get_grid(self, mzbins=None, chunksize=256):
+        """
+        Intensities of all pixels with data on a shared m/z axis. The dense layout uses its own axis. Pixels in the
+        csr layout are interpolated onto an axis made as in merge_spectra.
+        :param mzbins: Linear m/z bin size for the csr layout. None or 0 for a nonlinear axis.
+        :param chunksize: Number of pixels to read at a time
+        :return: m/z axis, intensity grid (pixels with data x m/z)
+        """
+        with h5py.File(self.filename, "r") as hdf:
+            group = hdf[group_name]
+            if len(self.indexes) == 0:
+                return np.array([]), np.zeros((0, 0))
+            if self.layout == "dense":
+                axis = group["mz_axis"][:]
+                grid = np.empty((len(self.indexes), len(axis)), dtype=group["intensity"].dtype)
+                for start in range(0, len(self.indexes), chunksize):
+                    rows = self.indexes[start:start + chunksize]
+                    grid[start:start + len(rows)] = group["intensity"][rows[0]:rows[-1] + 1][rows - rows[0]]
+                return axis, grid
+
+            lengths = np.diff(self.offsets)
+            longest = read_pixel(group, int(np.argmax(lengths)))
+            axis = get_axis(np.nanmin(self.mzrange[:, 0]), np.nanmax(self.mzrange[:, 1]), longest, mzbins)
+            template = np.transpose([axis, np.zeros_like(axis)])
+            grid = np.zeros((len(self.indexes), len(axis)))
+            for start in range(0, len(self.indexes), chunksize):
+                rows = self.indexes[start:start + chunksize]
+                i0 = self.offsets[rows[0]]
+                mz = group["mz"][i0:self.offsets[rows[-1] + 1]]
+                intensity = group["intensity"][i0:self.offsets[rows[-1] + 1]]
+                for j, r in enumerate(rows):
+                    a = self.offsets[r] - i0
+                    b = self.offsets[r + 1] - i0
+                    if b - a > 2:
+                        grid[start + j] = ud.mergedata(template, np.transpose([mz[a:b], intensity[a:b]]))[:, 1]
+            return axis, grid
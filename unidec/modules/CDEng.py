@@ -1,6 +1,7 @@
 import numpy as np
 import os
 import scipy
+import scipy.sparse
 import unidec.tools as ud
 from unidec.modules.unidec_enginebase import UniDecEngine
 from unidec.modules.thermo_reader.ThermoImporter import ThermoDataImporter
@@ -9,6 +10,7 @@ import matplotlib.pyplot as plt
 import scipy.fft as fft
 from unidec.modules import unidecstructure, peakstructure, IM_functions, fitting, i2ms_importer
 from unidec.modules import mzMLimporter
+from unidec.modules import ion_store
 import time
 from unidec import engine
 from scipy.optimize import curve_fit
@@ -41,27 +43,37 @@ def Gmax2(darray):
     return gradmax2
 
 
-def fft_fun(a):
-    return fft.rfft2(a)
+def fft_fun(a, workers=None):
+    return fft.rfft2(a, workers=workers)
 
 
-def ifft_fun(A, shape):
-    return fft.irfft2(A, shape)
+def ifft_fun(A, shape, workers=None, overwrite_x=False):
+    return fft.irfft2(A, shape, workers=workers, overwrite_x=overwrite_x)
 
 
 def safedivide(a, b):
     return ud.safedivide(a, b)
 
 
+def safedivide_inplace(a, b):
+    """
+    Same as safedivide but writes a/b into b. Where b is 0, it stays 0.
+    :param a: Numerator
+    :param b: Denominator, overwritten with the result
+    :return: b
+    """
+    return xp.divide(a, b, out=b, where=b != 0)
+
+
 def ndis(x, y, s):
     return np.exp(-(x - y) * (x - y) / (2.0 * s * s))
 
 
-def cconv2D_preB(a, B):
-    A = fft_fun(a)
-    C = A * B
-    c = ifft_fun(C, a.shape)
-    return xp.abs(c)
+def cconv2D_preB(a, B, workers=None):
+    A = fft_fun(a, workers)
+    A *= B
+    c = ifft_fun(A, a.shape, workers, overwrite_x=True)
+    return xp.abs(c, out=c)
 
 
 def softmax(I, beta):
@@ -124,6 +136,13 @@ class UniDecCD(engine.UniDec):
         self.exemode = True
         self.massaxis = None
         self.invinjtime = None
+        # Memory-mapped ion store for the raw ions and a sorted m/z index on farray
+        self.ionstore = None
+        self.farray_index = None
+        # Number of threads for the FFTs in decon_core. -1 uses all cores.
+        self.workers = -1
+        # Sparse matrices for the mass transforms, kept until the axes change
+        self.transform_matrices = {}
         pass
 
     def exe_mode(self, exemode=True):
@@ -159,7 +178,9 @@ class UniDecCD(engine.UniDec):
 
         The min and max m/z values are set from the darray.
 
-        Then, saves a numpy compressed file if it doesn't exist for faster imports in the future.
+        Then, saves a memory-mapped ion store (if self.config.CDionstore is 1) or a numpy compressed file if it doesn't
+        exist for faster imports in the future. If the ion store is found, it is opened instead of the file, and the
+        darray is a memory-mapped view of it.
         Finally, it opens the config file if found in the _unidecfiles folder.
 
         :param path: File path to open.
@@ -170,6 +191,14 @@ class UniDecCD(engine.UniDec):
         self.path = path
         # Set up unidec paths
         self.before_open(refresh=refresh)
+        self.ionstore = None
+
+        # Open the ion store if it was saved before, which skips reading and decompressing the file
+        if self.config.CDionstore == 1 and not refresh and ion_store.IonStore.exists(self.config.cdionstoredir):
+            print("Ion store found:", self.config.cdionstoredir)
+            self.open_ionstore(self.config.cdionstoredir)
+            self.after_open(starttime)
+            return
 
         if os.path.isdir(self.path):
             self.path = self.convert_stori(self.path)
@@ -386,13 +415,52 @@ class UniDecCD(engine.UniDec):
         self.config.minmz = np.amin(mz)
         self.config.maxmz = np.amax(mz)
 
+        if self.config.CDionstore == 1:
+            # Create the ion store and use its memory-mapped view in place of the darray
+            try:
+                self.ionstore = ion_store.IonStore.create(self.config.cdionstoredir, self.darray, noise=self.noise,
+                                                          mzrange=[self.config.minmz, self.config.maxmz])
+                self.darray = self.ionstore.darray
+                self.data.rawdata = self.darray[:, :2]
+            except Exception as e:
+                print("Could not create ion store:", e)
+                self.ionstore = None
+
         # Create the npz file of the extracted values if it doens't exist
-        if not os.path.isfile(self.config.cdrawextracts) or refresh:
+        if self.ionstore is None and (not os.path.isfile(self.config.cdrawextracts) or refresh):
             try:
                 np.savez_compressed(self.config.cdrawextracts, data=self.darray)
             except Exception as e:
                 pass
 
+        self.after_open(starttime)
+
+    def open_ionstore(self, directory):
+        """
+        Open previously imported ions from a memory-mapped ion store. The darray and farray are read-only
+        memory-mapped views, so the ions are only read from disk as they are used.
+        :param directory: Ion store folder
+        :return: None
+        """
+        self.ionstore = ion_store.IonStore(directory)
+        self.darray = self.ionstore.darray
+        # Check for empty data
+        if ud.isempty(self.darray):
+            print("Error: Data Array is Empty")
+            raise ImportError
+        self.invinjtime = self.darray[:, 3]
+        self.thermodata = False
+        self.noise = self.ionstore.noise
+        self.farray = self.darray
+        self.data.rawdata = self.darray[:, :2]
+        self.config.minmz, self.config.maxmz = self.ionstore.mzrange
+
+    def after_open(self, starttime):
+        """
+        Finish opening a CD-MS file by loading or exporting the config.
+        :param starttime: Time the opening started from time.perf_counter()
+        :return: None
+        """
         self.config.cdmsflag = 1
         # Load the config if you can find it
         if os.path.isfile(self.config.confname):
@@ -478,29 +546,35 @@ class UniDecCD(engine.UniDec):
         :return: None
         """
         starttime = time.perf_counter()
-        # Copy filtered array and delete peaks.
-        self.farray = deepcopy(self.darray)
         self.pks = peakstructure.Peaks()
+        scanrange = self.get_scan_range()
+        mzrange = np.abs([self.config.minmz, self.config.maxmz])
+
+        if self.using_ionstore():
+            # Select the scan and m/z ranges with the ion store indexes and only read those ions
+            print("Filtering m/z range:", self.config.minmz, self.config.maxmz, "Start Length:", len(self.darray))
+            index = self.ionstore.select(mzrange=mzrange, scanrange=scanrange)
+            self.farray = self.ionstore.take(index)
+            # Compress Scans
+            if self.config.CDScanCompress > 1:
+                self.farray[:, 2] = np.floor(self.farray[:, 2] / self.config.CDScanCompress)
+        else:
+            # Copy filtered array
+            self.farray = deepcopy(self.darray)
 
-        # Filter Scans
-        try:
-            if int(self.config.CDScanStart) > 0:
-                self.farray = self.farray[self.farray[:, 2] > self.config.CDScanStart]
-        except:
-            pass
-        try:
-            if int(self.config.CDScanEnd) > 0:
-                self.farray = self.farray[self.farray[:, 2] < self.config.CDScanEnd]
-        except:
-            pass
+            # Filter Scans
+            if scanrange[0] is not None:
+                self.farray = self.farray[self.farray[:, 2] > scanrange[0]]
+            if scanrange[1] is not None:
+                self.farray = self.farray[self.farray[:, 2] < scanrange[1]]
 
-        # Compress Scans
-        if self.config.CDScanCompress > 1:
-            self.farray[:, 2] = np.floor(self.farray[:, 2] / self.config.CDScanCompress)
+            # Compress Scans
+            if self.config.CDScanCompress > 1:
+                self.farray[:, 2] = np.floor(self.farray[:, 2] / self.config.CDScanCompress)
 
-        # Filter m/z
-        print("Filtering m/z range:", self.config.minmz, self.config.maxmz, "Start Length:", len(self.farray))
-        self.filter_mz(mzrange=np.abs([self.config.minmz, self.config.maxmz]))
+            # Filter m/z
+            print("Filtering m/z range:", self.config.minmz, self.config.maxmz, "Start Length:", len(self.farray))
+            self.filter_mz(mzrange=mzrange)
 
         # Filter Centroids
         print("Filtering centroids:", self.config.CDres, "Start Length:", len(self.farray))
@@ -527,6 +601,43 @@ class UniDecCD(engine.UniDec):
             return 0
         print("Process Time:", time.perf_counter() - starttime)
 
+    def get_scan_range(self):
+        """
+        Get the scan range from self.config.CDScanStart and self.config.CDScanEnd. Scans are kept if strictly inside.
+        :return: [start, end], with None for either if not set
+        """
+        scanrange = [None, None]
+        try:
+            if int(self.config.CDScanStart) > 0:
+                scanrange[0] = self.config.CDScanStart
+        except:
+            pass
+        try:
+            if int(self.config.CDScanEnd) > 0:
+                scanrange[1] = self.config.CDScanEnd
+        except:
+            pass
+        return scanrange
+
+    def using_ionstore(self):
+        """
+        Check whether self.darray is the memory-mapped view of self.ionstore.
+        :return: True if range queries on the ion store can be used in place of self.darray
+        """
+        return self.ionstore is not None and self.darray is not None and self.darray.base is self.ionstore.ions
+
+    def farray_mz_index(self, mzrange, inclusive=True):
+        """
+        Find the ions in self.farray within an m/z range using a sorted m/z index, which is built once for each farray.
+        :param mzrange: [low, high] m/z
+        :param inclusive: If True (default), keep low <= m/z <= high. If False, keep low < m/z < high.
+        :return: Indexes of the ions in self.farray, in m/z order
+        """
+        if self.farray_index is None or self.farray_index[0] is not self.farray:
+            order = np.argsort(self.farray[:, 0], kind="stable")
+            self.farray_index = (self.farray, self.farray[order, 0], order)
+        return ion_store.range_index(self.farray_index[1], self.farray_index[2], mzrange[0], mzrange[1], inclusive)
+
     def harray_process(self, transform=True):
         self.data.data2 = np.transpose([self.mz, np.sum(self.harray, axis=0)])
         np.savetxt(self.config.infname, self.data.data2)
@@ -818,6 +929,60 @@ class UniDecCD(engine.UniDec):
         massaxis = np.arange(minval, maxval, self.config.massbins)
         return massaxis
 
+    def get_transform_matrix(self, massaxis, mass=None, keep="z", method="integrate"):
+        """
+        Get a sparse matrix that projects a flattened charge x m/z histogram onto the mass axis.
+        The matrix is built once and reused until the mass grid or mass axis changes.
+        :param massaxis: Mass axis
+        :param mass: Mass of each point in the histogram, charge x m/z. Default is self.mass.
+        :param keep: "z" to give a mass x charge grid, as in transform. "mz" to give a mass x m/z grid.
+        :param method: "integrate" (ud.lintegrate), "interpolate" (ud.linterpolate), or "nearest" (sum into the
+        nearest mass bin)
+        :return: CSR matrix of shape (len(massaxis) * length of kept axis, mass.size)
+        """
+        if mass is None:
+            mass = self.mass
+        mass = np.asarray(mass)
+        massaxis = np.asarray(massaxis)
+        key = (keep, method)
+        if key in self.transform_matrices:
+            oldmass, oldaxis, matrix = self.transform_matrices[key]
+            if np.array_equal(oldmass, mass) and np.array_equal(oldaxis, massaxis):
+                return matrix
+
+        nz, nmz = mass.shape
+        cells = np.arange(mass.size).reshape(mass.shape)
+        if keep == "z":
+            nkeep = nz
+            keepindex = np.repeat(np.arange(nz), nmz)
+            lines = [(cells[i], i) for i in range(nz)]
+        else:
+            nkeep = nmz
+            keepindex = np.tile(np.arange(nmz), nz)
+            lines = [(cells[:, i], i) for i in range(nmz)]
+
+        if method == "interpolate":
+            # Interpolation depends on the neighbors along each line, so build the matrix one line at a time
+            rows, cols, vals = [], [], []
+            for c, i in lines:
+                newindex, lo, hi, frac = ud.linterpolate_weights(np.ravel(mass)[c], massaxis)
+                rows.extend([newindex * nkeep + i] * 2)
+                cols.extend([c[lo], c[hi]])
+                vals.extend([1 - frac, frac])
+            rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+        elif method == "nearest":
+            cols = np.arange(mass.size)
+            rows = ud.nearest_array(massaxis, np.ravel(mass)) * nkeep + keepindex
+            vals = np.ones(mass.size)
+        else:
+            sub = ud.lintegrate_matrix(np.ravel(mass), massaxis).tocoo()
+            rows = sub.row * nkeep + keepindex[sub.col]
+            cols = sub.col
+            vals = sub.data
+        matrix = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(massaxis) * nkeep, mass.size))
+        self.transform_matrices[key] = (mass.copy(), massaxis.copy(), matrix)
+        return matrix
+
     def transform(self, harray=None, dataobj=None, ztab=None, mass=None, mz=None):
         if harray is None:
             harray = self.harray
@@ -839,23 +1004,18 @@ class UniDecCD(engine.UniDec):
 
         massaxis = self.create_mass_axis(harray, mass=mass)
 
-        # Create the mass grid
-        dataobj.massgrid = []
-        for i in range(len(ztab)):
-            d = harray[i]
-            if self.config.poolflag == 1:
-                newdata = np.atleast_2d(np.transpose([mass[i], d]))
-                massdata = ud.linterpolate(newdata, massaxis)
-            else:
-                boo1 = d > 0
-                newdata = np.transpose([mass[i][boo1], d[boo1]])
-                if len(newdata) < 2:
-                    massdata = np.transpose([massaxis, massaxis * 0])
-                else:
-                    massdata = ud.lintegrate(newdata, massaxis)
-
-            dataobj.massgrid.append(massdata[:, 1])
-        dataobj.massgrid = np.transpose(dataobj.massgrid)
+        # Create the mass grid by projecting each charge state onto the mass axis with one sparse matrix product
+        harray = np.asarray(harray)
+        if self.config.poolflag == 1:
+            matrix = self.get_transform_matrix(massaxis, mass, keep="z", method="interpolate")
+            h = harray
+        else:
+            matrix = self.get_transform_matrix(massaxis, mass, keep="z", method="integrate")
+            # Only positive points are integrated, and charge states with less than two are left empty
+            boo1 = harray > 0
+            h = np.where(boo1, harray, 0)
+            h[np.sum(boo1, axis=1) < 2] = 0
+        dataobj.massgrid = np.reshape(matrix @ np.ravel(h), (len(massaxis), len(ztab)))
         # Create the linearized mass data by integrating everything into the new linear axis
         dataobj.massdat = np.transpose([massaxis, np.sum(dataobj.massgrid, axis=1)])
         if flag:
@@ -885,21 +1045,26 @@ class UniDecCD(engine.UniDec):
         massaxis = self.data.massdat[:, 0]
         print("m/z Length:", len(self.mz))
         print("Mass Length:", len(massaxis))
-        # Create the mass grid
-        self.data.mzmassgrid = []
-        for i in range(len(self.mz)):
-            d = self.harray[:, i]
-            boo1 = d >= 0
-            newdata = np.transpose([self.mass[:, i][boo1], d[boo1]])
-            # if :
-            #    self.data.mzmassgrid.append(massaxis * 0)
-            # else:
-            if self.config.poolflag == 1 and len(newdata) >= 2:
-                massdata = ud.linterpolate(newdata, massaxis)
-            else:
-                massdata = ud.lintegrate(newdata, massaxis)
-            self.data.mzmassgrid.append(massdata[:, 1])
-        self.data.mzmassgrid = np.transpose(self.data.mzmassgrid)
+        harray = np.asarray(self.harray)
+        boo1 = harray >= 0
+        if self.config.poolflag == 1 and len(self.ztab) >= 2:
+            # Interpolating across charge states fills most of the mass grid, so a projection matrix would be as
+            # large as the output. Interpolate each m/z column instead.
+            self.data.mzmassgrid = []
+            for i in range(len(self.mz)):
+                d = harray[:, i]
+                newdata = np.transpose([self.mass[:, i][boo1[:, i]], d[boo1[:, i]]])
+                if len(newdata) >= 2:
+                    massdata = ud.linterpolate(newdata, massaxis)
+                else:
+                    massdata = ud.lintegrate(newdata, massaxis)
+                self.data.mzmassgrid.append(massdata[:, 1])
+            self.data.mzmassgrid = np.transpose(self.data.mzmassgrid)
+        else:
+            # Create the mass grid by integrating each m/z column onto the mass axis with one sparse matrix product
+            matrix = self.get_transform_matrix(massaxis, self.mass, keep="mz", method="integrate")
+            h = np.where(boo1, harray, 0)
+            self.data.mzmassgrid = np.reshape(matrix @ np.ravel(h), (len(massaxis), len(self.mz)))
         print("Created m/z vs. Mass: ", self.data.mzmassgrid.shape)
         pass
 
@@ -991,34 +1156,70 @@ class UniDecCD(engine.UniDec):
         self.upperindex = np.array(upperindex, dtype=int)
         self.lowerindex = np.array(lowerindex, dtype=int)
 
-    def filter_zdist(self, I, setup=True):
+        # Flat indexes into the intensity array. Z+1 of the top charge state and Z-1 of the bottom use their own row.
+        rows = np.arange(len(self.ztab))
+        upperrows = np.minimum(rows + 1, len(rows) - 1)
+        lowerrows = np.maximum(rows - 1, 0)
+        self.zupperflat = upperrows[:, np.newaxis] * lm + self.upperindex
+        self.zlowerflat = lowerrows[:, np.newaxis] * lm + self.lowerindex
+
+    def filter_zdist(self, I, setup=True, buffers=None):
+        """
+        Smooth the charge state distribution by combining each point with its Z+1 and Z-1 neighbors at the same mass.
+        :param I: Intensity array
+        :param setup: Whether to calculate the neighbor indexes first with setup_zsmooth
+        :param buffers: Optional pair of arrays the same shape as I to reuse as work space.
+        If given, the result is written into I.
+        :return: Filtered intensity array
+        """
         if setup:
             self.setup_zsmooth()
+        return self.filter_neighbors(I, self.zupperflat, self.zlowerflat, self.config.zzsig, buffers)
 
-        # Get the intensities of the Z+1 values
-        upperints = xp.zeros_like(I)
-        for i, row in enumerate(self.upperindex):
-            if i + 1 != len(I):
-                upperints[i] = I[i + 1, row]
-            else:
-                upperints[i] = I[i, row]
-
-        # Get the intensities of the Z-1 values
-        lowerints = xp.zeros_like(I)
-        for i, row in enumerate(self.lowerindex):
-            if i != 0:
-                lowerints[i] = I[i - 1, row]
-            else:
-                lowerints[i] = I[i, row]
+    def filter_neighbors(self, I, upperflat, lowerflat, floor, buffers=None):
+        """
+        Combine each point of I with the points at the flat indexes upperflat and lowerflat.
+        If floor is positive, takes the geometric mean with floor added.
+        If floor is negative, takes the mean with the neighbors weighted by abs(floor).
+        :param I: Intensity array
+        :param upperflat: Flat indexes of the upper neighbors, same shape as I
+        :param lowerflat: Flat indexes of the lower neighbors, same shape as I
+        :param floor: zzsig or msig value
+        :param buffers: Optional pair of arrays the same shape as I to reuse as work space.
+        If given, the result is written into I.
+        :return: Filtered intensity array
+        """
+        if buffers is None:
+            upperints = xp.empty_like(I)
+            lowerints = xp.empty_like(I)
+            out = None
+        else:
+            upperints, lowerints = buffers
+            out = I
+        xp.take(I, upperflat, out=upperints)
+        xp.take(I, lowerflat, out=lowerints)
 
-        floor = self.config.zzsig
         if floor > 0:
-            I = xp.clip(xp.exp(
-                xp.mean(xp.asarray([xp.log(upperints + floor), xp.log(lowerints + floor), xp.log(I + floor)]), axis=0))
-                        - floor, 0, None)
+            # Mean of the logs, added in the same order as np.mean over [upper, lower, I]
+            upperints += floor
+            xp.log(upperints, out=upperints)
+            lowerints += floor
+            xp.log(lowerints, out=lowerints)
+            upperints += lowerints
+            xp.add(I, floor, out=lowerints)
+            xp.log(lowerints, out=lowerints)
+            upperints += lowerints
+            upperints /= 3
+            xp.exp(upperints, out=upperints)
+            upperints -= floor
+            I = xp.clip(upperints, 0, None, out=out)
         else:
             ratio = xp.abs(floor)
-            I = (upperints * ratio + I + lowerints * ratio) / 3.
+            upperints *= ratio
+            upperints += I
+            lowerints *= ratio
+            upperints += lowerints
+            I = xp.divide(upperints, 3., out=out)
         return I
 
     def setup_msmooth(self):
@@ -1038,24 +1239,23 @@ class UniDecCD(engine.UniDec):
         self.mupperindexes = upperindexes
         self.mlowerindexes = lowerindexes
 
-    def filter_mdist(self, I, setup=True):
+        # Flat indexes into the intensity array
+        rowstarts = np.arange(len(self.ztab))[:, np.newaxis] * lmz
+        self.mupperflat = rowstarts + upperindexes
+        self.mlowerflat = rowstarts + lowerindexes
+
+    def filter_mdist(self, I, setup=True, buffers=None):
+        """
+        Smooth the mass distribution by combining each point with the points one oligomer mass above and below.
+        :param I: Intensity array
+        :param setup: Whether to calculate the neighbor indexes first with setup_msmooth
+        :param buffers: Optional pair of arrays the same shape as I to reuse as work space.
+        If given, the result is written into I.
+        :return: Filtered intensity array
+        """
         if setup:
             self.setup_msmooth()
-
-        upperints = xp.array([d[self.mupperindexes[i]] for i, d in enumerate(I)])
-        lowerints = xp.array([d[self.mlowerindexes[i]] for i, d in enumerate(I)])
-
-        floor = self.config.msig
-        if floor > 0:
-            I = xp.clip(xp.exp(
-                xp.mean(xp.array([xp.log(upperints + floor), xp.log(lowerints + floor), xp.log(I + floor)]),
-                        axis=0)) - floor,
-                        0, None)
-        else:
-            ratio = xp.abs(floor)
-            I = (upperints * ratio + I + lowerints * ratio) / 3.
-
-        return I
+        return self.filter_neighbors(I, self.mupperflat, self.mlowerflat, self.config.msig, buffers)
 
     def decon_core(self):
         """
@@ -1065,12 +1265,15 @@ class UniDecCD(engine.UniDec):
         # Create a working array of intensity values
         I = deepcopy(self.harray)
         D = deepcopy(self.harray)
+        # Work space for the filters, reused on every iteration
+        buffers = (xp.empty_like(I), xp.empty_like(I))
+        workers = self.workers
 
         # Perform the FFTs for convolution and correlation kernels
-        ftk = fft_fun(self.kernel)
-        ftck = fft_fun(self.ckernel)
+        ftk = fft_fun(self.kernel, workers)
+        ftck = fft_fun(self.ckernel, workers)
         if self.config.psig != 0:
-            ftmk = fft_fun(self.mkernel2)
+            ftmk = fft_fun(self.mkernel2, workers)
 
         # Set up the while loop
         i = 0
@@ -1083,7 +1286,7 @@ class UniDecCD(engine.UniDec):
 
             # Point Smoothing
             if self.config.psig > 0:
-                I = cconv2D_preB(I, ftmk)
+                I = cconv2D_preB(I, ftmk, workers)
 
             # Run the smooth charge state filter and smooth mass filter. Set up the dist if needed.
             if i == 0:
@@ -1093,15 +1296,16 @@ class UniDecCD(engine.UniDec):
 
             if self.config.zzsig != 0:
                 if self.config.CDzbins == 1:  # Zdist smoothing currently only defined for unit charge bins
-                    I = self.filter_zdist(I, setup)
+                    I = self.filter_zdist(I, setup, buffers)
                 else:
                     print("Error: Charge Bins Size must be 1 for Charge State Smoothing")
             if self.config.msig != 0:
-                I = self.filter_mdist(I, setup)
+                I = self.filter_mdist(I, setup, buffers)
 
             # Classic Richardson-Lucy Algorithm here. Most the magic happens in this one line...
             if self.config.mzsig != 0 or self.config.csig != 0:
-                newI = I * cconv2D_preB(safedivide(D, cconv2D_preB(I, ftk)), ftck)
+                newI = cconv2D_preB(safedivide_inplace(D, cconv2D_preB(I, ftk, workers)), ftck, workers)
+                newI *= I
                 # newI = I * safedivide(D, cconv2D_preB(I, ftk))
 
                 if i > 10:
@@ -1116,7 +1320,7 @@ class UniDecCD(engine.UniDec):
             I /= xp.amax(I)
 
         # Get the reconvolved data
-        recon = cconv2D_preB(I, ftk)
+        recon = cconv2D_preB(I, ftk, workers)
 
         # Get the fit data in 1D for the DScore calc
         self.data.fitdat = np.sum(recon, axis=0)
@@ -1125,8 +1329,8 @@ class UniDecCD(engine.UniDec):
 
         if self.config.mzsig > 0 and self.config.rawflag == 0:
             # Reconvolved/Profile: Reconvolves with the peak shape in the mass dimension only
-            ftmk = fft_fun(self.mkernel)
-            recon2 = cconv2D_preB(I, ftmk)
+            ftmk = fft_fun(self.mkernel, workers)
+            recon2 = cconv2D_preB(I, ftmk, workers)
             self.harray = recon2
         else:
             # Raw/Centroid: Takes the deconvolved data straight
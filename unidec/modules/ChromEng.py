@@ -3,6 +3,9 @@ import numpy as np
 import unidec.tools as ud
 from unidec.metaunidec.mudeng import MetaUniDec
 from unidec.engine import UniDec
+from unidec.modules.mzMLimporter import mzMLimporter
+from unidec.modules.mzXML_importer import mzXMLimporter
+from unidec.modules.chrom_cube import ScanPrefixSum
 from copy import deepcopy
 
 chrom_file_exts = [".raw", ".Raw", ".RAW", ".d", ".mzML.gz", ".mzML"]
@@ -25,6 +28,7 @@ class ChromEngine(MetaUniDec):
         self.dirname = None
         self.path = None
         self.chromdat = None
+        self.chromcube = None
         self.tic = None
         self.ticdat = None
         self.spectra = None
@@ -89,6 +93,7 @@ class ChromEngine(MetaUniDec):
         self.update_history()
 
         self.chromdat = ud.get_importer(path)
+        self.chromcube = None
         self.auto_polarity(path, self.chromdat)
         self.tic = self.chromdat.get_tic()
         self.ticdat = np.array(self.tic)
@@ -96,11 +101,14 @@ class ChromEngine(MetaUniDec):
         return hdf5
 
     def get_data_from_scans(self, scan_range=None):
-        self.mzdata = self.chromdat.get_data(scan_range)
+        if self.chromcube is not None and scan_range is not None and scan_range[1] > scan_range[0]:
+            self.mzdata = self.chromcube.get_data(scan_range)
+        else:
+            self.mzdata = self.chromdat.get_data(scan_range)
         self.procdata = None
         return self.mzdata
 
-    def get_data_from_times(self, minval, maxval):
+    def get_scans_from_times(self, minval, maxval):
         minscan = ud.nearest(self.ticdat[:, 0], minval)
         if self.ticdat[minscan, 0] < minval:
             minscan += 1
@@ -109,6 +117,10 @@ class ChromEngine(MetaUniDec):
             maxscan -= 1
         if maxscan <= minscan:
             maxscan = minscan + 1
+        return minscan, maxscan
+
+    def get_data_from_times(self, minval, maxval):
+        minscan, maxscan = self.get_scans_from_times(minval, maxval)
         self.scans = [minscan, maxscan, minval, maxval]
 
         attrs = {"timestart": minval, "timeend": maxval,
@@ -120,6 +132,32 @@ class ChromEngine(MetaUniDec):
         self.get_data_from_scans([minscan, maxscan])
         return self.mzdata
 
+    def setup_chromcube(self, starts, ends):
+        """
+        Build the scan prefix sums (chrom_cube.ScanPrefixSum) before extracting a set of time windows, so that each
+        window is one subtraction rather than a new merge of its scans. The prefix sums are only built if
+        config.chromcube is on, the data are mzML or mzXML, and the windows together cover more scans than the file
+        has. They are kept until a new file is loaded.
+        :param starts: Start times of the windows
+        :param ends: End times of the windows
+        :return: None
+        """
+        if self.chromcube is not None or not self.config.chromcube:
+            return
+        if not isinstance(self.chromdat, (mzMLimporter, mzXMLimporter)):
+            return
+        total = 0
+        for t0, t1 in zip(starts, ends):
+            minscan, maxscan = self.get_scans_from_times(t0, t1)
+            total += maxscan - minscan + 1
+        if total <= len(self.ticdat):
+            return
+        try:
+            self.chromcube = ScanPrefixSum.from_importer(self.chromdat, directory=self.dirname)
+        except Exception as e:
+            print("Could not build scan prefix sums:", e)
+            self.chromcube = None
+
     def get_minmax_times(self):
         return np.amin(self.ticdat[:, 0]), np.amax(self.ticdat[:, 0])
 
@@ -197,6 +235,7 @@ class ChromEngine(MetaUniDec):
             times = times[boo3]
 
         self.data.clear()
+        self.setup_chromcube(times, times + self.config.time_window)
         for i, t in enumerate(times):
             data = self.get_data_from_times(t, t + self.config.time_window)
             self.data.add_data(data, name=str(t), attrs=self.attrs, export=False)
@@ -212,6 +251,8 @@ class ChromEngine(MetaUniDec):
             times = times[boo3]
 
         self.data.clear()
+        if len(times) > 0:
+            self.setup_chromcube(times[:, 0], times[:, 1])
         for i, t in enumerate(times):
             data = self.get_data_from_times(t[0], t[1])
             self.data.add_data(data, name=str(t[0]), attrs=self.attrs, export=False)
@@ -221,6 +262,7 @@ class ChromEngine(MetaUniDec):
             self.config.sw_scan_offset = 1
         tindex = np.arange(0, len(self.ticdat), int(self.config.sw_scan_offset))
         self.data.clear()
+        times = []
         for i in tindex:
             t = self.ticdat[i, 0]
 
@@ -230,13 +272,18 @@ class ChromEngine(MetaUniDec):
             if self.config.time_end is not None:
                 if t + self.config.sw_time_window > self.config.time_end:
                     continue
+            times.append(t)
 
+        times = np.array(times)
+        self.setup_chromcube(times, times + self.config.sw_time_window)
+        for t in times:
             data = self.get_data_from_times(t, t + self.config.sw_time_window)
             self.data.add_data(data, name=str(t), attrs=self.attrs, export=False)
         pass
 
     def add_list_times(self, starts, ends):
         self.data.clear()
+        self.setup_chromcube(starts, ends)
         for i, t in enumerate(starts):
             data = self.get_data_from_times(t, ends[i])
             self.data.add_data(data, name=str(t), attrs=self.attrs, export=False)
@@ -107,7 +107,7 @@ class DoubleDec:
         self.data = np.loadtxt(datapath)
 
     def kimport(self, kernelpath):
-        self.kernel = np.loadtxt(kernelpath)
+        self.kernel = ud.load_txt_cached(kernelpath)
         self.kdata = deepcopy(self.kernel)
 
     def Extract(self, data, basemass=41983, m1=762, m2=63, m1range=None, m2range=None, exmethod=1, window=10):
@@ -1,4 +1,5 @@
 import time
+import os
 
 import numpy as np
 import scipy.ndimage
@@ -9,6 +10,7 @@ from unidec.modules.ChromEng import *
 from unidec.modules.IM_functions import calc_linear_ccs, calc_linear_ccsconst
 import unidec.tools as ud
 from unidec.modules.unidecstructure import UniDecConfig
+from unidec.modules import cube_storage
 
 import matplotlib.pyplot as plt
 import scipy.fft as fft
@@ -48,6 +50,8 @@ class HTEng:
         self.decontime = []
         self.deconscans = []
         self.dtype = float
+        # Number of threads for the FFTs. -1 uses all cores.
+        self.workers = -1
 
         # Index Values
         self.padindex = 0
@@ -247,6 +251,7 @@ class HTEng:
         """
         Overarching function to demultiplex data. Calls each demultiplexing type based on config parameter
         :param data: 1D array of data to be deconvolved. Should be same dimension as self.htkernel if HT mode.
+        Can also be a 2D array of traces (one per row) to demultiplex all of them at once along the last axis.
         :param mode: Type of demultiplexing. Default is HT.
         :param kwargs: Additional keyword arguments.
         :return: Demultiplexed data. Same length as input.
@@ -270,13 +275,13 @@ class HTEng:
             if self.config.HToutputub > 0:
                 # find index of first peak greater than self.config.HToutputub
                 i1 = np.argmax(self.decontime > self.config.HToutputub)
-                output = output[:i1]
+                output = output[..., :i1]
                 self.decontime = self.decontime[:i1]
                 self.deconscans = self.deconscans[:i1]
             if self.config.HToutputlb > 0:
                 # find index of first peak greater than self.config.HToutputlb
                 i2 = np.argmax(self.decontime > self.config.HToutputlb)
-                output = output[i2:]
+                output = output[..., i2:]
                 self.decontime = self.decontime[i2:]
                 self.deconscans = self.deconscans[i2:]
 
@@ -303,6 +308,7 @@ class HTEng:
         """
         Deconvolve the data using the HT kernel. Need to call setup_ht first.
         :param data: 1D array of data to be deconvolved. Should be same dimension as self.htkernel.
+        Can also be a 2D array with one trace per row, which are all deconvolved along the last axis in one FFT.
         :param kwargs: Keyword arguments. Currently supports "normalize" which normalizes the output to the maximum
         value. Also supports "gsmooth" which smooths the data with a Gaussian filter before deconvolution.
         Also supports "sgsmooth" which smooths the data with a Savitzky-Golay filter before deconvolution.
@@ -318,23 +324,26 @@ class HTEng:
 
         # Set the range of indexes used in the deconvolution
         # Starts at the pad but shift will move it back
-        self.indexrange = [self.padindex - self.shiftindex, len(data) - self.shiftindex]
+        datalen = np.shape(data)[-1]
+        self.indexrange = [self.padindex - self.shiftindex, datalen - self.shiftindex]
         # print("Index Range:", self.indexrange, "Pad Index:", self.padindex, "Shift Index:", self.shiftindex, "Data Length:", len(data))
 
         # Do the convolution
-        output = fft.irfft(fft.rfft(data[self.indexrange[0]:self.indexrange[1]]) * self.fftk).real
+        subdata = data[..., self.indexrange[0]:self.indexrange[1]]
+        output = fft.irfft(fft.rfft(subdata, workers=self.workers) * self.fftk, workers=self.workers).real
         # If output is odd, add a 0 to the end
-        if len(output) < len(data[self.indexrange[0]:self.indexrange[1]]):
-            output = np.append(output, 0)
+        if output.shape[-1] < subdata.shape[-1]:
+            output = np.concatenate((output, np.zeros(output.shape[:-1] + (1,))), axis=-1)
         # print(len(output), len(data[self.indexrange[0]:self.indexrange[1]]))
         # Shift the output back to the original time
         if self.padindex > 0:
             # add zeros back on the front and roll to the correct index
-            output = np.roll(np.concatenate((np.zeros(self.padindex), output)), self.rollindex)
+            output = np.concatenate((np.zeros(output.shape[:-1] + (self.padindex,)), output), axis=-1)
+            output = np.roll(output, self.rollindex, axis=-1)
         # print(np.shape(data), np.shape(output))
         if "normalize" in kwargs:
             if kwargs["normalize"]:
-                output /= np.amax(output)
+                output /= np.amax(output, axis=-1, keepdims=True)
         # Return demultiplexed data
         return output, data
 
@@ -430,7 +439,8 @@ class HTEng:
     def ftdecon(self, data, flatten=None, apodize=None, aFT=False, normalize=False, nzp=None, keepcomplex=False):
         """
         Perform Fourier Transform Deconvolution
-        :param data: 1D data array of y-data only
+        :param data: 1D data array of y-data only.
+        Can also be a 2D array with one trace per row, which are all transformed along the last axis in one FFT.
         :param flatten: Whether to flatten the TIC before demultiplexing to remove low frequency components
         :param apodize: Whether to apodize the data with a Hanning window
         :param aFT: Whether to use Absorption FT mode
@@ -440,9 +450,11 @@ class HTEng:
         """
         if np.amax(data) == 0:
             if keepcomplex:
-                return np.zeros(len(self.decontime), dtype=self.dtype), data
+                return np.zeros(np.shape(data)[:-1] + (len(self.decontime),), dtype=self.dtype), data
             else:
-                return data[:len(self.decontime)], data
+                return data[..., :len(self.decontime)], data
+        # Traces that are all zero are returned as is, same as above
+        empty = np.amax(data, axis=-1) == 0
 
         if flatten is not None:
             self.config.FTflatten = flatten
@@ -455,7 +467,7 @@ class HTEng:
             if self.config.HTksmooth < 4:
                 self.config.HTksmooth = 4
                 print("Warning: FT smoothing kernel too small. Setting to 4.")
-            if self.config.HTksmooth > len(y) - 1:
+            if self.config.HTksmooth > y.shape[-1] - 1:
                 self.config.HTksmooth = 10
                 print("Warning: FT smoothing kernel too long. Setting to 10.")
             y = scipy.signal.savgol_filter(y, int(np.round(float(self.config.HTksmooth))), 3)
@@ -469,27 +481,27 @@ class HTEng:
 
         if self.config.FTapodize == 1:
             # create hanning window
-            hanning = np.hanning(len(y) * 2)
-            y = y * hanning[len(y):]
+            hanning = np.hanning(y.shape[-1] * 2)
+            y = y * hanning[y.shape[-1]:]
 
         if self.config.FTflatten:
             # fit trendline to y and subtract to eliminate low frequency components
             ytrnd = scipy.signal.savgol_filter(y, 15, 3)
             y = y - ytrnd
 
-        original_len = len(y)
+        original_len = y.shape[-1]
         if nzp > 0 and self.config.FTapodize:
-            pad_len = int(2 ** math.ceil(math.log2(int(len(y)))) * nzp)
-            z = np.zeros(pad_len)
-            z[:len(y)] = y
+            pad_len = int(2 ** math.ceil(math.log2(int(original_len))) * nzp)
+            z = np.zeros(y.shape[:-1] + (pad_len,))
+            z[..., :original_len] = y
             y = z
 
         # Fourier Transform
-        Y = np.fft.rfft(y)
+        Y = fft.rfft(y, workers=self.workers)
 
         if aFT:
-            maxindex = np.argmax(np.abs(Y[5:])) + 5
-            phase = np.angle(Y[maxindex])
+            maxindex = np.argmax(np.abs(Y[..., 5:]), axis=-1) + 5
+            phase = np.angle(np.take_along_axis(Y, maxindex[..., np.newaxis], axis=-1))
             Y = Y * np.exp(-1j * phase)
             if not keepcomplex:
                 Y = np.real(Y)
@@ -498,9 +510,16 @@ class HTEng:
                 Y = np.abs(Y)
 
         if normalize:
-            Y /= np.amax(Y)
+            Y /= np.amax(Y, axis=-1, keepdims=True)
 
-        return Y, y[:original_len]
+        y = y[..., :original_len]
+        if np.any(empty):
+            Y[empty] = 0
+            if not keepcomplex:
+                n = min(Y.shape[-1], original_len)
+                Y[empty, :n] = data[empty, :n]
+            y[empty] = data[empty]
+        return Y, y
 
     def set_timepad_index(self, timepad):
         """
@@ -721,6 +740,29 @@ class UniChromCDEng(HTEng, UniDecCD):
         self.open_cdms_file(path, refresh=refresh)
         self.parse_file_name(path)
 
+    def make_cube(self, name, shape, dtype=float):
+        """
+        Create an empty data cube with the storage set by self.config.HTcubemode and the precision set by
+        self.config.HTcubefloat32. Memory-mapped cubes are written next to the output files.
+        :param name: Name of the cube, used for memory-mapped file names
+        :param shape: Shape of the cube
+        :param dtype: Data type before any conversion to single precision
+        :return: Cube
+        """
+        dtype = cube_storage.get_dtype(dtype, self.config.HTcubefloat32)
+        return cube_storage.make_cube(shape, dtype, self.config.HTcubemode, self.get_cube_dir(), prefix=name + "_")
+
+    def get_cube_dir(self):
+        """
+        Get the folder for memory-mapped data cubes.
+        :return: Folder path or None to use the system temporary folder
+        """
+        if self.config.outfname:
+            directory = os.path.dirname(os.path.abspath(self.config.outfname))
+            if os.path.isdir(directory):
+                return directory
+        return None
+
     def clear_arrays(self, massonly=False):
         """
         Clear arrays to reset.
@@ -737,6 +779,8 @@ class UniChromCDEng(HTEng, UniDecCD):
         self.mass_tic = None
         self.mass_tic_ht = None
         self.ccsstack_ht = None
+        # Delete memory-mapped cube files that are no longer in use
+        cube_storage.remove_temp_files()
 
     def prep_time_domain(self):
         """
@@ -782,23 +826,20 @@ class UniChromCDEng(HTEng, UniDecCD):
         # Prepare histogram
         self.prep_hist(mzbins=self.config.mzbins, zbins=self.config.CDzbins)
 
-        # Create a stack with one histogram for each scan
-        self.hstack = np.zeros((len(self.scans), self.topharray.shape[0], self.topharray.shape[1]))
-
         print("Creating Histograms for Each Scan", time.perf_counter() - starttime)
-        # Loop through scans and create histograms
-        for i, s in enumerate(self.scans):
-            # Pull out subset of data for this scan
-            b1 = self.topfarray[:, 2] == s
-
-            # Create histogram
-            harray = self.histogramLC(x=self.topfarray[b1, 0], y=self.topzarray[b1], w=self.topfarray[b1, 3])
-            harray = self.hist_data_prep(harray)
-
-            # Add histogram to stack
-            self.hstack[i] = harray
-
-        self.topharray = np.sum(self.hstack, axis=0)
+        if self.config.HTcubemode == cube_storage.dense_mode:
+            # Bin all ions into a scan x charge x m/z stack in one pass, then process all histograms at once
+            self.fullhstack = self.histogram_scans(x=self.topfarray[:, 0], y=self.topzarray,
+                                                   scans=self.topfarray[:, 2], w=self.topfarray[:, 3])
+            self.fullhstack = self.hist_data_prep_stack(self.fullhstack)
+            self.topharray = np.sum(self.fullhstack, axis=0)
+            if self.config.HTcubefloat32:
+                self.fullhstack = self.fullhstack.astype(cube_storage.get_dtype(float, True))
+        else:
+            # Build the stack a chunk of scans at a time into a memory-mapped or sparse cube
+            self.fullhstack, self.topharray = self.histogram_scans_cube(x=self.topfarray[:, 0], y=self.topzarray,
+                                                                        scans=self.topfarray[:, 2],
+                                                                        w=self.topfarray[:, 3])
 
         # Normalize the histogram
         if self.config.datanorm == 1:
@@ -809,11 +850,6 @@ class UniChromCDEng(HTEng, UniDecCD):
         # self.data.data3 = np.transpose([np.ravel(self.X, order="F"), np.ravel(self.Y, order="F"),
         #                                np.ravel(self.topharray, order="F")])
 
-        # create full hstack to fill any holes in the data for scans with no ions
-        self.fullhstack = np.zeros((len(self.fullscans), self.topharray.shape[0], self.topharray.shape[1]))
-        for i, s in enumerate(self.scans):
-            self.fullhstack[int(s) - 1] = self.hstack[i]
-
         print("Process Time HT:", time.perf_counter() - starttime)
 
     def prep_hist(self, mzbins=1, zbins=1, mzrange=None, zrange=None):
@@ -900,6 +936,111 @@ class UniChromCDEng(HTEng, UniDecCD):
         harray = np.transpose(harray)
         return harray
 
+    def histogram_scans(self, x, y, scans, w=None, start=0, nscans=None):
+        """
+        Histogram all ions into a stack with one histogram for each scan in self.fullscans.
+        Gives the same result as histogramLC on each scan, including empty histograms for scans with one ion or less.
+        :param x: x-axis (m/z) for each ion
+        :param y: y-axis (charge) for each ion
+        :param scans: Scan number for each ion
+        :param w: Weights for each ion, only used if self.config.CDiitflag is set
+        :param start: Index of the first scan in the stack. Default 0.
+        :param nscans: Number of scans in the stack. Default None goes to the end of self.fullscans.
+        :return: Histogram stack. Shape is scans vs. charge vs. m/z.
+        """
+        if nscans is None:
+            nscans = len(self.fullscans) - start
+        nz = len(self.zaxis) - 1
+        nmz = len(self.mzaxis) - 1
+        scanindex = np.asarray(scans).astype(int) - 1 - start
+
+        # Keep ions from scans with more than one ion, as in histogramLC
+        good = np.logical_and(scanindex >= 0, scanindex < nscans)
+        counts = np.bincount(scanindex[good], minlength=nscans)
+        good[good] = counts[scanindex[good]] > 1
+
+        # Find the bins the same way as np.histogram2d, with the last bin including the right edge
+        mzindex = np.searchsorted(self.mzaxis, x, side="right")
+        mzindex[x == self.mzaxis[-1]] -= 1
+        zindex = np.searchsorted(self.zaxis, y, side="right")
+        zindex[y == self.zaxis[-1]] -= 1
+        good = np.logical_and(good, np.logical_and(mzindex > 0, mzindex <= nmz))
+        good = np.logical_and(good, np.logical_and(zindex > 0, zindex <= nz))
+
+        index = (scanindex[good] * nz + zindex[good] - 1) * nmz + mzindex[good] - 1
+        if self.config.CDiitflag and w is not None and len(w) == len(x):
+            weights = w[good]
+        else:
+            weights = None
+        stack = np.bincount(index, weights=weights, minlength=nscans * nz * nmz).astype(float)
+        return np.reshape(stack, (nscans, nz, nmz))
+
+    def hist_data_prep_stack(self, stack, verbose=True):
+        """
+        Apply hist_data_prep to every histogram in a stack at once.
+        :param stack: Histogram stack. Shape is scans vs. charge vs. m/z. Modified in place.
+        :param verbose: Whether to print the processing steps. Default True.
+        :return: Processed histogram stack
+        """
+        if self.config.smooth > 0 or self.config.smoothdt > 0:
+            if verbose:
+                print("Histogram Smoothing:", self.config.smoothdt, self.config.smooth)
+            stack = scipy.ndimage.gaussian_filter(stack, [0, self.config.smoothdt, self.config.smooth])
+
+        if self.config.intthresh > 0:
+            if verbose:
+                print("Histogram Intensity Threshold:", self.config.intthresh)
+            stack = self.hist_int_threshold(stack, self.config.intthresh)
+        if self.config.reductionpercent > 0:
+            if verbose:
+                print("Histogram Data Reduction:", self.config.reductionpercent)
+            flat = np.reshape(stack, (len(stack), -1))
+            index = round(flat.shape[1] * self.config.reductionpercent / 100.)
+            cutoffs = np.partition(flat, index, axis=1)[:, index]
+            stack *= stack > cutoffs[:, np.newaxis, np.newaxis]
+
+        if self.config.subbuff > 0 or self.config.subbufdt > 0:
+            if verbose:
+                print("Histogram Background Subtraction:", self.config.subbuff, self.config.subbufdt)
+            for i in np.flatnonzero(np.any(stack, axis=(1, 2))):
+                stack[i] = IM_functions.subtract_complex_2d(stack[i].transpose(), self.config).transpose()
+
+        # Smashing masks on self.X and self.Y, so apply it to all scans at once with scans as the last axis
+        stack = self.hist_filter_smash(stack.transpose((1, 2, 0))).transpose((2, 0, 1))
+        return stack
+
+    def histogram_scans_cube(self, x, y, scans, w=None):
+        """
+        Histogram and process all scans a chunk of scans at a time, writing each chunk into a cube from make_cube.
+        Gives the same result as hist_data_prep_stack(histogram_scans(...)) without holding the full dense stack.
+        :param x: x-axis (m/z) for each ion
+        :param y: y-axis (charge) for each ion
+        :param scans: Scan number for each ion
+        :param w: Weights for each ion, only used if self.config.CDiitflag is set
+        :return: Processed histogram cube (scans vs. charge vs. m/z), Sum of all histograms (charge vs. m/z)
+        """
+        nscans = len(self.fullscans)
+        shape = (nscans, len(self.zaxis) - 1, len(self.mzaxis) - 1)
+        cube = self.make_cube("fullhstack", shape)
+        total = np.zeros(shape[1:])
+
+        # Sort the ions by scan so each chunk of scans is a contiguous block of ions
+        scanindex = np.asarray(scans).astype(int) - 1
+        order = np.argsort(scanindex, kind="stable")
+        sortedscans = scanindex[order]
+        for start, end in cube_storage.iter_chunks(nscans, cube_storage.chunk_rows(shape)):
+            i1, i2 = np.searchsorted(sortedscans, [start, end])
+            sel = order[i1:i2]
+            subw = w[sel] if w is not None and len(w) == len(x) else None
+            chunk = self.histogram_scans(x[sel], y[sel], scans[sel], w=subw, start=start, nscans=end - start)
+            chunk = self.hist_data_prep_stack(chunk, verbose=start == 0)
+            # Add one scan at a time to match the order of np.sum on the full stack
+            for row in chunk:
+                total += row
+            cube_storage.write_rows(cube, start, chunk)
+        cube_storage.flush(cube)
+        return cube, total
+
     def create_chrom(self, farray, **kwargs):
         """
         Create a chromatogram from the farray.
@@ -1005,25 +1146,22 @@ class UniChromCDEng(HTEng, UniDecCD):
         # Calculate the Swoop m/z range, zrange, upper charge, and lower charge bounds
         mz, z, zup, zdown = ud.calc_swoop(sarray, adduct_mass=self.config.adductmass)
         # Create Boolean array
-        bsum = np.zeros(len(self.farray))
+        bsum = np.zeros(len(self.farray), dtype=bool)
         # Loop over all charge states
         for i, zval in enumerate(z):
-            # For each charge state, filter z values within the bounds
-            b1 = self.zarray >= zdown[i]
-            b2 = self.zarray <= zup[i]
-            bz = b1 & b2
-
-            # Filter m/z values within the bounds of that charge state
+            # Find the ions within the m/z bounds of that charge state with the sorted m/z index
             mzmin, mzmax = ud.get_swoop_mz_minmax(mz, i)
-            b1 = self.farray[:, 0] >= mzmin
-            b2 = self.farray[:, 0] <= mzmax
-            bmz = b1 & b2
+            index = self.farray_mz_index([mzmin, mzmax])
+
+            # For each charge state, filter z values within the bounds
+            zvals = self.zarray[index]
+            bz = np.logical_and(zvals >= zdown[i], zvals <= zup[i])
 
             # Take everything that is within the charge and m/z range for that charge state
-            # Add rather than multiple because it's OR for each charge state
-            bsum += bmz * bz
+            # OR for each charge state
+            bsum[index[bz]] = True
         # Filter farray
-        farray2 = self.farray[bsum.astype(bool)]
+        farray2 = self.farray[bsum]
 
         # Create EIC
         eic = self.create_chrom(farray2, **kwargs)
@@ -1037,15 +1175,11 @@ class UniChromCDEng(HTEng, UniDecCD):
         :param kwargs: Keywords to be passed down to create_chrom
         :return: 2D array of EIC (time, intensity)
         """
-        # Filter farray
-        b1 = self.farray[:, 0] >= mzrange[0]
-        b2 = self.farray[:, 0] <= mzrange[1]
-        b3 = self.zarray >= zrange[0]
-        b4 = self.zarray <= zrange[1]
-        b = np.logical_and(b1, b2)
-        b = np.logical_and(b, b3)
-        b = np.logical_and(b, b4)
-        farray2 = self.farray[b]
+        # Find the ions in the m/z range with the sorted m/z index, then filter the charge on only those ions
+        index = self.farray_mz_index(mzrange)
+        zvals = self.zarray[index]
+        b = np.logical_and(zvals >= zrange[0], zvals <= zrange[1])
+        farray2 = self.farray[np.sort(index[b])]
 
         # Create EIC
         eic = self.create_chrom(farray2, **kwargs)
@@ -1115,21 +1249,22 @@ class UniChromCDEng(HTEng, UniDecCD):
         # Setup HT
         self.setup_demultiplex()
 
-        # Run the HT on each track in the stack
-        self.fullhstack_ht = np.empty((len(self.decontime), self.topharray.shape[0], self.topharray.shape[1])
-                                      , dtype=self.dtype)
+        # Run the HT on each track in the stack. Tracks at or below the intensity threshold are left as zeros.
+        shape = self.topharray.shape
+        cells = np.flatnonzero(np.ravel(self.topharray) > self.config.intthresh)
+        self.fullhstack_ht = self.make_cube("fullhstack_ht", (len(self.decontime), shape[0], shape[1]),
+                                            dtype=self.dtype)
 
         processed_tic = np.zeros_like(self.fulltime)
-        for i in range(len(self.mz)):
-            for j in range(len(self.ztab)):
-                trace = self.fullhstack[:, j, i]
-                tracesum = self.topharray[j, i]
-                if tracesum <= self.config.intthresh:
-                    htoutput = np.zeros_like(self.decontime)
-                else:
-                    htoutput, trace = self.run_demultiplex(trace, chop=False, keepcomplex=True)
-                    processed_tic += trace
-                self.fullhstack_ht[:, j, i] = htoutput
+        # Demultiplex all tracks with one FFT along time, in chunks of tracks to limit the memory of the FFT arrays
+        chunksize = max(1, int(2e7 // len(self.fullhstack)))
+        for start in range(0, len(cells), chunksize):
+            c = cells[start:start + chunksize]
+            traces = cube_storage.read_columns(self.fullhstack, c)
+            htoutput, trace = self.run_demultiplex(np.transpose(traces), chop=False, keepcomplex=True)
+            cube_storage.write_columns(self.fullhstack_ht, c, np.transpose(htoutput))
+            processed_tic += np.sum(trace, axis=0)
+        cube_storage.flush(self.fullhstack_ht)
 
         # Clip all values below 1e-6 to zero
         # self.fullhstack_ht[np.abs(self.fullhstack_ht) < 1e-6] = 0
@@ -1171,8 +1306,7 @@ class UniChromCDEng(HTEng, UniDecCD):
         b1 = self.decontime >= range[0]
         b2 = self.decontime <= range[1]
         b = np.logical_and(b1, b2)
-        substack_ht = np.real(self.fullhstack_ht[b])
-        self.harray = np.sum(substack_ht, axis=0)
+        self.harray = np.real(cube_storage.sum_rows(self.fullhstack_ht, b))
         self.harray = np.clip(self.harray, 0, np.amax(self.harray))
         self.harray_process()
         return self.harray
@@ -1190,31 +1324,27 @@ class UniChromCDEng(HTEng, UniDecCD):
         b1 = self.fulltime >= range[0]
         b2 = self.fulltime <= range[1]
         b = np.logical_and(b1, b2)
-        substack = self.fullhstack[b]
-        self.harray = np.sum(substack, axis=0)
+        self.harray = cube_storage.sum_rows(self.fullhstack, b)
         self.harray = np.clip(self.harray, 0, np.amax(self.harray))
         self.harray_process()
         return self.harray
 
-    def transform_array(self, array, dtype=float):
+    def transform_array(self, array, dtype=float, name="fullmstack"):
         """
         Transforms a histogram stack from m/z to mass
         :param array: Histogram stack. Shape is time vs. charge vs. m/z.
+        :param dtype: Data type of the output
+        :param name: Name of the output cube, used for memory-mapped file names
         :return: Transformed array
         """
         mlen = len(self.massaxis)
         zlen = len(self.ztab)
-        outarray = np.zeros((len(array), mlen, zlen), dtype=dtype)
-
-        for j in range(len(self.ztab)):
-            indexes = np.array([ud.nearest(self.massaxis, m) for m in self.mass[j]])
-            uindexes = np.unique(indexes)
+        outarray = self.make_cube(name, (len(array), mlen, zlen), dtype=dtype)
 
-            subarray = array[:, j]
-            # Sum together everything with the same index
-            subarray = np.transpose([np.sum(subarray[:, indexes == u], axis=1) for u in uindexes])
-            # Add to the output array
-            outarray[:, uindexes, j] += subarray
+        # Sum every point into the nearest mass bin for its charge with one sparse matrix product for all times
+        matrix = self.get_transform_matrix(self.massaxis, self.mass, keep="z", method="nearest")
+        outarray = cube_storage.apply_matrix(array, matrix, outarray)
+        cube_storage.flush(outarray)
 
         return np.sum(outarray, axis=2), outarray
 
@@ -1251,7 +1381,8 @@ class UniChromCDEng(HTEng, UniDecCD):
         if self.fullhstack_ht is None:
             return
 
-        self.mstack_ht, self.fullmstack_ht = self.transform_array(self.fullhstack_ht, dtype=self.dtype)
+        self.mstack_ht, self.fullmstack_ht = self.transform_array(self.fullhstack_ht, dtype=self.dtype,
+                                                                   name="fullmstack_ht")
 
         self.mass_tic_ht = np.transpose([self.decontime, np.real(np.sum(self.mstack_ht, axis=1))])
 
@@ -1289,8 +1420,7 @@ class UniChromCDEng(HTEng, UniDecCD):
             array = self.fullmstack
             xvals = self.fulltime
 
-        substack = array[:, b, :][:, :, b5]
-        mass_eic = np.sum(substack, axis=(1, 2))
+        mass_eic = cube_storage.select_sum(array, [b, b5])
         return np.transpose([xvals, mass_eic])
 
     def get_ccs_eic(self, massrange=None, zrange=None, mzrange=None, normalize=False):
@@ -1304,40 +1434,30 @@ class UniChromCDEng(HTEng, UniDecCD):
         """
         array = self.ccsstack_ht
         print("Ranges:", massrange, zrange, mzrange)
+        # The filters do not depend on CCS, so build a single mass vs. charge mask for every CCS bin
+        mask = np.ones((len(self.massaxis), len(self.ztab)), dtype=bool)
         if zrange is not None:
             # Filter ztab
             b3 = self.ztab >= zrange[0]
             b4 = self.ztab <= zrange[1]
             b5 = np.logical_and(b4, b3)
-            # Project b5 into array of same shape
-            b5 = np.array([[b5 for i in range(len(self.massaxis))] for j in range(len(self.ccsaxis))])
-        else:
-            b5 = np.ones_like(array, dtype=bool)
+            mask = mask * b5[np.newaxis, :]
 
         if mzrange is not None:
-            dt3d, mass3d, ztab3d = np.meshgrid(self.ccsaxis, self.massaxis, self.ztab, indexing='ij')
-            mz3d = (mass3d + ztab3d * self.config.adductmass) / ztab3d
-            b6 = mz3d >= mzrange[0]
-            b7 = mz3d <= mzrange[1]
-            b8 = np.logical_and(b7, b6)
-        else:
-            b8 = np.ones_like(array, dtype=bool)
+            mass2d, ztab2d = np.meshgrid(self.massaxis, self.ztab, indexing='ij')
+            mz2d = (mass2d + ztab2d * self.config.adductmass) / ztab2d
+            b6 = mz2d >= mzrange[0]
+            b7 = mz2d <= mzrange[1]
+            mask = mask * np.logical_and(b7, b6)
 
         if massrange is not None:
             # Filter mstack
             b1 = self.massaxis >= massrange[0]
             b2 = self.massaxis <= massrange[1]
             b = np.logical_and(b1, b2)
-            b = np.transpose([[b for i in range(len(self.ccsaxis))] for j in range(len(self.ztab))], axes=[1, 2, 0])
-        else:
-            b = np.ones_like(array, dtype=bool)
-
-        # Merge B8, B5 and B into one large 3D array
-        b8 = b8 * b5 * b
-
-        substack = array * b8
+            mask = mask * b[:, np.newaxis]
 
-        ccs_eic = np.abs(np.sum(substack, axis=(1, 2)))
+        ccs_eic = np.abs(cube_storage.masked_sum(array, mask))
 
         if self.config.FTsmooth > 0:
             ccs_eic = scipy.signal.savgol_filter(ccs_eic, int(self.config.FTsmooth), 3)
@@ -1353,14 +1473,16 @@ class UniChromCDEng(HTEng, UniDecCD):
         :param array: Histogram Mass stack. Shape is time vs. mass vs. charge.
         :return: Transformed array
         """
-        # Create dt, mass, and z arrays in 3D
-        dt3d, mass3d, ztab3d = np.meshgrid(self.decontime, self.massaxis, self.ztab, indexing='ij')
-        # Parallel calc all CCS values into new 3d array
+        # Create dt and z arrays in 2D. CCS values are calculated one mass at a time to avoid a full 3D array.
+        dt2d, ztab2d = np.meshgrid(self.decontime, self.ztab, indexing='ij')
         calc_linear_ccsconst(self.config)
-        ccs3d = calc_linear_ccs(mass3d, ztab3d, dt3d, self.config)
+
+        def ccs_slice(i):
+            return calc_linear_ccs(self.massaxis[i:i + 1][:, np.newaxis], ztab2d, dt2d, self.config)
+
         # Create new CCS axis
-        minccs = np.amin(ccs3d)
-        maxccs = np.amax(ccs3d)
+        minccs = np.amin([np.amin(ccs_slice(i)) for i in range(len(self.massaxis))])
+        maxccs = np.amax([np.amax(ccs_slice(i)) for i in range(len(self.massaxis))])
         if self.config.ccsbins == -1:
             binsize = (maxccs - minccs) / len(self.decontime)
         else:
@@ -1373,20 +1495,26 @@ class UniChromCDEng(HTEng, UniDecCD):
 
         mlen = len(self.massaxis)
         zlen = len(self.ztab)
-        outarray = np.zeros((len(ccsaxis), mlen, zlen), dtype=self.dtype)
-        if not keepcomplex:
-            array = np.abs(array)
-        # Loop through array and paste back onto the new CCS axis
+        outarray = self.make_cube("ccsstack_ht", (len(ccsaxis), mlen, zlen), dtype=self.dtype)
+        nccs = len(ccsaxis)
+        zindex = np.arange(zlen)[np.newaxis, :]
+        # Loop through the masses and paste all charge states back onto the new CCS axis at once
         for i in range(mlen):
-            for j in range(zlen):
-                # indexes = np.array([ud.nearest(self.ccsaxis, c) for c in ccs3d[:, i, j]])
-                # outlist = np.zeros_like(self.ccsaxis, dtype=self.dtype)
-                # outlist[indexes] += array[:, i, j]
-
-                outlist = np.histogram(ccs3d[:, i, j], bins=ccsbins, weights=array[:, i, j])[0]
-                outarray[:, i, j] = outlist
-                # interpolate the existing arrray onto the new ccs axis
-                # outarray[:, i, j] = np.interp(self.ccsaxis, ccs3d[:, i, j], array[:, i, j])
+            ccs2d = ccs_slice(i)
+            subarray = array[:, i, :]
+            if not keepcomplex:
+                subarray = np.abs(subarray)
+            # Find the bins the same way as np.histogram, with the last bin including the right edge
+            index = np.searchsorted(ccsbins, ccs2d, side="right") - 1
+            index[ccs2d == ccsbins[-1]] -= 1
+            good = np.logical_and(index >= 0, index < nccs)
+            flat = (index * zlen + zindex)[good]
+            weights = subarray[good]
+            outblock = np.bincount(flat, weights=np.real(weights), minlength=nccs * zlen)
+            if np.iscomplexobj(weights):
+                outblock = outblock + 1j * np.bincount(flat, weights=np.imag(weights), minlength=nccs * zlen)
+            cube_storage.write_columns(outarray, i * zlen + np.arange(zlen), np.reshape(outblock, (nccs, zlen)))
+        cube_storage.flush(outarray)
 
         return outarray
 
@@ -1407,7 +1535,7 @@ class UniChromCDEng(HTEng, UniDecCD):
         b1 = ccs_tic > 0
         ccs_tic = ccs_tic[b1]
         self.ccsaxis = self.ccsaxis[b1]
-        self.ccsstack_ht = self.ccsstack_ht[b1]
+        self.ccsstack_ht = cube_storage.select_rows(self.ccsstack_ht, b1, self.get_cube_dir())
         if self.config.FTsmooth > 0:
             if self.config.FTsmooth > len(ccs_tic):
                 self.config.FTsmooth = len(ccs_tic)
@@ -0,0 +1,133 @@
+"""
+Prefix sums of LC-MS scans for fast extraction of summed spectra over windows of scans (ChromEngine).
+
+Each scan is resampled once onto a shared m/z axis in the same way as merge_spectra, and the running sum over scans is
+stored as a (number of scans + 1) x (length of axis) array. The summed spectrum of scans i to j is then
+cumsum[j + 1] - cumsum[i], so any window costs one subtraction no matter how many scans it covers.
+"""
+import numpy as np
+import unidec.tools as ud
+from unidec.modules.mzMLimporter import get_resolution
+from unidec.modules import cube_storage
+
+__author__ = 'Michael.Marty'
+
+# Prefix sums larger than this in bytes are memory-mapped rather than kept in memory
+memmap_bytes = 2 ** 30
+
+
+def get_axis(mzmin, mzmax, longest, mzbins=None):
+    """
+    Shared m/z axis for a set of scans, made the same way as in merge_spectra.
+    :param mzmin: Minimum m/z of all scans
+    :param mzmax: Maximum m/z of all scans
+    :param longest: Longest scan (N x 2), which sets the resolution of the nonlinear axis
+    :param mzbins: Linear m/z bin size. None or 0 for a nonlinear axis with the resolution of the longest scan.
+    :return: m/z axis
+    """
+    if mzbins is None or float(mzbins) == 0:
+        resolution = get_resolution(longest)
+        if resolution < 0:
+            resolution = np.abs(resolution)
+        elif resolution == 0:
+            resolution = 20000
+        return ud.nonlinear_axis(mzmin, mzmax, resolution)
+    return np.arange(mzmin, mzmax, float(mzbins))
+
+
+class ScanPrefixSum(object):
+    def __init__(self, datalist, mzbins=None, mode=None, directory=None):
+        """
+        Resample every scan onto a shared m/z axis and store the running sum over scans.
+
+        The scans are read twice, once to find the axis and once to resample them, and only one scan is held at a
+        time. datalist can therefore be any sequence that reads each scan when it is indexed.
+        :param datalist: Sequence of N x 2 scans, in scan order
+        :param mzbins: Linear m/z bin size. None or 0 (default) for a nonlinear axis like merge_spectra.
+        :param mode: cube_storage mode for the prefix sums. Default is dense below memmap_bytes and memory-mapped above.
+        :param directory: Folder for memory-mapped files. Default is the system temporary folder.
+        :return: ScanPrefixSum object
+        """
+        self.nscans = len(datalist)
+        self.mzmin = np.full(self.nscans, np.nan)
+        self.mzmax = np.full(self.nscans, np.nan)
+        longest = None
+        for i in range(self.nscans):
+            d = datalist[i]
+            if d is not None and len(d) > 0:
+                self.mzmin[i] = np.amin(d[:, 0])
+                self.mzmax[i] = np.amax(d[:, 0])
+                if longest is None or len(d) > len(longest):
+                    longest = d
+        if longest is None:
+            raise ValueError("No data in scans")
+
+        self.axis = get_axis(np.nanmin(self.mzmin), np.nanmax(self.mzmax), longest, mzbins)
+        shape = (self.nscans + 1, len(self.axis))
+        if mode is None:
+            nbytes = shape[0] * shape[1] * np.dtype(float).itemsize
+            mode = cube_storage.memmap_mode if nbytes > memmap_bytes else cube_storage.dense_mode
+        print("Building scan prefix sums:", shape)
+        self.cumsum = cube_storage.make_cube(shape, dtype=float, mode=mode, directory=directory, prefix="chromcube_")
+
+        template = np.transpose([self.axis, np.zeros_like(self.axis)])
+        row = np.zeros(len(self.axis))
+        for i in range(self.nscans):
+            d = datalist[i]
+            # Same rule as merge_spectra for which scans are added
+            if d is not None and len(d) > 2:
+                row += ud.mergedata(template, d)[:, 1]
+            self.cumsum[i + 1] = row
+        cube_storage.flush(self.cumsum)
+
+    @classmethod
+    def from_importer(cls, importer, mzbins=None, mode=None, directory=None):
+        """
+        Build the prefix sums from the scans of an mzML or mzXML importer. Scans already in memory are used directly.
+        Otherwise, large files that the importer would stream are read one scan at a time, and smaller files are
+        loaded with grab_data as in get_data.
+        :param importer: mzMLimporter or mzXMLimporter object
+        :param mzbins: Linear m/z bin size. None or 0 (default) for a nonlinear axis like merge_spectra.
+        :param mode: cube_storage mode for the prefix sums
+        :param directory: Folder for memory-mapped files
+        :return: ScanPrefixSum object
+        """
+        if importer.data is None:
+            if importer.filesize > 1e9 and hasattr(importer, "grab_scan_data"):
+                return cls(ImporterScans(importer), mzbins=mzbins, mode=mode, directory=directory)
+            importer.grab_data()
+        return cls(importer.data, mzbins=mzbins, mode=mode, directory=directory)
+
+    def __len__(self):
+        return self.nscans
+
+    def get_data(self, scan_range):
+        """
+        Summed spectrum over a range of scans, cropped to the m/z range of those scans.
+        :param scan_range: [first scan, last scan], both included, as indexes in the scan list
+        :return: N x 2 summed data, or None if the scans are empty
+        """
+        s0 = max(int(scan_range[0]), 0)
+        s1 = min(int(scan_range[1]), self.nscans - 1)
+        if s1 < s0 or np.all(np.isnan(self.mzmin[s0:s1 + 1])):
+            return None
+        i1 = np.searchsorted(self.axis, np.nanmin(self.mzmin[s0:s1 + 1]), side="left")
+        i2 = np.searchsorted(self.axis, np.nanmax(self.mzmax[s0:s1 + 1]), side="right")
+        vals = self.cumsum[s1 + 1, i1:i2] - self.cumsum[s0, i1:i2]
+        return np.transpose([self.axis[i1:i2], vals])
+
+
+class ImporterScans(object):
+    def __init__(self, importer):
+        """
+        Sequence of the scans of an importer that reads each scan from the file when it is indexed.
+        :param importer: Importer object with scans and grab_scan_data
+        :return: ImporterScans object
+        """
+        self.importer = importer
+
+    def __len__(self):
+        return len(self.importer.scans)
+
+    def __getitem__(self, i):
+        return self.importer.grab_scan_data(int(self.importer.scans[i]))
@@ -0,0 +1,516 @@
+"""
+Storage for the large scan x charge x m/z data cubes used by the HT-CD-MS engine (HTEng.UniChromCDEng).
+
+Cubes can be kept as:
+    0: Dense numpy arrays in memory (default)
+    1: Memory-mapped .npy files on disk
+    2: Sparse cubes with one CSR row per scan (SparseCube)
+
+The helper functions below read and write cubes in chunks of scans or columns so that the memory-mapped and sparse
+modes never need the full dense cube in memory.
+"""
+import os
+import tempfile
+import weakref
+import numpy as np
+import scipy.sparse as sparse
+
+__author__ = 'Michael.Marty'
+
+dense_mode = 0
+memmap_mode = 1
+sparse_mode = 2
+
+# Target size in bytes of each dense chunk read from or written to a cube
+chunk_bytes = 2 ** 26
+
+# Memory-mapped files that could not be deleted while mapped, such as on Windows. Each is deleted when its map closes.
+temp_files = set()
+
+
+class SparseCube(object):
+    def __init__(self, shape, dtype=float, matrix=None):
+        """
+        Sparse N-D array stored as a CSR matrix with one row for each index on the first axis (scan or time) and one
+        column for each cell in the remaining axes.
+
+        Supports the parts of the numpy array interface used on the HT-CD-MS cubes: len, shape, indexing with
+        slices, integers, and boolean or integer arrays, np.sum, np.amax, np.amin, np.clip, np.real, and np.abs.
+        Indexing with arrays on more than one axis selects the outer product, like cube[:, a][:, :, b].
+        Anything else converts to a dense array through __array__.
+        :param shape: Shape of the cube
+        :param dtype: Data type
+        :param matrix: Optional CSR matrix of shape (shape[0], prod(shape[1:]))
+        :return: SparseCube object
+        """
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        ncols = int(np.prod(self.shape[1:]))
+        if matrix is None:
+            matrix = sparse.csr_matrix((self.shape[0], ncols), dtype=self.dtype)
+        self.matrix = matrix
+        self.pieces = []
+        self.csc = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        m = self.get_matrix()
+        return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_matrix(self):
+        """
+        Merge any pending writes into the CSR matrix.
+        :return: CSR matrix
+        """
+        if len(self.pieces) > 0:
+            rows = np.concatenate([p[0] for p in self.pieces])
+            cols = np.concatenate([p[1] for p in self.pieces])
+            vals = np.concatenate([p[2] for p in self.pieces]).astype(self.dtype)
+            self.pieces = []
+            new = sparse.coo_matrix((vals, (rows, cols)), shape=self.matrix.shape).tocsr()
+            self.matrix = new if self.matrix.nnz == 0 else (self.matrix + new).tocsr()
+            self.csc = None
+        return self.matrix
+
+    def get_csc(self):
+        """
+        Column-compressed copy of the matrix for fast column reads. Cached until the next write.
+        :return: CSC matrix
+        """
+        if self.csc is None or len(self.pieces) > 0:
+            self.csc = self.get_matrix().tocsc()
+        return self.csc
+
+    def write_rows(self, start, chunk):
+        """
+        Write a dense chunk of rows into empty rows of the cube.
+        :param start: First row
+        :param chunk: Dense array of shape (n,) + shape[1:]
+        :return: None
+        """
+        flat = np.reshape(chunk, (len(chunk), -1))
+        r, c = np.nonzero(flat)
+        self.pieces.append((r + start, c, flat[r, c]))
+
+    def write_columns(self, cols, chunk):
+        """
+        Write a dense block into empty columns of the cube.
+        :param cols: Flat column indexes (cells on axes 1 and up)
+        :param chunk: Dense array of shape (shape[0], len(cols))
+        :return: None
+        """
+        r, c = np.nonzero(chunk)
+        self.pieces.append((r, np.asarray(cols)[c], chunk[r, c]))
+
+    def read_columns(self, cols):
+        """
+        Read columns as a dense array.
+        :param cols: Flat column indexes
+        :return: Dense array of shape (shape[0], len(cols))
+        """
+        return self.get_csc()[:, cols].toarray()
+
+    def toarray(self):
+        return np.reshape(self.get_matrix().toarray(), self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.toarray()
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+    def copy(self):
+        return SparseCube(self.shape, self.dtype, self.get_matrix().copy())
+
+    def astype(self, dtype, copy=True):
+        return SparseCube(self.shape, dtype, self.get_matrix().astype(dtype))
+
+    def _apply(self, func, dtype=None):
+        # Apply a function that keeps zeros as zeros to the stored values
+        m = self.get_matrix().copy()
+        m.data = func(m.data)
+        if dtype is None:
+            dtype = m.data.dtype
+        return SparseCube(self.shape, dtype, m)
+
+    @property
+    def real(self):
+        return self._apply(np.real)
+
+    @property
+    def imag(self):
+        return self._apply(np.imag)
+
+    def __abs__(self):
+        return self._apply(np.abs)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if ufunc is np.absolute and method == "__call__" and len(inputs) == 1 and "out" not in kwargs:
+            return self.__abs__()
+        inputs = [np.asarray(i) if isinstance(i, SparseCube) else i for i in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def clip(self, min=None, max=None, out=None, **kwargs):
+        if (min is None or min <= 0) and (max is None or max >= 0) and out is None:
+            return self._apply(lambda d: np.clip(d, min, max))
+        return np.clip(self.toarray(), min, max, out=out, **kwargs)
+
+    def _reduce_extreme(self, func, axis=None, out=None, **kwargs):
+        if axis is None and out is None:
+            m = self.get_matrix()
+            if m.nnz == 0:
+                return self.dtype.type(0)
+            value = func(m.data)
+            if m.nnz < self.size:
+                value = func([value, 0])
+            return value
+        return func(self.toarray(), axis=axis, out=out, **kwargs)
+
+    def max(self, axis=None, out=None, **kwargs):
+        return self._reduce_extreme(np.amax, axis=axis, out=out, **kwargs)
+
+    def min(self, axis=None, out=None, **kwargs):
+        return self._reduce_extreme(np.amin, axis=axis, out=out, **kwargs)
+
+    def sum(self, axis=None, dtype=None, out=None, keepdims=False, **kwargs):
+        """
+        Sum over axes, like np.sum.
+        :param axis: None, int, or tuple of ints
+        :return: Dense array or scalar
+        """
+        m = self.get_matrix()
+        if axis is None:
+            result = m.sum()
+        else:
+            axes = np.atleast_1d(axis)
+            axes = sorted(set(int(a) % self.ndim for a in axes))
+            cellaxes = [a for a in axes if a > 0]
+            keep = [a for a in range(1, self.ndim) if a not in cellaxes]
+            if len(cellaxes) > 0:
+                # Project the cells onto the axes that are kept
+                keepshape = [self.shape[a] for a in keep]
+                coords = np.unravel_index(np.arange(m.shape[1]), self.shape[1:])
+                if len(keep) > 0:
+                    target = np.ravel_multi_index([coords[a - 1] for a in keep], keepshape)
+                else:
+                    target = np.zeros(m.shape[1], dtype=int)
+                proj = sparse.csr_matrix((np.ones(m.shape[1]), (np.arange(m.shape[1]), target)),
+                                         shape=(m.shape[1], int(np.prod(keepshape))))
+                m = m @ proj
+            else:
+                keepshape = list(self.shape[1:])
+            if 0 in axes:
+                result = np.reshape(np.asarray(m.sum(axis=0)), keepshape)
+            else:
+                result = np.reshape(m.toarray(), [self.shape[0]] + keepshape)
+            if keepdims:
+                result = np.reshape(result, [1 if a in axes else s for a, s in enumerate(self.shape)])
+        if dtype is not None:
+            result = np.asarray(result).astype(dtype)
+        if out is not None:
+            out[...] = result
+            return out
+        return result
+
+    def _normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        return key + (slice(None),) * (self.ndim - len(key))
+
+    def __getitem__(self, key):
+        key = self._normalize_key(key)
+        rowkey = key[0]
+        cellkeys = key[1:]
+        if all(isinstance(k, slice) and k == slice(None) for k in cellkeys):
+            m = self.get_matrix()
+            if isinstance(rowkey, (int, np.integer)):
+                return np.reshape(m[int(rowkey)].toarray(), self.shape[1:])
+            rows = np.arange(self.shape[0])[rowkey]
+            return SparseCube((len(rows),) + self.shape[1:], self.dtype, m[rows])
+
+        # Select the cells as an outer product of the index on each axis
+        grids = []
+        outshape = []
+        for k, n in zip(cellkeys, self.shape[1:]):
+            g = np.arange(n)[k]
+            if np.ndim(g) > 0:
+                outshape.append(len(g))
+            grids.append(np.atleast_1d(g))
+        cols = np.ravel(np.ravel_multi_index(np.ix_(*grids), self.shape[1:]))
+        if isinstance(rowkey, slice) and rowkey == slice(None):
+            out = self.get_csc()[:, cols].toarray()
+        else:
+            rows = np.atleast_1d(np.arange(self.shape[0])[rowkey])
+            out = self.get_matrix()[rows][:, cols].toarray()
+        if isinstance(rowkey, (int, np.integer)):
+            return np.reshape(out, outshape)
+        return np.reshape(out, [len(out)] + outshape)
+
+
+def get_dtype(dtype, single=False):
+    """
+    Get the data type for a cube, optionally in single precision.
+    :param dtype: Data type (float or complex)
+    :param single: If True, use float32 or complex64
+    :return: numpy dtype
+    """
+    dtype = np.dtype(dtype)
+    if single:
+        if np.issubdtype(dtype, np.complexfloating):
+            return np.dtype(np.complex64)
+        return np.dtype(np.float32)
+    return dtype
+
+
+def remove_temp_file(path):
+    """
+    Delete the file of a memory-mapped cube if it is no longer mapped.
+    :param path: File path
+    :return: True if the file is gone
+    """
+    try:
+        if os.path.isfile(path):
+            os.remove(path)
+    except OSError:
+        return False
+    temp_files.discard(path)
+    return True
+
+
+def remove_temp_files():
+    """
+    Delete the files of memory-mapped cubes that could not be deleted when they were made, if they are no longer
+    mapped. Files still in use are deleted when their map is closed.
+    :return: None
+    """
+    for path in list(temp_files):
+        remove_temp_file(path)
+
+
+def make_cube(shape, dtype=float, mode=dense_mode, directory=None, prefix="cube_"):
+    """
+    Create an empty cube filled with zeros.
+
+    Memory-mapped cubes are written to a new temporary .npy file in directory. The file is deleted as soon as it is
+    mapped where the operating system allows it, so the space is freed when the cube is no longer used. Otherwise,
+    such as on Windows, the file is deleted when the map is closed, which is after the cube and all views of it are
+    released.
+    :param shape: Shape of the cube
+    :param dtype: Data type
+    :param mode: 0 for dense, 1 for memory-mapped, 2 for sparse
+    :param directory: Folder for memory-mapped files. Default is the system temporary folder.
+    :param prefix: Prefix for memory-mapped file names
+    :return: Cube
+    """
+    shape = tuple(int(s) for s in shape)
+    if mode == memmap_mode:
+        if directory is not None and not os.path.isdir(directory):
+            directory = None
+        fd, path = tempfile.mkstemp(suffix=".npy", prefix=prefix, dir=directory)
+        os.close(fd)
+        cube = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        if not remove_temp_file(path):
+            temp_files.add(path)
+            # The base of the memmap is the map itself, which closes after the last view of the cube is released
+            weakref.finalize(cube.base, remove_temp_file, path)
+        return cube
+    elif mode == sparse_mode:
+        return SparseCube(shape, dtype)
+    return np.zeros(shape, dtype=dtype)
+
+
+def is_dense(cube):
+    return isinstance(cube, np.ndarray) and not isinstance(cube, np.memmap)
+
+
+def chunk_rows(cube_or_shape, dtype=float):
+    """
+    Number of rows (first axis) to read or write at a time.
+    :param cube_or_shape: Cube or shape
+    :param dtype: Data type, if a shape is given
+    :return: Number of rows
+    """
+    if hasattr(cube_or_shape, "shape"):
+        shape = cube_or_shape.shape
+        dtype = cube_or_shape.dtype
+    else:
+        shape = cube_or_shape
+    rowbytes = max(1, int(np.prod(shape[1:])) * np.dtype(dtype).itemsize)
+    return max(1, int(chunk_bytes // rowbytes))
+
+
+def iter_chunks(n, size):
+    """
+    Iterate over (start, end) ranges of size at most size covering 0 to n.
+    :param n: Total length
+    :param size: Chunk size
+    :return: Generator of (start, end)
+    """
+    for start in range(0, n, size):
+        yield start, min(n, start + size)
+
+
+def write_rows(cube, start, chunk):
+    """
+    Write a dense chunk into rows start:start + len(chunk) of a cube.
+    :param cube: Cube
+    :param start: First row
+    :param chunk: Dense array
+    :return: None
+    """
+    if isinstance(cube, SparseCube):
+        cube.write_rows(start, chunk)
+    else:
+        cube[start:start + len(chunk)] = chunk
+
+
+def write_columns(cube, cols, chunk):
+    """
+    Write a dense block of shape (len(cube), len(cols)) into the flat cells cols of a cube.
+    :param cube: Cube
+    :param cols: Flat cell indexes on axes 1 and up
+    :param chunk: Dense array
+    :return: None
+    """
+    if isinstance(cube, SparseCube):
+        cube.write_columns(cols, chunk)
+    else:
+        flat = np.reshape(cube, (len(cube), -1))
+        flat[:, cols] = chunk
+
+
+def read_columns(cube, cols):
+    """
+    Read the flat cells cols of a cube as a dense array of shape (len(cube), len(cols)).
+    :param cube: Cube
+    :param cols: Flat cell indexes on axes 1 and up
+    :return: Dense array
+    """
+    if isinstance(cube, SparseCube):
+        return cube.read_columns(cols)
+    return np.reshape(cube, (len(cube), -1))[:, cols]
+
+
+def sum_rows(cube, rows=None):
+    """
+    Sum a cube over the first axis, optionally only over some rows.
+    :param cube: Cube
+    :param rows: Boolean mask or index array for the first axis. Default is all rows.
+    :return: Dense array of shape cube.shape[1:]
+    """
+    if isinstance(cube, SparseCube):
+        if rows is not None:
+            cube = cube[rows]
+        return cube.sum(axis=0)
+    if is_dense(cube):
+        if rows is not None:
+            cube = cube[rows]
+        return np.sum(cube, axis=0)
+    # Memory-mapped. Add one row at a time, which matches the order of np.sum on axis 0.
+    index = np.arange(len(cube))
+    if rows is not None:
+        index = index[rows]
+    out = np.zeros(cube.shape[1:], dtype=cube.dtype)
+    for start, end in iter_chunks(len(index), chunk_rows(cube)):
+        chunk = cube[index[start:end]]
+        for row in chunk:
+            out += row
+    return out
+
+
+def select_sum(cube, keys):
+    """
+    Sum the block cube[:, keys[0]][:, :, keys[1]]... over all axes except the first.
+    :param cube: Cube
+    :param keys: List of boolean masks or index arrays, one for each axis after the first
+    :return: Dense 1D array of length len(cube)
+    """
+    axes = tuple(range(1, cube.ndim))
+    if isinstance(cube, SparseCube):
+        return cube[(slice(None),) + tuple(keys)].sum(axis=axes)
+
+    def block(array):
+        for i, k in enumerate(keys):
+            array = array[(slice(None),) * (i + 1) + (k,)]
+        return np.sum(array, axis=axes)
+
+    if is_dense(cube):
+        return block(cube)
+    return np.concatenate([block(cube[start:end]) for start, end in iter_chunks(len(cube), chunk_rows(cube))])
+
+
+def masked_sum(cube, mask):
+    """
+    Sum cube * mask over all axes except the first.
+    :param cube: Cube
+    :param mask: Array of shape cube.shape[1:], usually boolean
+    :return: Dense 1D array of length len(cube)
+    """
+    axes = tuple(range(1, cube.ndim))
+    if isinstance(cube, SparseCube):
+        return np.asarray(cube.get_matrix() @ np.ravel(mask).astype(float)).ravel()
+    if is_dense(cube):
+        return np.sum(cube * mask, axis=axes)
+    return np.concatenate([np.sum(cube[start:end] * mask, axis=axes)
+                           for start, end in iter_chunks(len(cube), chunk_rows(cube))])
+
+
+def select_rows(cube, rows, directory=None):
+    """
+    Take rows of a cube, like cube[rows], without loading a memory-mapped cube into memory.
+    :param cube: Cube
+    :param rows: Boolean mask or index array for the first axis
+    :param directory: Folder for the new memory-mapped file. Default is the system temporary folder.
+    :return: Cube with the selected rows
+    """
+    if not isinstance(cube, np.memmap):
+        return cube[rows]
+    index = np.arange(len(cube))[rows]
+    if len(index) == len(cube):
+        return cube
+    out = make_cube((len(index),) + cube.shape[1:], cube.dtype, memmap_mode, directory)
+    for start, end in iter_chunks(len(index), chunk_rows(cube)):
+        out[start:end] = cube[index[start:end]]
+    return out
+
+
+def apply_matrix(cube, matrix, out):
+    """
+    Multiply the flattened cells in each row of a cube by a sparse matrix, so out[i] = matrix @ cube[i].
+    :param cube: Input cube
+    :param matrix: Sparse matrix of shape (number of cells in each row of out, number of cells in each row of cube)
+    :param out: Empty output cube with the same number of rows
+    :return: Output cube, which is a new cube if both cubes are sparse
+    """
+    if isinstance(cube, SparseCube) and isinstance(out, SparseCube):
+        product = (cube.get_matrix() @ matrix.T).tocsr().astype(out.dtype)
+        return SparseCube(out.shape, out.dtype, product)
+    for start, end in iter_chunks(len(cube), chunk_rows(cube)):
+        chunk = np.reshape(cube[start:end], (end - start, -1))
+        product = np.transpose(matrix @ np.transpose(chunk))
+        write_rows(out, start, np.reshape(product, (end - start,) + tuple(out.shape[1:])))
+    return out
+
+
+def flush(cube):
+    """
+    Flush a memory-mapped cube to disk. Does nothing for other cubes.
+    :param cube: Cube
+    :return: None
+    """
+    if isinstance(cube, np.memmap):
+        cube.flush()
@@ -0,0 +1,175 @@
+"""
+Disk cache of deconvolution results for UniDec.run_unidec.
+
+Results are keyed by a hash of the processed data and the config fields that change the deconvolution,
+so rerunning the same data with the same settings loads the results instead of running the core again.
+The cache is limited in size and drops the least recently used entries first.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+__author__ = 'Michael.Marty'
+
+# Config fields from get_config_dict that do not change the deconvolution output. The version is kept in the key so that
+# results are not reused across releases that change the algorithm.
+ignored_keys = ["peakwindow", "peakthresh", "normthresh", "peakplotthresh", "plotsep", "cmap", "peakcmap",
+                "spectracmap", "publicationmode", "peaknorm", "discreteplot", "integratelb", "integrateub",
+                "exwindow", "exchoice", "exchoicez", "exthresh", "exnorm", "exnormz", "chrom_time_window",
+                "chrom_peak_width", "sw_time_window", "sw_scan_offset", "time_start", "time_end", "cacheflag",
+                "cachesize"]
+
+# Arrays stored for each result
+result_keys = ["massdat", "massgrid", "mzgrid", "fitdat", "error", "iterations"]
+
+
+def get_default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".unidec", "decon_cache")
+
+
+class DeconCache(object):
+    def __init__(self, directory=None, maxsize=1000):
+        """
+        Disk cache of deconvolution results.
+        :param directory: Folder for the cache files. Default is ~/.unidec/decon_cache
+        :param maxsize: Maximum total size of the cache in MB
+        :return: DeconCache object
+        """
+        if directory is None or directory == "":
+            directory = get_default_cache_dir()
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, data, config):
+        """
+        Hash the processed data and the deconvolution settings.
+        :param data: Processed data array (data2)
+        :param config: UniDecConfig object
+        :return: Hex string key
+        """
+        h = hashlib.sha256()
+        data = np.ascontiguousarray(data, dtype=float)
+        h.update(str(data.shape).encode())
+        h.update(data.tobytes())
+
+        cdict = config.get_config_dict()
+        cdict = {k: v for k, v in cdict.items() if k not in ignored_keys}
+        cdict["doubledec"] = config.doubledec
+        cdict["dtype"] = str(np.dtype(config.dtype))
+        if config.doubledec:
+            cdict["kernel"] = config.kernel
+            try:
+                stat = os.stat(config.kernel)
+                cdict["kernelstamp"] = [stat.st_size, stat.st_mtime_ns]
+            except Exception:
+                pass
+        h.update(json.dumps(cdict, sort_keys=True, default=str).encode())
+
+        for name in ["masslist", "manuallist", "oligomerlist"]:
+            value = getattr(config, name, [])
+            h.update(name.encode())
+            h.update(np.asarray(value).astype(str).tobytes())
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        """
+        Load a cached result.
+        :param key: Key from make_key
+        :return: Dictionary of result arrays, or None on a miss
+        """
+        path = self.get_path(key)
+        if os.path.isfile(path):
+            try:
+                with np.load(path, allow_pickle=False) as npz:
+                    result = {k: npz[k] for k in npz.files}
+                # Touch the file so it counts as recently used
+                os.utime(path)
+                self.hits += 1
+                return result
+            except Exception as e:
+                print("Could not read cached result:", path, e)
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        """
+        Save a result to the cache and evict old entries if the cache is too large.
+        :param key: Key from make_key
+        :param result: Dictionary with the arrays in result_keys
+        :return: None
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.get_path(key)
+            # Write to a temporary file first so a partial write is never read as a result
+            tmppath = path[:-4] + "_tmp.npz"
+            np.savez(tmppath, **{k: result[k] for k in result_keys})
+            os.replace(tmppath, path)
+        except Exception as e:
+            print("Could not write cached result:", e)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache is below maxsize.
+        :return: None
+        """
+        entries = self.get_entries()
+        total = np.sum([e[2] for e in entries])
+        maxbytes = self.maxsize * 1e6
+        for path, mtime, size in entries:
+            if total <= maxbytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except Exception as e:
+                print("Could not remove cached result:", path, e)
+
+    def get_entries(self):
+        """
+        List the cache files sorted from least to most recently used.
+        :return: List of (path, mtime, size)
+        """
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for f in os.listdir(self.directory):
+            if f.endswith(".npz") and not f.endswith("_tmp.npz"):
+                path = os.path.join(self.directory, f)
+                try:
+                    stat = os.stat(path)
+                    entries.append((path, stat.st_mtime, stat.st_size))
+                except Exception:
+                    pass
+        entries.sort(key=lambda e: e[1])
+        return entries
+
+    def clear(self):
+        """
+        Delete all entries and reset the counters.
+        :return: None
+        """
+        for path, mtime, size in self.get_entries():
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Get the cache counters and size.
+        :return: Dictionary of hits, misses, number of entries, and size in MB
+        """
+        entries = self.get_entries()
+        return {"hits": self.hits, "misses": self.misses, "entries": len(entries),
+                "size": np.sum([e[2] for e in entries]) / 1e6}
@@ -1266,7 +1266,7 @@ class main_controls(wx.Panel):  # scrolled.ScrolledPanel):
                 is_mass = False
             else:
                 # Otherwise, it might be a mass file. Check if linear
-                kernel_dat = np.loadtxt(kernel_path)
+                kernel_dat = ud.load_txt_cached(kernel_path)
                 kernel_diff = np.diff(kernel_dat[:, 0])
                 is_mass = np.all(kernel_diff == kernel_diff[0])
             if not is_mass:  # If not a mass file, find the mass file
@@ -1274,11 +1274,10 @@ class main_controls(wx.Panel):  # scrolled.ScrolledPanel):
                 kernel_path2 = os.path.dirname(kernel_path) + "\\" + bare_name + "_unidecfiles\\" + \
                                bare_name + "_mass.txt"
 
-            try:
-                with open(kernel_path2, "r") as f:
-                    self.doubledecbutton.SetLabel(os.path.splitext(os.path.basename(kernel_path2))[0])
-                    self.config.kernel = kernel_path2
-            except (IOError, FileNotFoundError) as err:
+            if ud.cached_file_exists(kernel_path2):
+                self.doubledecbutton.SetLabel(os.path.splitext(os.path.basename(kernel_path2))[0])
+                self.config.kernel = kernel_path2
+            else:
                 print("Please deconvolve the m/z file [" + kernel_name + "] with UniDec first.")
             print(self.config.kernel)
 
@@ -1,14 +1,25 @@
+import zlib
 import h5py
 import numpy as np
 
 
-def replace_dataset(group, name, data):
+def replace_dataset(group, name, data, compression="gzip", shuffle=False):
     if name in list(group.keys()):
         del group[name]
-    group.create_dataset(name, data=data, compression="gzip")
+    group.create_dataset(name, data=data, compression=compression, shuffle=shuffle)
     pass
 
 
+def fingerprint(data):
+    """
+    Cheap fingerprint of an array to tell if it has changed since it was written to or read from a file.
+    :param data: Array
+    :return: Tuple of shape, dtype, and CRC32 of the data
+    """
+    data = np.ascontiguousarray(data)
+    return data.shape, data.dtype.str, zlib.crc32(data)
+
+
 def replace_dataset_strings(group, name, data):
     if name in list(group.keys()):
         del group[name]
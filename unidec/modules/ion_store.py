@@ -0,0 +1,208 @@
+"""
+Memory-mapped columnar store of CD-MS ions for UniDecCD.
+
+The store is a folder with the ion columns (m/z, intensity, scan, and inverse injection time) saved as one
+(4, number of ions) .npy file, plus a sort index on m/z and an index of the ions in each scan. Opening the store
+maps the files without reading them, and range queries on m/z and scan only touch the selected ions.
+"""
+import os
+import json
+import numpy as np
+
+__author__ = 'Michael.Marty'
+
+version = 1
+
+# Rows in ions.npy. The transpose matches the columns of UniDecCD.darray.
+columns = ["mz", "intensity", "scan", "invinjtime"]
+
+
+def range_index(sortedkeys, order, lo=None, hi=None, inclusive=False):
+    """
+    Find the items with keys in a range using a sorted copy of the keys.
+    :param sortedkeys: Keys sorted in increasing order
+    :param order: Index of each sorted key in the original array, such that keys[order] = sortedkeys
+    :param lo: Lower bound. None for no bound.
+    :param hi: Upper bound. None for no bound.
+    :param inclusive: If True, keep lo <= key <= hi. If False (default), keep lo < key < hi.
+    :return: Indexes in the original array, in sorted key order
+    """
+    i1 = 0
+    i2 = len(sortedkeys)
+    if lo is not None:
+        i1 = np.searchsorted(sortedkeys, lo, side="left" if inclusive else "right")
+    if hi is not None:
+        i2 = np.searchsorted(sortedkeys, hi, side="right" if inclusive else "left")
+    return np.asarray(order[i1:max(i1, i2)])
+
+
+class IonStore(object):
+    def __init__(self, directory):
+        """
+        Open an ion store without reading the data into memory.
+        :param directory: Store folder, written by IonStore.create
+        :return: IonStore object
+        """
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.ions = self.load("ions")
+        self.mzsorted = self.load("mzsorted")
+        self.mzorder = self.load("mzorder")
+        self.scanorder = self.load("scanorder")
+        self.scanvalues = self.load("scanvalues")
+        self.scanptr = self.load("scanptr")
+        self.noise = self.meta["noise"]
+        self.mzrange = self.meta["mzrange"]
+
+    def load(self, name):
+        return np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r")
+
+    @staticmethod
+    def exists(directory):
+        """
+        Check for a complete store of the current version.
+        :param directory: Store folder
+        :return: True if the store can be opened
+        """
+        path = os.path.join(directory, "meta.json")
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path, "r") as f:
+                meta = json.load(f)
+            return meta["version"] == version
+        except Exception:
+            return False
+
+    @classmethod
+    def create(cls, directory, darray, noise=0, mzrange=None):
+        """
+        Write a new store, replacing any old store in the same folder.
+        :param directory: Store folder
+        :param darray: Ion array with columns m/z, intensity, scan, and inverse injection time
+        :param noise: Noise level to save with the ions
+        :param mzrange: m/z range of the raw data to save with the ions. Default is the range of darray.
+        :return: IonStore object
+        """
+        os.makedirs(directory, exist_ok=True)
+        # Remove the old metadata first so a partly written store is never opened
+        metapath = os.path.join(directory, "meta.json")
+        if os.path.isfile(metapath):
+            os.remove(metapath)
+
+        ions = np.ascontiguousarray(np.transpose(darray), dtype=float)
+        np.save(os.path.join(directory, "ions.npy"), ions)
+
+        mzorder = np.argsort(ions[0], kind="stable")
+        np.save(os.path.join(directory, "mzorder.npy"), mzorder)
+        np.save(os.path.join(directory, "mzsorted.npy"), ions[0][mzorder])
+
+        # Ions for each scan are scanorder[scanptr[i]:scanptr[i + 1]] for scan scanvalues[i]
+        scanorder = np.argsort(ions[2], kind="stable")
+        scanvalues, scanstarts = np.unique(ions[2][scanorder], return_index=True)
+        scanptr = np.append(scanstarts, len(scanorder))
+        np.save(os.path.join(directory, "scanorder.npy"), scanorder)
+        np.save(os.path.join(directory, "scanvalues.npy"), scanvalues)
+        np.save(os.path.join(directory, "scanptr.npy"), scanptr)
+
+        if mzrange is None:
+            mzrange = [np.amin(ions[0]), np.amax(ions[0])] if ions.shape[1] > 0 else [0, 0]
+        meta = {"version": version, "length": int(ions.shape[1]), "columns": columns, "noise": float(noise),
+                "mzrange": [float(mzrange[0]), float(mzrange[1])]}
+        with open(metapath, "w") as f:
+            json.dump(meta, f)
+        return cls(directory)
+
+    def __len__(self):
+        return self.ions.shape[1]
+
+    @property
+    def darray(self):
+        """
+        Memory-mapped view of the ions with the same layout as UniDecCD.darray (ions x columns).
+        """
+        return np.transpose(self.ions)
+
+    def scan_index(self, lo=None, hi=None, inclusive=False):
+        """
+        Find the ions with scans in a range.
+        :param lo: Lower scan bound. None for no bound.
+        :param hi: Upper scan bound. None for no bound.
+        :param inclusive: If True, bounds are included. If False (default), bounds are excluded.
+        :return: Indexes of the ions, grouped by scan
+        """
+        s = range_index(self.scanvalues, np.arange(len(self.scanvalues)), lo, hi, inclusive)
+        if len(s) == 0:
+            return np.array([], dtype=np.int64)
+        return np.asarray(self.scanorder[self.scanptr[s[0]]:self.scanptr[s[-1] + 1]])
+
+    def mz_index(self, lo=None, hi=None, inclusive=False):
+        """
+        Find the ions with m/z in a range.
+        :param lo: Lower m/z bound. None for no bound.
+        :param hi: Upper m/z bound. None for no bound.
+        :param inclusive: If True, bounds are included. If False (default), bounds are excluded.
+        :return: Indexes of the ions, in m/z order
+        """
+        return range_index(self.mzsorted, self.mzorder, lo, hi, inclusive)
+
+    def select(self, mzrange=None, scanrange=None, intrange=None, inclusive=False):
+        """
+        Find the ions within all of the given ranges. Uses whichever of the m/z or scan indexes selects fewer ions
+        and checks the other ranges on only those ions.
+        :param mzrange: [low, high] m/z. Either bound can be None.
+        :param scanrange: [low, high] scan. Either bound can be None.
+        :param intrange: [low, high] intensity. Either bound can be None.
+        :param inclusive: If True, bounds are included. If False (default), bounds are excluded.
+        :return: Sorted indexes of the ions, or None if no ranges are given
+        """
+        candidates = []
+        if mzrange is not None:
+            candidates.append((0, self.mz_index(mzrange[0], mzrange[1], inclusive)))
+        if scanrange is not None:
+            candidates.append((2, self.scan_index(scanrange[0], scanrange[1], inclusive)))
+        if len(candidates) == 0 and intrange is None:
+            return None
+        used = None
+        if len(candidates) == 0:
+            index = np.arange(len(self))
+        else:
+            used, index = min(candidates, key=lambda c: len(c[1]))
+            if len(index) == len(self):
+                index = np.arange(len(self))
+            else:
+                index = np.sort(index)
+
+        # Check the remaining ranges on the selected ions only
+        for row, r in [(0, mzrange), (2, scanrange), (1, intrange)]:
+            if r is None or row == used or len(index) == 0:
+                continue
+            values = self.ions[row][index]
+            keep = np.ones(len(index), dtype=bool)
+            if r[0] is not None:
+                keep &= values >= r[0] if inclusive else values > r[0]
+            if r[1] is not None:
+                keep &= values <= r[1] if inclusive else values < r[1]
+            index = index[keep]
+        return index
+
+    def take(self, index=None):
+        """
+        Read ions into memory.
+        :param index: Indexes of the ions from select. None reads all ions.
+        :return: Array with columns m/z, intensity, scan, and inverse injection time
+        """
+        if index is None:
+            return np.transpose(np.array(self.ions))
+        return np.transpose(self.ions[:, index])
+
+    def scan_counts(self, index=None):
+        """
+        Count the ions in each scan.
+        :param index: Indexes of the ions from select. None counts all ions.
+        :return: Scan values, Number of ions in each scan
+        """
+        if index is None:
+            return np.asarray(self.scanvalues), np.diff(self.scanptr)
+        return np.unique(self.ions[2][index], return_counts=True)
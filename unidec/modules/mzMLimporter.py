@@ -24,8 +24,18 @@ def gzip_files(mzml_path, out_path):
 
 
 def auto_gzip(mzml_path):
+    """
+    Get an indexed gzip copy of an mzML file. An existing copy is reused if it is newer than the mzML file, so the
+    copy and its scan index are only rebuilt when the mzML file changes.
+    :param mzml_path: .mzML file path
+    :return: .mzML.gz file path
+    """
     out_path = mzml_path + ".gz"
+    if os.path.isfile(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(mzml_path):
+        print("Using existing gzip file:", out_path)
+        return out_path
     gzip_files(mzml_path, out_path)
+    print("Converted to gzip file to improve speed:", out_path)
     return out_path
 
 
@@ -223,6 +233,117 @@ def get_im_data_from_spectrum(spectrum, threshold=-1):
     return impdat
 
 
+def get_index_path(path):
+    """
+    Get the path of the sidecar scan index for an mzML file.
+    :param path: .mzML or .mzML.gz file path
+    :return: Path of the index file
+    """
+    return path + "_scanindex.npz"
+
+
+def get_file_stamp(path):
+    """
+    Get the size and modification time of a file, which are used to check that a scan index is still valid.
+    :param path: File path
+    :return: Array of [size, mtime]
+    """
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime], dtype=float)
+
+
+def scan_spectrum_offsets(path, chunksize=2 ** 24):
+    """
+    Find the byte offset of every <spectrum> element in a plain mzML file in one pass over the raw bytes.
+    Offsets are returned in file order, which is the same order pymzml iterates the spectra.
+    :param path: .mzML file path
+    :param chunksize: Number of bytes to read at a time
+    :return: Array of byte offsets
+    """
+    tag = b"<spectrum "
+    offsets = []
+    position = 0
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            buffer = tail + chunk
+            start = position - len(tail)
+            i = buffer.find(tag)
+            while i >= 0:
+                offsets.append(start + i)
+                i = buffer.find(tag, i + 1)
+            # Keep enough of the end to catch a tag split across chunks, but not a full tag
+            tail = buffer[-(len(tag) - 1):]
+            position += len(chunk)
+    return np.array(offsets, dtype=np.int64)
+
+
+def get_polarity_from_spectrum(spectrum):
+    """
+    Get the polarity of a spectrum from its cvParams.
+    :param spectrum: pymzml spectrum
+    :return: 1 for positive, -1 for negative, 0 for unknown
+    """
+    if spectrum.get("MS:1000129") is not None:
+        return -1
+    elif spectrum.get("MS:1000130") is not None:
+        return 1
+    return 0
+
+
+def get_tic_from_spectrum(spectrum):
+    """
+    Get the total ion current of a spectrum. Uses the cvParam if present and otherwise sums the intensities.
+    :param spectrum: pymzml spectrum
+    :return: TIC (float)
+    """
+    try:
+        return float(spectrum.TIC)
+    except Exception:
+        try:
+            return float(np.sum(spectrum.i))
+        except Exception:
+            return 0
+
+
+def save_scan_index(path, index, stamp):
+    """
+    Write the scan index to the sidecar file. Failures are not fatal because the index can always be rebuilt.
+    :param path: mzML file path
+    :param index: Dictionary of index arrays
+    :param stamp: Output of get_file_stamp for the mzML file
+    :return: None
+    """
+    try:
+        np.savez(get_index_path(path), stamp=stamp, **index)
+    except Exception as e:
+        print("Could not write scan index:", e)
+
+
+def load_scan_index(path):
+    """
+    Load the sidecar scan index for an mzML file if it exists and matches the current file size and mtime.
+    :param path: mzML file path
+    :return: Dictionary of index arrays or None if no valid index is found
+    """
+    indexpath = get_index_path(path)
+    if not os.path.isfile(indexpath):
+        return None
+    try:
+        with np.load(indexpath, allow_pickle=False) as npz:
+            index = {k: npz[k] for k in npz.files}
+        if not np.array_equal(index.pop("stamp"), get_file_stamp(path)):
+            print("Scan index out of date, rebuilding:", indexpath)
+            return None
+    except Exception as e:
+        print("Could not read scan index:", e)
+        return None
+    return index
+
+
 def search_by_id(obo, id):
     key = "MS:{0}".format(id)
     return_value = ""
@@ -256,16 +377,46 @@ class mzMLimporter:
         if not os.path.splitext(path)[1] == ".gz" and (
                 self.filesize > 1e8 or gzmode) and not nogz:  # for files larger than 100 MB
             path = auto_gzip(path)
-            print("Converted to gzip file to improve speed:", path)
             self.filesize = os.stat(path).st_size
         self.path = path
         self.msrun = pymzml.run.Reader(path)
         self.data = None
-        # self.scans = []
-        self.times = []
-        self.ids = []
+        self.seeded_file = None
+
+        index = load_scan_index(path)
+        if index is None:
+            index = self.build_scan_index()
+            save_scan_index(path, index, get_file_stamp(path))
+        else:
+            print("Loaded scan index:", get_index_path(path))
+        self.times = index["times"]
+        self.ids = index["ids"]
+        self.offsets = index["offsets"]
+        self.spectrum_index = index["spectrum_index"]
+        self.mslevels = index["mslevels"]
+        self.polarities = index["polarities"]
+        self.tics = index["tics"]
+        self.seed_offsets()
+        self.scans = np.arange(0, len(self.ids))
+        print("Reading Complete", len(self.scans))
 
+    def build_scan_index(self):
+        """
+        Read through the file once and record the id, time, MS level, polarity, TIC, and byte offset of each scan.
+        :return: Dictionary of index arrays
+        """
+        times = []
+        ids = []
+        spectrum_index = []
+        mslevels = []
+        polarities = []
+        tics = []
+
+        n = -1
         for i, spectrum in enumerate(self.msrun):
+            if isinstance(spectrum, pymzml.spec.Spectrum):
+                # Position of this spectrum in the file, counting all spectra
+                n += 1
             if '_scan_time' in list(spectrum.__dict__.keys()):
                 try:
                     if spectrum.ms_level is None:
@@ -275,23 +426,57 @@ class mzMLimporter:
                 try:
                     t = spectrum.scan_time_in_minutes()
                     id = spectrum.ID
-                    self.times.append(float(t))
+                    times.append(float(t))
                 except Exception as e:
-                    self.times.append(-1)
+                    times.append(-1)
                     id = -1
                     print("1", spectrum, e)
-                # self.scans.append(i)
-                self.ids.append(id)
-                # print(i, end=" ")
+                ids.append(id)
+                spectrum_index.append(n)
+                try:
+                    mslevels.append(int(spectrum.ms_level))
+                except:
+                    mslevels.append(0)
+                polarities.append(get_polarity_from_spectrum(spectrum))
+                tics.append(get_tic_from_spectrum(spectrum))
             else:
                 print("Scan time not found", i)
-        self.times = np.array(self.times)
-        self.ids = np.array(self.ids)
-        self.scans = np.arange(0, len(self.ids))
-        print("Reading Complete", len(self.scans))
+
+        spectrum_index = np.array(spectrum_index, dtype=np.int64)
+        offsets = np.full(len(spectrum_index), -1, dtype=np.int64)
+        if os.path.splitext(self.path)[1].lower() != ".gz":
+            try:
+                alloffsets = scan_spectrum_offsets(self.path)
+                if len(alloffsets) > n:
+                    offsets = alloffsets[spectrum_index]
+            except Exception as e:
+                print("Could not find scan offsets:", e)
+
+        return {"times": np.array(times), "ids": np.array(ids), "offsets": offsets,
+                "spectrum_index": spectrum_index, "mslevels": np.array(mslevels, dtype=int),
+                "polarities": np.array(polarities, dtype=int), "tics": np.array(tics, dtype=float)}
+
+    def seed_offsets(self):
+        """
+        Pass the byte offsets from the scan index to pymzml so that random access to scans does not need to search.
+        :return: None
+        """
+        fileobject = self.msrun.info["file_object"]
+        if fileobject is self.seeded_file:
+            return
+        try:
+            offset_dict = fileobject.file_handler.offset_dict
+            for id, offset in zip(self.ids, self.offsets):
+                id = id.item()
+                if offset >= 0 and id not in offset_dict:
+                    offset_dict[id] = (int(offset),)
+            self.seeded_file = fileobject
+        except Exception as e:
+            print("Could not use scan index offsets:", e)
 
     def grab_scan_data(self, scan):
         try:
+            self.seed_offsets()
             data = get_data_from_spectrum(self.msrun[self.ids[scan]])
         except Exception as e:
             print("Error in grab_scan_data:", e)
@@ -342,6 +527,76 @@ class mzMLimporter:
                 print("Error", e, "With scan number:", i)'''
         return template
 
+    def make_template(self, data, mzbins=None):
+        """
+        Make an empty template spectrum spanning the m/z range of data.
+        :param data: N x 2 data used to set the range and resolution of the axis
+        :param mzbins: Optional linear m/z bin size. If None or 0, a nonlinear axis with the resolution of data is used.
+        :return: Template N x 2 array with zero intensity
+        """
+        if mzbins is None or float(mzbins) == 0:
+            resolution = get_resolution(data)
+            if resolution <= 0:
+                print("ERROR with auto resolution:", resolution, "Using 20000.")
+                resolution = 20000
+            axis = ud.nonlinear_axis(np.amin(data[:, 0]), np.amax(data[:, 0]), resolution)
+        else:
+            axis = np.arange(np.amin(data[:, 0]), np.amax(data[:, 0]), float(mzbins))
+        return np.transpose([axis, np.zeros_like(axis)])
+
+    def get_data_streaming(self, scan_range=None, time_range=None, mzbins=None, type="Interpolate"):
+        """
+        Merge scans into a single spectrum while reading through the file once.
+        Each scan is summed into the template axis as soon as it is read, so memory does not grow with file size.
+        :param scan_range: Range of scans to merge, as indexes into self.scans
+        :param time_range: Range of times to merge. Overrides scan_range.
+        :param mzbins: Optional linear m/z bin size. If None or 0, a nonlinear axis is made from the first scan.
+        :param type: "Interpolate" (default) or "Integrate", as in merge_spectra
+        :return: Merged N x 2 data set
+        """
+        if time_range is not None:
+            scan_range = self.get_scans_from_times(time_range)
+            print("Getting times:", time_range)
+        if scan_range is None:
+            scan_range = [int(np.amin(self.scans)), int(np.amax(self.scans))]
+        print("Scan Range:", scan_range)
+        selected = self.spectrum_index[int(scan_range[0]):int(scan_range[1]) + 1]
+        if len(selected) == 0:
+            print("Error: Empty Data Object")
+            return None
+
+        last = selected[-1]
+        selected = set(selected.tolist())
+        template = None
+        # Use a separate reader so random access on self.msrun does not disturb the stream
+        run = pymzml.run.Reader(self.path)
+        n = -1
+        for spec in run:
+            if not isinstance(spec, pymzml.spec.Spectrum):
+                continue
+            n += 1
+            if n > last:
+                break
+            if n not in selected:
+                continue
+            try:
+                data = get_data_from_spectrum(spec)
+                if template is None:
+                    # Build the template axis from the first scan, as in get_data_memory_safe
+                    template = self.make_template(data, mzbins)
+                if len(data) > 2:
+                    if type == "Interpolate":
+                        newdat = ud.mergedata(template, data)
+                    else:
+                        newdat = ud.lintegrate(data, template[:, 0])
+                    template[:, 1] += newdat[:, 1]
+            except Exception as e:
+                print("Error", e, "With spectrum number:", n)
+        run.close()
+        if template is None:
+            print("Error: Empty Data Object")
+        return template
+
     def grab_data(self, threshold=-1):
         print("Grabbing Data")
         newtimes = []
@@ -387,7 +642,8 @@ class mzMLimporter:
         if self.data is None:
             self.grab_data()
 
-        data = deepcopy(self.data)
+        # Slicing gives a view; merge_spectra does not modify the scans so no copy is needed
+        data = self.data
         if time_range is not None:
             scan_range = self.get_scans_from_times(time_range)
             print("Getting times:", time_range)
@@ -411,7 +667,8 @@ class mzMLimporter:
                 data = ud.removeduplicates(sort)
                 print("2", e)
         elif len(data) == 1:
-            data = data[0]
+            # Copy so callers cannot modify the stored scan
+            data = np.copy(data[0])
         else:
             data = data
         # plt.figure()
@@ -426,7 +683,7 @@ class mzMLimporter:
         """
         if self.filesize > 1e9 and self.data is None:
             try:
-                data = self.get_data_memory_safe(scan_range, time_range)
+                data = self.get_data_streaming(scan_range, time_range)
             except Exception as e:
                 print("Error in Memory Safe mzML, trying memory heavy method")
                 data = self.get_data_fast_memory_heavy(scan_range, time_range)
@@ -443,6 +700,8 @@ class mzMLimporter:
                 raise Exception
         except:
             print("Error getting TIC in mzML; trying to make it...")
+            if len(self.tics) == len(self.times) and self.data is None:
+                return np.transpose([self.times, self.tics])
 
             tic = []
             self.grab_data()
@@ -606,6 +865,14 @@ class mzMLimporter:
         return data
 
     def get_polarity(self, scan=1):
+        # The scan index stores polarity by position in the file, so look it up there first
+        pos = np.flatnonzero(self.spectrum_index == scan)
+        if len(pos) > 0 and self.polarities[pos[0]] != 0:
+            if self.polarities[pos[0]] < 0:
+                print("Polarity: Negative")
+                return "Negative"
+            print("Polarity: Positive")
+            return "Positive"
         for s, spec in enumerate(self.msrun):
             if s == scan:
                 # spec = self.msrun[scan]
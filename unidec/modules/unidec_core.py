@@ -0,0 +1,821 @@
+"""
+In-process port of the UniDec core deconvolution (MainDeconvolution in src/UniDec_Main.h).
+
+Takes the processed data and the config as arrays and returns the mass data, mass grid, m/z grid, and fit data
+without writing the _input.dat/_conf.dat files or calling the external binary. Features that are not ported
+(see core_supported) fall back to the executable in UniDec.run_unidec.
+"""
+
+import time
+import numpy as np
+from numba import njit, prange
+
+__author__ = 'Michael.Marty'
+
+# Factor to convert Gaussian FWHM to sigma, as in PostImport in UniDec.h
+fwhm_to_sigma = 2.35482
+# Number of peak widths to extend the peak shape, config.psthresh in the C code
+psthresh = 6
+
+
+def core_supported(config):
+    """
+    Check whether the options in config are covered by the in-process core.
+    :param config: UniDecConfig object
+    :return: True if run_core can be used, False if the external binary is needed
+    """
+    if config.imflag != 0 or config.cdmsflag != 0 or config.metamode != -2:
+        return False
+    if config.isotopemode != 0 or config.doubledec or config.autotune:
+        return False
+    if config.aggressiveflag != 0:
+        return False
+    if config.mfileflag or config.manualfileflag:
+        return False
+    if config.mzsig < 0 or config.psig < 0 or config.beta < 0:
+        return False
+    if config.poolflag not in [0, 1, 2]:
+        return False
+    return True
+
+
+@njit(fastmath=True, cache=True)
+def nearfast(xarray, point):
+    """
+    Find the index of the nearest point in a sorted array. Port of nearfast from UniDec.h, including tie-breaking.
+    :param xarray: Sorted array
+    :param point: Target value
+    :return: Index of the closest value
+    """
+    start = 0
+    length = len(xarray) - 1
+    diff = length - start
+    while diff > 1:
+        mid = start + (length - start) // 2
+        if point < xarray[mid]:
+            length = mid
+        elif point == xarray[mid]:
+            return mid
+        else:
+            start = mid
+        diff = length - start
+    if abs(point - xarray[start]) >= abs(point - xarray[length]):
+        return length
+    return start
+
+
+@njit(fastmath=True, cache=True)
+def mzpeakshape(x, y, sig, psfun):
+    if psfun == 0:
+        return np.exp(-((x - y) ** 2) / (2 * sig * sig))
+    elif psfun == 1:
+        return (sig / 2) ** 2 / ((x - y) ** 2 + (sig / 2) ** 2)
+    else:
+        if y < x:
+            return np.exp(-((x - y) ** 2) / (2 * sig * sig * 0.180337))
+        else:
+            return (sig / 2) ** 2 / ((x - y) ** 2 + (sig / 2) ** 2)
+
+
+@njit(fastmath=True, cache=True)
+def fixk(k, lengthmz):
+    k = abs(k)
+    if k >= lengthmz:
+        k = 2 * lengthmz - k - 2
+    return k
+
+
+@njit(fastmath=True, cache=True)
+def make_barr(mtab, nztab, massub, masslb, nativezub, nativezlb):
+    """
+    Boolean array of allowed m/z and charge combinations. Port of TestMass from UniDec.h.
+    The intensity threshold (KillB) is applied separately after the blur neighbors are found, as in the C code.
+    """
+    lengthmz, numz = mtab.shape
+    barr = np.zeros((lengthmz, numz), dtype=np.bool_)
+    for i in range(lengthmz):
+        for j in range(numz):
+            testmass = mtab[i, j]
+            nativelimit = 0.0467 * testmass ** 0.533
+            if masslb < testmass < massub and nativelimit + nativezlb < nztab[j] < nativelimit + nativezub:
+                barr[i, j] = True
+    return barr
+
+
+@njit(fastmath=True, cache=True)
+def make_sparse_blur(mz, mtab, nztab, barr, closemind, closezind, closeval, mzsig, psfun, molig, adductmass,
+                     massbins):
+    """
+    Port of MakeSparseBlur. Finds the neighbors in charge and oligomer mass for each point in the grid.
+    :return: closeind, closearray (lengthmz * numz x numclose). Points with fewer than two neighbors are removed
+    from barr in place.
+    """
+    lengthmz, numz = mtab.shape
+    numclose = len(closeval)
+    closeind = np.full((lengthmz * numz, numclose), -1, dtype=np.int64)
+    closearray = np.zeros((lengthmz * numz, numclose), dtype=np.float64)
+    for i in range(lengthmz):
+        for j in range(numz):
+            if not barr[i, j]:
+                continue
+            num = 0
+            sig = mzsig
+            if sig == 0:
+                i1 = i - 1
+                i2 = i + 1
+                if i >= lengthmz - 1:
+                    i2 = i
+                if i == 0:
+                    i1 = i
+                sig = 2 * abs(mz[i2] - mz[i1])
+                if sig > massbins or sig == 0:
+                    sig = massbins * 2
+            newthreshold = sig * 2
+            index = i * numz + j
+            for k in range(numclose):
+                indz = j + closezind[k]
+                if indz < 0 or indz >= numz or (nztab[j] + closezind[k]) == 0:
+                    continue
+                newz = nztab[j] + closezind[k]
+                point = (mtab[i, j] + closemind[k] * molig + adductmass * newz) / newz
+                if point < mz[0] - newthreshold or point > mz[lengthmz - 1] + newthreshold:
+                    continue
+                ind = nearfast(mz, point)
+                closepoint = mz[ind]
+                # barr is updated as the loop goes, so points already removed are not counted, as in the C code
+                if barr[ind, indz] and abs(point - closepoint) < newthreshold:
+                    closeind[index, k] = ind * numz + indz
+                    closearray[index, k] = closeval[k] * mzpeakshape(point, closepoint, sig, psfun)
+                    num += 1
+            if num < 2:
+                barr[i, j] = False
+    return closeind, closearray
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def blur_it_mean(closeind, logclosearray, blur, barr, zerolog):
+    """
+    Charge and mass smoothing with a mean filter of the log. Port of blur_it_mean.
+    The log of the blur is taken once per point and added to the precomputed log of the neighbor weights.
+    """
+    ln, numclose = closeind.shape
+    if numclose == 1:
+        return blur.copy()
+    logblur = np.zeros(ln)
+    for i in prange(ln):
+        if blur[i] > 0:
+            logblur[i] = np.log(blur[i])
+    newblur = np.zeros(ln)
+    for i in prange(ln):
+        if barr[i]:
+            temp = 0.
+            for k in range(numclose):
+                ind = closeind[i, k]
+                if ind != -1 and blur[ind] > 0:
+                    temp += logblur[ind] + logclosearray[i, k]
+                else:
+                    temp += zerolog
+            newblur[i] = np.exp(temp / numclose)
+    return newblur
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def blur_it(closeind, closearray, blur, barr):
+    """
+    Charge and mass smoothing as a weighted sum. Port of blur_it.
+    """
+    ln, numclose = closeind.shape
+    newblur = np.zeros(ln)
+    if numclose == 1:
+        return blur.copy()
+    for i in prange(ln):
+        if barr[i]:
+            temp = 0.
+            for k in range(numclose):
+                ind = closeind[i, k]
+                if ind != -1:
+                    temp += closearray[i, k] * blur[ind]
+            newblur[i] = temp
+    return newblur
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def blur_it_hybrid(closeind, closearray, blur, barr, zlength, mlength, mdist, zdist, zerolog, logz):
+    """
+    Hybrid smoothing with the log mean over one dimension and the weighted sum over the other.
+    Port of blur_it_hybrid1 (logz=True) and blur_it_hybrid2 (logz=False).
+    """
+    ln, numclose = closeind.shape
+    newblur = np.zeros(ln)
+    if numclose == 1:
+        return blur.copy()
+    for i in prange(ln):
+        if barr[i]:
+            temp = 0.
+            for n in range(mlength):
+                temp2 = 0.
+                for k in range(zlength):
+                    m = k * mlength + n
+                    ind = closeind[i, m]
+                    if logz:
+                        temp3 = 0.
+                        if ind != -1:
+                            temp3 = blur[ind] * closearray[i, m]
+                        if temp3 > 0:
+                            temp2 += np.log(temp3)
+                        else:
+                            temp2 += zerolog
+                    elif ind != -1:
+                        temp2 += blur[ind] * zdist[k] * closearray[i, m]
+                if logz:
+                    temp += np.exp(temp2 / zlength) * mdist[n]
+                elif temp2 > 0:
+                    temp += np.log(temp2)
+                else:
+                    temp += zerolog
+            if logz:
+                newblur[i] = temp
+            else:
+                newblur[i] = np.exp(temp / mlength)
+    return newblur
+
+
+@njit(fastmath=True, cache=True)
+def set_starts_ends(mz, psmzthresh, speedyflag):
+    """
+    Port of SetStartsEnds. Sets the range of m/z indexes covered by the peak shape for each point.
+    """
+    lengthmz = len(mz)
+    starttab = np.zeros(lengthmz, dtype=np.int64)
+    endtab = np.zeros(lengthmz, dtype=np.int64)
+    maxlength = 1
+    for i in range(lengthmz):
+        point = mz[i] - psmzthresh
+        if point < mz[0] and speedyflag == 0:
+            start = 0 - nearfast(mz, 2 * mz[0] - point)
+        else:
+            start = nearfast(mz, point)
+        starttab[i] = start
+
+        point = mz[i] + psmzthresh
+        if point > mz[lengthmz - 1] and speedyflag == 0:
+            end = lengthmz - 1 + nearfast(mz, 2 * mz[0] - point)
+        else:
+            end = nearfast(mz, point)
+        endtab[i] = end
+        if end - start > maxlength:
+            maxlength = end - start
+    return starttab, endtab, maxlength
+
+
+@njit(fastmath=True, cache=True)
+def make_peak_shape_2d(mz, starttab, endtab, maxlength, mzsig, psfun):
+    lengthmz = len(mz)
+    mzdist = np.zeros((lengthmz, maxlength))
+    for i in range(lengthmz):
+        start = starttab[i]
+        for j in range(start, endtab[i] + 1):
+            j2 = fixk(j, lengthmz)
+            if 0 <= j2 - start < maxlength:
+                mzdist[i, j2 - start] = mzpeakshape(mz[i], mz[j2], mzsig, psfun)
+    return mzdist
+
+
+@njit(fastmath=True, cache=True)
+def make_peak_shape_1d(mz, threshold, mzsig, psfun):
+    lengthmz = len(mz)
+    mzdist = np.zeros((1, lengthmz))
+    binsize = mz[1] - mz[0]
+    newrange = int(threshold / binsize)
+    for n in range(-newrange, newrange):
+        mzdist[0, n % lengthmz] = mzpeakshape(0, n * binsize, mzsig, psfun)
+    return mzdist
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def convolve_simp(starttab, endtab, mzdist, deltas, speedyflag):
+    """
+    Convolve a 1D array with the peak shape. Port of convolve_simp.
+    """
+    lengthmz = len(deltas)
+    denom = np.zeros(lengthmz)
+    for i in prange(lengthmz):
+        cv = 0.
+        for k in range(starttab[i], endtab[i] + 1):
+            if speedyflag == 0:
+                k2 = fixk(k, lengthmz)
+                ind = i - starttab[k2]
+                if 0 <= ind < mzdist.shape[1]:
+                    cv += deltas[k2] * mzdist[k2, ind]
+            else:
+                cv += deltas[k] * mzdist[0, (i - k) % lengthmz]
+        denom[i] = cv
+    return denom
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def reconvolve(starttab, endtab, mzdist, blur, barr, speedyflag):
+    """
+    Convolve each charge state in the grid with the peak shape. Port of Reconvolve.
+    """
+    lengthmz, numz = blur.shape
+    newblur = np.zeros((lengthmz, numz))
+    for i in prange(lengthmz):
+        for j in range(numz):
+            if barr[i, j]:
+                cv = 0.
+                for k in range(starttab[i], endtab[i] + 1):
+                    if speedyflag == 0:
+                        k2 = fixk(k, lengthmz)
+                        ind = i - starttab[k2]
+                        if blur[k2, j] != 0 and 0 <= ind < mzdist.shape[1]:
+                            cv += blur[k2, j] * mzdist[k2, ind]
+                    elif blur[k, j] != 0:
+                        cv += blur[k, j] * mzdist[0, (i - k) % lengthmz]
+                newblur[i, j] = cv
+    return newblur
+
+
+@njit(fastmath=True, cache=True)
+def softargmax(blur, beta):
+    """
+    Port of softargmax. Applies a softmax across charge states for each m/z value.
+    """
+    lengthmz, numz = blur.shape
+    out = np.zeros((lengthmz, numz))
+    for i in range(lengthmz):
+        sum1 = 0.
+        sum2 = 0.
+        min2 = 1e12
+        for j in range(numz):
+            d = blur[i, j]
+            sum1 += d
+            e = np.exp(beta * d)
+            if e < min2:
+                min2 = e
+            out[i, j] = e
+            sum2 += e
+        factor = 0.
+        denom = sum2 - min2 * numz
+        if denom != 0:
+            factor = sum1 / denom
+        if factor > 0:
+            for j in range(numz):
+                out[i, j] = (out[i, j] - min2) * factor
+        else:
+            for j in range(numz):
+                out[i, j] = 0
+    return out
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def point_smoothing(blur, barr, width):
+    """
+    Port of point_smoothing. Boxcar average along the m/z axis for allowed points.
+    """
+    lengthmz, numz = blur.shape
+    out = blur.copy()
+    for i in prange(lengthmz):
+        low = max(i - width, 0)
+        high = min(i + width + 1, lengthmz)
+        for j in range(numz):
+            if barr[i, j]:
+                s = 0.
+                for k in range(low, high):
+                    s += blur[k, j]
+                out[i, j] = s / (1. + 2 * width)
+    return out
+
+
+@njit(fastmath=True, cache=True)
+def integrate_transform(mtab, blur, massaxis, massmax, massmin):
+    """
+    Port of IntegrateTransform. Splits each m/z grid point between the two nearest mass bins.
+    """
+    lengthmz, numz = mtab.shape
+    mlen = len(massaxis)
+    massgrid = np.zeros((mlen, numz))
+    for i in range(lengthmz):
+        for j in range(numz):
+            testmass = mtab[i, j]
+            if massmin < testmass < massmax:
+                index = nearfast(massaxis, testmass)
+                newval = blur[i, j]
+                if massaxis[index] == testmass:
+                    massgrid[index, j] += newval
+                if massaxis[index] < testmass and index < mlen - 2:
+                    index2 = index + 1
+                    interpos = (testmass - massaxis[index]) / (massaxis[index2] - massaxis[index])
+                    massgrid[index, j] += (1.0 - interpos) * newval
+                    massgrid[index2, j] += interpos * newval
+                if massaxis[index] > testmass and index > 0:
+                    index2 = index - 1
+                    interpos = (testmass - massaxis[index]) / (massaxis[index2] - massaxis[index])
+                    massgrid[index, j] += (1 - interpos) * newval
+                    massgrid[index2, j] += interpos * newval
+    return massgrid
+
+
+@njit(fastmath=True, cache=True)
+def cubic_interpolate(y0, y1, y2, y3, mu):
+    mu2 = mu * mu
+    a0 = y3 - y2 - y0 + y1
+    a1 = y0 - y1 - a0
+    a2 = y2 - y0
+    a3 = y1
+    return a0 * mu * mu2 + a1 * mu2 + a2 * mu + a3
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def interpolate_transform(mz, nztab, blur, massaxis, adductmass):
+    """
+    Port of InterpolateTransform. Cubic interpolation of the m/z grid at each point on the mass axis.
+    """
+    lengthmz, numz = blur.shape
+    mlen = len(massaxis)
+    massgrid = np.zeros((mlen, numz))
+    for i in prange(mlen):
+        for j in range(numz):
+            mztest = (massaxis[i] + nztab[j] * adductmass) / nztab[j]
+            if mz[0] < mztest < mz[lengthmz - 1]:
+                index = nearfast(mz, mztest)
+                index2 = index
+                if mz[index] == mztest:
+                    massgrid[i, j] = blur[index, j]
+                else:
+                    if mz[index] > mztest and 1 < index < lengthmz - 1:
+                        index2 = index
+                        index = index - 1
+                    elif mz[index] < mztest and 0 < index < lengthmz - 2:
+                        index2 = index + 1
+                    if index2 > index and (mz[index2] - mz[index]) != 0:
+                        mu = (mztest - mz[index]) / (mz[index2] - mz[index])
+                        newval = cubic_interpolate(blur[index - 1, j], blur[index, j], blur[index2, j],
+                                                   blur[index2 + 1, j], mu)
+                        massgrid[i, j] = max(newval, 0)
+    return massgrid
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def smart_transform(mz, nztab, blur, massaxis, adductmass):
+    """
+    Port of SmartTransform. Interpolates where the m/z grid is sparse relative to the mass axis and integrates
+    where it is dense.
+    """
+    lengthmz, numz = blur.shape
+    mlen = len(massaxis)
+    massgrid = np.zeros((mlen, numz))
+    startmzval = mz[0]
+    endmzval = mz[lengthmz - 1]
+    for i in prange(mlen):
+        for j in range(numz):
+            z = nztab[j]
+            mtest = massaxis[i]
+            mztest = (mtest + z * adductmass) / z
+            if i > 0:
+                mlower = massaxis[i - 1]
+                mzlower = (mlower + z * adductmass) / z
+            else:
+                mzlower = mztest
+                mlower = mtest
+            if i < mlen - 1:
+                mupper = massaxis[i + 1]
+                mzupper = (mupper + z * adductmass) / z
+            else:
+                mzupper = mztest
+                mupper = mtest
+
+            if not (mzupper > startmzval and mzlower < endmzval):
+                continue
+            index = nearfast(mz, mztest)
+            index1 = nearfast(mz, mzlower)
+            index2 = nearfast(mz, mzupper)
+            imz = mz[index]
+            newval = 0.
+            if index2 - index1 < 5:
+                if imz == mztest:
+                    newval = max(blur[index, j], 0)
+                else:
+                    edge = 0
+                    index2 = index
+                    if imz > mztest:
+                        index = index - 1
+                    elif imz < mztest:
+                        index2 = index + 1
+                    if index < 1 or index2 >= lengthmz - 1:
+                        edge = 1
+                    if index < 0 or index2 >= lengthmz:
+                        edge = 2
+                    if edge == 0 and index2 > index and (mz[index2] - mz[index]) != 0:
+                        mu = (mztest - mz[index]) / (mz[index2] - mz[index])
+                        newval = max(cubic_interpolate(blur[index - 1, j], blur[index, j], blur[index2, j],
+                                                       blur[index2 + 1, j], mu), 0)
+                    elif edge == 1 and (mz[index2] - mz[index]) != 0:
+                        mu = (mztest - mz[index]) / (mz[index2] - mz[index])
+                        newval = max(blur[index, j] * (1 - mu) + blur[index2, j] * mu, 0)
+                    elif edge == 2:
+                        if index2 == 0:
+                            index = 0
+                            index2 = 1
+                        if index == lengthmz - 1:
+                            index2 = lengthmz - 2
+                        if (mz[index2] - mz[index]) != 0 and 0 <= index < lengthmz:
+                            mu = (mztest - mz[index]) / (mz[index] - mz[index2])
+                            newval = max(blur[index, j] * (1 - mu), 0)
+            else:
+                num = 0.
+                for k in range(index1, index2 + 1):
+                    kmz = mz[k]
+                    km = (kmz - adductmass) * z
+                    if mztest < kmz and km < mupper:
+                        scale = (km - mupper) / (mtest - mupper) if mtest != mupper else 0.
+                    elif kmz < mztest and km > mlower:
+                        scale = (km - mlower) / (mtest - mlower) if mtest != mlower else 0.
+                    elif kmz == mztest:
+                        scale = 1.
+                    else:
+                        scale = 0.
+                    newval += scale * blur[k, j]
+                    num += scale
+                if num != 0:
+                    newval /= num
+                newval = max(newval, 0)
+            massgrid[i, j] = newval
+    return massgrid
+
+
+def make_blur_tables(config, mzsig, mz, mtab, nztab, barr):
+    """
+    Set up the charge and oligomer neighborhoods and the smoothing weights as in MainDeconvolution.
+    :return: closeind, closearray, zlength, mlength, mdist, zdist
+    """
+    zsig = config.zzsig
+    msig = config.msig
+    if zsig >= 0 and msig >= 0:
+        zlength = 1 + 2 * int(zsig)
+        mlength = 1 + 2 * int(msig)
+    else:
+        zlength = 1 + 2 * int(3 * abs(zsig) + 0.5) if zsig != 0 else 1
+        mlength = 1 + 2 * int(3 * abs(msig) + 0.5) if msig != 0 else 1
+
+    mind = np.arange(mlength) - (mlength - 1) // 2
+    zind = np.arange(zlength) - (zlength - 1) // 2
+    if msig != 0:
+        mdist = np.exp(-((np.arange(mlength) - (mlength - 1) / 2.) ** 2) / (2.0 * msig * msig))
+    else:
+        mdist = np.ones(mlength)
+    if zsig != 0:
+        zdist = np.exp(-((np.arange(zlength) - (zlength - 1) / 2.) ** 2) / (2.0 * zsig * zsig))
+    else:
+        zdist = np.ones(zlength)
+
+    k = np.arange(mlength * zlength)
+    closemind = mind[k % mlength]
+    closezind = zind[k // mlength]
+    closeval = zdist[k // mlength] * mdist[k % mlength]
+    mdist = mdist / np.sum(mdist)
+    zdist = zdist / np.sum(zdist)
+    closeval = closeval / np.sum(closeval)
+
+    closeind, closearray = make_sparse_blur(mz, mtab, nztab, barr, closemind, closezind, closeval, mzsig,
+                                            int(config.psfun), float(config.molig), float(config.adductmass),
+                                            float(config.massbins))
+    return closeind, closearray, zlength, mlength, mdist, zdist
+
+
+def run_core(data2, config, silent=False):
+    """
+    Run the UniDec deconvolution in process.
+    :param data2: Processed data (N x 2) (m/z intensity)
+    :param config: UniDecConfig object
+    :param silent: Whether to suppress printing
+    :return: Dictionary with massdat (M x 2), massgrid (M * numz), mzgrid (N * numz), fitdat (N), error (sum of
+    squared errors), rsquared, and iterations. The grids are flattened in the same order as the binary outputs.
+    """
+    tstart = time.perf_counter()
+    # The binary reads _input.dat, which dataexport writes with six decimals, as single precision floats.
+    # Round the same way so that the allowed points, and so the mass axis, match the binary.
+    data2 = np.round(np.asarray(data2, dtype=float), 6).astype(np.float32)
+    mz = np.array(data2[:, 0], dtype=float)
+    ints = np.array(data2[:, 1], dtype=float)
+    lengthmz = len(mz)
+    nztab = np.arange(config.startz, config.endz + 1).astype(float)
+    numz = len(nztab)
+
+    params = get_core_params(config)
+    mzsig = params["mzsig"]
+    inflate = params["inflate"]
+    psmzthresh = params["psmzthresh"]
+    speedyflag = params["speedyflag"]
+
+    # Set up the grids, the allowed points, and the smoothing neighborhoods
+    mtab = np.outer(mz, nztab) - config.adductmass * nztab
+    barr = make_barr(mtab, nztab, params["massub"], params["masslb"], float(config.nativezub),
+                     float(config.nativezlb))
+
+    maxlength = 0
+    starttab = np.zeros(lengthmz, dtype=np.int64)
+    endtab = np.zeros(lengthmz, dtype=np.int64)
+    mzdist = np.zeros((1, 1))
+    if mzsig != 0:
+        starttab, endtab, maxlength = set_starts_ends(mz, psmzthresh, speedyflag)
+        if speedyflag == 0:
+            mzdist = make_peak_shape_2d(mz, starttab, endtab, maxlength, mzsig * inflate, int(config.psfun))
+        else:
+            mzdist = make_peak_shape_1d(mz, psmzthresh, mzsig * inflate, int(config.psfun))
+    peakshape = (starttab, endtab, mzdist, maxlength)
+
+    closeind, closearray, zlength, mlength, mdist, zdist = make_blur_tables(config, mzsig, mz, mtab, nztab, barr)
+    # Apply the intensity threshold to kill peaks (KillB)
+    if config.intthresh != -1:
+        barr[ints <= config.intthresh] = False
+    flatbarr = np.ravel(barr)
+    logclosearray = np.log(np.clip(closearray, 1e-300, None))
+    if not np.any(barr):
+        print("ERROR: Setup is bad. No points are allowed.")
+        blur = np.zeros((lengthmz, numz))
+        return make_outputs(config, mz, ints, mtab, nztab, blur, blur, barr, peakshape, 0, 0, tstart, silent)
+
+    dmax = np.amax(ints)
+    betafactor = dmax if dmax > 1 else 1
+
+    # Initialize the blur
+    blur = np.where(barr, (ints / (numz + 2.))[:, np.newaxis], 0)
+    newblur = blur.copy()
+    oldblur = blur.copy()
+
+    conv = 0
+    off = 0
+    iterations = 0
+    numit = int(config.numit)
+    zsig = config.zzsig
+    msig = config.msig
+    for iterations in range(abs(numit)):
+        if config.beta > 0 and iterations > 0:
+            blur = softargmax(blur, config.beta / betafactor)
+        if config.psig >= 1 and iterations > 0:
+            blur = point_smoothing(blur, barr, int(abs(config.psig)))
+
+        # Charge and mass smoothing
+        flatblur = np.ravel(blur)
+        if zsig >= 0 and msig >= 0:
+            newblur = blur_it_mean(closeind, logclosearray, flatblur, flatbarr, config.zerolog)
+        elif zsig > 0 > msig:
+            newblur = blur_it_hybrid(closeind, closearray, flatblur, flatbarr, zlength, mlength, mdist, zdist,
+                                     config.zerolog, True)
+        elif zsig < 0 < msig:
+            newblur = blur_it_hybrid(closeind, closearray, flatblur, flatbarr, zlength, mlength, mdist, zdist,
+                                     config.zerolog, False)
+        else:
+            newblur = blur_it(closeind, closearray, flatblur, flatbarr)
+        newblur = newblur.reshape((lengthmz, numz))
+
+        # Richardson-Lucy deconvolution
+        deltas = np.sum(newblur * barr, axis=1)
+        if mzsig != 0:
+            denom = convolve_simp(starttab, endtab, mzdist, deltas, speedyflag)
+        else:
+            denom = deltas
+        b1 = np.logical_and(denom != 0, ints >= 0)
+        denom[b1] = ints[b1] / denom[b1]
+        blur = np.where(barr, newblur * denom[:, np.newaxis], 0)
+
+        # Check convergence periodically
+        if numit < 10 or iterations % 10 == 0 or iterations % 10 == 1 or iterations > 0.9 * numit:
+            diff = np.sum(((blur - oldblur) ** 2)[barr])
+            tot = np.sum(blur[barr])
+            if tot != 0:
+                conv = diff / tot
+            else:
+                if conv == 12345678:
+                    print("m/z vs. charge grid is zero. Iteration:", iterations)
+                    break
+                conv = 12345678
+            if conv < 0.000001:
+                if off == 1 and numit > 0:
+                    if not silent:
+                        print("Converged in", iterations, "iterations.")
+                    break
+                off = 1
+            oldblur = blur.copy()
+
+    return make_outputs(config, mz, ints, mtab, nztab, blur, newblur, barr, peakshape, iterations, conv, tstart,
+                        silent)
+
+
+def get_core_params(config):
+    """
+    Convert the config parameters to the values used in the core, as in PostImport in UniDec.h.
+    :param config: UniDecConfig object
+    :return: Dictionary of converted parameters
+    """
+    mzsig = float(config.mzsig)
+    if config.psfun == 0:
+        mzsig /= fwhm_to_sigma
+    inflate = float(config.inflate)
+    massub = float(config.massub)
+    masslb = float(config.masslb)
+    return {"mzsig": mzsig, "inflate": inflate, "psmzthresh": psthresh * abs(mzsig) * inflate,
+            "speedyflag": 1 if config.linflag not in [-1, 2] else 0, "fixedmassaxis": massub < 0 or masslb < 0,
+            "massub": abs(massub), "masslb": abs(masslb),
+            "massbins": float(config.massbins) if config.massbins != 0 else 1.}
+
+
+def make_outputs(config, mz, ints, mtab, nztab, blur, newblur, barr, peakshape, iterations, conv, tstart, silent):
+    """
+    Apply the cutoff, calculate the fit, and transform the m/z grid to mass as in the end of MainDeconvolution.
+    """
+    starttab, endtab, mzdist, maxlength = peakshape
+    params = get_core_params(config)
+    mzsig = params["mzsig"]
+    speedyflag = params["speedyflag"]
+    psmzthresh = params["psmzthresh"]
+    massub = params["massub"]
+    masslb = params["masslb"]
+    massbins = params["massbins"]
+    fixedmassaxis = params["fixedmassaxis"]
+    lengthmz, numz = blur.shape
+    # Apply the cutoff
+    blurmax = max(np.amax(blur), 0)
+    cutoff = 0.000001 if blurmax != 0 else 0
+    blur[blur < blurmax * cutoff] = 0
+
+    # Calculate the fit data and error
+    deltas = np.sum(blur, axis=1)
+    if maxlength != 0:
+        fitdat = convolve_simp(starttab, endtab, mzdist, deltas, speedyflag)
+    else:
+        fitdat = deltas
+    maxint = max(np.amax(ints), 0)
+    fitmax = max(np.amax(fitdat), 0)
+    if fitmax != 0:
+        fitdat = np.clip(fitdat, 0, None) * maxint / fitmax
+    fitdat[fitdat < 0] = 0
+    error = np.sum((fitdat - ints) ** 2)
+    sstot = np.sum((ints - np.mean(ints)) ** 2)
+    rsquared = 1 - error / sstot if sstot != 0 else 0
+
+    if config.intthresh != -1:
+        zeros = np.logical_and(ints[:-1] == 0, ints[1:] == 0)
+        fitdat[:-1][zeros] = 0
+        fitdat[1:][zeros] = 0
+
+    if config.orbimode == 1:
+        blur = blur / nztab
+
+    # Reconvolve for profile outputs
+    newblurmax = blurmax
+    if config.rawflag == 0 or config.rawflag == 2:
+        if mzsig != 0:
+            newblur = reconvolve(starttab, endtab, mzdist, blur, barr, speedyflag)
+            newblurmax = max(np.amax(newblur), 0)
+        else:
+            newblur = blur.copy()
+
+    # Set up the mass axis
+    if not fixedmassaxis:
+        massmax = masslb
+        massmin = massub
+        b1 = newblur * barr > newblurmax * cutoff
+        if np.any(b1):
+            testmax = (mtab + psmzthresh * nztab + massbins)[b1]
+            testmin = (mtab - psmzthresh * nztab)[b1]
+            massmax = max(np.amax(np.round(testmax / massbins) * massbins), massmax)
+            massmin = min(np.amin(np.round(testmin / massbins) * massbins), massmin)
+    else:
+        massmax = massub
+        massmin = masslb
+    mlen = int(int(massmax - massmin) / massbins)
+    if mlen < 1:
+        print("ERROR: No masses detected. Length:", mlen)
+        massmax = massub
+        massmin = masslb
+        mlen = int(int(massmax - massmin) / massbins)
+        massaxis = massmin + np.arange(mlen) * massbins
+        massgrid = np.zeros((mlen, numz))
+    else:
+        massaxis = massmin + np.arange(mlen) * massbins
+        if config.rawflag == 1 or config.rawflag == 3:
+            grid = blur
+        else:
+            grid = newblur
+        if config.poolflag == 0:
+            massgrid = integrate_transform(mtab, grid, massaxis, massmax, massmin)
+        elif config.poolflag == 1:
+            massgrid = interpolate_transform(mz, nztab, grid, massaxis, float(config.adductmass))
+        else:
+            massgrid = smart_transform(mz, nztab, grid, massaxis, float(config.adductmass))
+
+    if config.rawflag == 1 or config.rawflag == 3:
+        mzgrid = blur
+    else:
+        mzgrid = newblur
+
+    massdat = np.transpose([massaxis, np.sum(massgrid, axis=1)])
+    if not silent:
+        print("Deconvolution Time: %.2gs" % (time.perf_counter() - tstart), "Iterations:", iterations,
+              "Convergence:", conv)
+    dtype = config.dtype
+    return {"massdat": massdat.astype(dtype), "massgrid": np.ravel(massgrid).astype(dtype),
+            "mzgrid": np.ravel(mzgrid).astype(dtype), "fitdat": fitdat.astype(dtype), "error": error,
+            "rsquared": rsquared, "iterations": iterations}
@@ -329,10 +329,11 @@ class UniDecEngine:
             self.olg.pair_glyco()
         print(self.olg.oligomerlist)
         self.matchlist, self.matchindexes = ud.match(self.pks, self.olg.oligomasslist, self.olg.oligonames,
-                                                     self.config.oligomerlist, tolerance=tolerance, return_numbers=True)
+                                                     self.config.oligomerlist, tolerance=tolerance, return_numbers=True,
+                                                     sortorder=self.olg.massorder)
 
-    def get_alts(self, tolerance=100):
-        self.altmasses, self.altindexes, self.matchcounts = self.olg.get_alts(self.pks, tolerance)
+    def get_alts(self, tolerance=100, ppmtol=None):
+        self.altmasses, self.altindexes, self.matchcounts = self.olg.get_alts(self.pks, tolerance, ppmtol=ppmtol)
 
     def get_summed_match_intensities(self, index, alts=True, normmode=0, probarray=None, get_2d=False):
         # To translate the index into oligomer number
@@ -53,6 +53,10 @@ class UniDecConfig(object):
         self.version = version
         self.inputversion = None
         self.dtype = np.single
+        # Compression filter for the spectra in MetaUniDec and UniChrom HDF5 files: "gzip", "lzf" (h5py only), or None
+        self.hdf5compression = "gzip"
+        # MetaUniDec reads spectrum arrays when used, keeping at most this many spectra in memory. 0 reads all at open.
+        self.maxresident = 256
 
         # File names and paths
         self.system = platform.system()
@@ -77,6 +81,7 @@ class UniDecConfig(object):
         self.massgridfile = ''
         self.massdatfile = ''
         self.cdrawextracts = ''
+        self.cdionstoredir = ''
         self.cdchrom = ''
         self.mzgridfile = ''
         self.cdcreaderpath = ''
@@ -111,6 +116,7 @@ class UniDecConfig(object):
         self.chrom_peak_width = 2
         self.sw_time_window = 1
         self.sw_scan_offset = 10
+        self.chromcube = 1
         self.time_start = ""
         self.time_end = ""
 
@@ -272,6 +278,8 @@ class UniDecConfig(object):
         self.CDScanEnd = -1
         self.CDiitflag = False
         self.CDprethresh = 0
+        # 1 = Save imported ions in a memory-mapped store for fast reopening and range queries, 0 = Numpy compressed
+        self.CDionstore = 1
 
         # Hadamard Transform Parameters
         self.htmode = False
@@ -298,10 +306,20 @@ class UniDecConfig(object):
         self.FTsmooth = 0
         self.HTmaskn = 1000
         self.HTwin = 5
+        # Storage for HT-CD-MS data cubes. 0 = Dense in memory, 1 = Memory-mapped on disk, 2 = Sparse
+        self.HTcubemode = 0
+        # 0 = Store data cubes in double precision, 1 = Single precision (float32 or complex64)
+        self.HTcubefloat32 = 0
         self.showlegends = True
 
         self.doubledec = False
         self.kernel = ""
+        # 0 = External UniDec binary, 1 = In-process Python core (falls back to binary if not supported)
+        self.coreflag = 0
+        # 0 = Off, 1 = Reuse cached deconvolution results for identical data and settings
+        self.cacheflag = 0
+        # Maximum size of the deconvolution result cache in MB
+        self.cachesize = 1000
 
         self.cmaps = None
         self.cmaps2 = None
@@ -579,6 +597,9 @@ class UniDecConfig(object):
 
         f.write("doubledec " + str(int(self.doubledec)) + "\n")
         f.write("kernel " + str(self.kernel) + "\n")
+        f.write("coreflag " + str(self.coreflag) + "\n")
+        f.write("cacheflag " + str(self.cacheflag) + "\n")
+        f.write("cachesize " + str(self.cachesize) + "\n")
 
         f.write("CDslope " + str(self.CDslope) + "\n")
         f.write("CDzbins " + str(self.CDzbins) + "\n")
@@ -586,6 +607,7 @@ class UniDecConfig(object):
         f.write("CDScanStart " + str(self.CDScanStart) + "\n")
         f.write("CDScanEnd " + str(self.CDScanEnd) + "\n")
         f.write("CDprethresh " + str(self.CDprethresh) + "\n")
+        f.write("CDionstore " + str(self.CDionstore) + "\n")
         f.write("HTksmooth " + str(self.HTksmooth) + "\n")
         f.write("CDScanCompress " + str(self.CDScanCompress) + "\n")
         f.write("HTmaxscans " + str(self.HTmaxscans) + "\n")
@@ -606,6 +628,8 @@ class UniDecConfig(object):
         f.write("FTsmooth " + str(self.FTsmooth) + "\n")
         f.write("HTmaskn " + str(self.HTmaskn) + "\n")
         f.write("HTwin " + str(self.HTwin) + "\n")
+        f.write("HTcubemode " + str(self.HTcubemode) + "\n")
+        f.write("HTcubefloat32 " + str(self.HTcubefloat32) + "\n")
 
         f.write("csig " + str(self.csig) + "\n")
         f.write("smoothdt " + str(self.smoothdt) + "\n")
@@ -725,6 +749,8 @@ class UniDecConfig(object):
                             self.CDScanStart = ud.string_to_int(line.split()[1])
                         if line.startswith("CDprethresh"):
                             self.CDprethresh = ud.string_to_value(line.split()[1])
+                        if line.startswith("CDionstore"):
+                            self.CDionstore = ud.string_to_int(line.split()[1])
                         if line.startswith("CDScanEnd"):
                             self.CDScanEnd = ud.string_to_int(line.split()[1])
                         if line.startswith("HTksmooth"):
@@ -767,6 +793,10 @@ class UniDecConfig(object):
                             self.HTmaskn = ud.string_to_value(line.split()[1])
                         if line.startswith("HTwin"):
                             self.HTwin = ud.string_to_value(line.split()[1])
+                        if line.startswith("HTcubemode"):
+                            self.HTcubemode = ud.string_to_int(line.split()[1])
+                        if line.startswith("HTcubefloat32"):
+                            self.HTcubefloat32 = ud.string_to_int(line.split()[1])
                         if line.startswith("zzsig"):
                             self.zzsig = ud.string_to_value(line.split()[1])
                         if line.startswith("psig"):
@@ -880,6 +910,12 @@ class UniDecConfig(object):
                                 self.doubledec = True
                         if line.startswith("kernel"):
                             self.kernel = line.strip()[7:]
+                        if line.startswith("coreflag"):
+                            self.coreflag = ud.string_to_int(line.split()[1])
+                        if line.startswith("cacheflag"):
+                            self.cacheflag = ud.string_to_int(line.split()[1])
+                        if line.startswith("cachesize"):
+                            self.cachesize = ud.string_to_value(line.split()[1])
 
                         # IM Imports
                         if line.startswith("ccsub"):
@@ -1024,13 +1060,14 @@ class UniDecConfig(object):
             "edc": self.edc, "gasmass": self.gasmass, "integratelb": self.integratelb,
             "integrateub": self.integrateub, "filterwidth": self.filterwidth, "zerolog": self.zerolog,
             "manualfileflag": self.manualfileflag, "mfileflag": self.mfileflag, "imflag": self.imflag,
+            "coreflag": self.coreflag, "cacheflag": self.cacheflag, "cachesize": self.cachesize,
             "cdmsflag": self.cdmsflag,
             "exwindow": self.exwindow, "exchoice": self.exchoice, "exchoicez": self.exchoicez,
             "exthresh": self.exthresh,
             "exnorm": self.exnorm, "exnormz": self.exnormz, "metamode": self.metamode,
             "datanorm": self.datanorm, "chrom_time_window": self.time_window, "chrom_peak_width": self.chrom_peak_width,
             "sw_time_window": self.sw_time_window, "sw_scan_offset": self.sw_scan_offset, "time_start": self.time_start,
-            "time_end": self.time_end
+            "time_end": self.time_end, "chromcube": self.chromcube
         }
         return cdict
 
@@ -1152,6 +1189,9 @@ class UniDecConfig(object):
         self.mfileflag = read_attr(self.mfileflag, "mfileflag", config_group)
         self.manualfileflag = read_attr(self.manualfileflag, "manualfileflag", config_group)
         self.imflag = read_attr(self.imflag, "imflag", config_group)
+        self.coreflag = read_attr(self.coreflag, "coreflag", config_group)
+        self.cacheflag = read_attr(self.cacheflag, "cacheflag", config_group)
+        self.cachesize = read_attr(self.cachesize, "cachesize", config_group)
         self.cdmsflag = read_attr(self.cdmsflag, "cdmsflag", config_group)
 
         self.exchoice = read_attr(self.exchoice, "exchoice", config_group)
@@ -1170,6 +1210,7 @@ class UniDecConfig(object):
         self.chrom_peak_width = read_attr(self.chrom_peak_width, "chrom_peak_width", config_group)
         self.sw_time_window = read_attr(self.sw_time_window, "sw_time_window", config_group)
         self.sw_scan_offset = read_attr(self.sw_scan_offset, "sw_scan_offset", config_group)
+        self.chromcube = read_attr(self.chromcube, "chromcube", config_group)
 
         self.time_start = read_attr(self.time_start, "time_start", config_group)
         self.time_end = read_attr(self.time_end, "time_end", config_group)
@@ -1206,6 +1247,7 @@ class UniDecConfig(object):
         self.deconfile = self.outfname + s + "decon.txt"
         self.mzgridfile = self.outfname + s + "grid.bin"
         self.cdrawextracts = self.outfname + s + "rawdata.npz"
+        self.cdionstoredir = self.outfname + s + "ionstore"
         self.cdchrom = self.outfname + s + "chroms.txt"
         self.reportfile = self.outfname + s + "report.html"
         if self.filetype == 0:
@@ -1526,41 +1568,59 @@ class OligomerContainer:
         self.oligomernames = np.array([])
         self.oligomasslist = np.array([])
         self.oligomerlist = np.array([])
+        self.massorder = np.array([], dtype=int)
 
     def make_oligomers(self, isolated=False, oligomerlist=None, minsites=None, maxsites=None):
         print("Starting to make oligomers. Isolated=", isolated)
         stime = time.perf_counter()
         self.oligomerlist = oligomerlist
         if not isolated:
-            self.oligomasslist, self.oligonames = ud.make_all_matches(oligomerlist)
+            self.oligomasslist, self.oligonames, self.massorder = ud.make_all_matches(oligomerlist, return_order=True)
         else:
             self.oligomasslist, self.oligonames = ud.make_isolated_match(oligomerlist)
+            self.massorder = ud.mass_sort_index(self.oligomasslist)
         if minsites is not None:
             sums = np.sum(self.oligonames, axis=1)
             b1 = sums >= minsites
             self.oligomasslist = self.oligomasslist[b1]
             self.oligonames = self.oligonames[b1]
+            self.massorder = ud.filter_sort_index(self.massorder, b1)
         if maxsites is not None:
             sums = np.sum(self.oligonames, axis=1)
             b1 = sums <= maxsites
             self.oligomasslist = self.oligomasslist[b1]
             self.oligonames = self.oligonames[b1]
+            self.massorder = ud.filter_sort_index(self.massorder, b1)
         print("Oligomers Made in ", time.perf_counter() - stime, "s")
 
     def pair_glyco(self):
         self.oligomasslist, self.oligonames = ud.pair_glyco_matches(self.oligomasslist, self.oligonames,
                                                                     self.oligomerlist)
+        self.massorder = ud.mass_sort_index(self.oligomasslist)
 
-    def get_alts(self, pks, tolerance=10):
+    def get_alts(self, pks, tolerance=10, ppmtol=None):
+        """
+        Find all oligomers within the tolerance of each peak.
+        :param pks: Peaks object
+        :param tolerance: Tolerance in Da
+        :param ppmtol: Tolerance in ppm of each peak mass. If set, it replaces tolerance.
+        :return: Masses of the matches for each peak, Indexes of the matches for each peak, Number of matches
+        """
+        if len(self.massorder) != len(self.oligomasslist):
+            self.massorder = ud.mass_sort_index(self.oligomasslist)
+        masses = np.asarray(self.oligomasslist, dtype=float)
+        names = np.asarray(self.oligonames)
+        sortedmasses = masses[self.massorder]
         altmasses = []
         altindexes = []
         matchcounts = []
         for p in pks.peaks:
             m = p.mass
-            b1 = np.abs(self.oligomasslist - m) < tolerance
-            altmasses.append(self.oligomasslist[b1])
-            altindexes.append(self.oligonames[b1])
-            matchcounts.append(np.sum(b1))
+            tol = tolerance if ppmtol is None else m * ppmtol * 1e-6
+            index = ud.window_sorted_index(masses, self.massorder, m, tol, sortedmasses=sortedmasses)
+            altmasses.append(masses[index])
+            altindexes.append(names[index])
+            matchcounts.append(len(index))
         return altmasses, altindexes, np.array(matchcounts)
 
 
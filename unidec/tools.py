@@ -9,10 +9,13 @@ import decimal
 from bisect import bisect_left
 from copy import deepcopy
 import zipfile
+import hashlib
 # noinspection PyUnresolvedReferences
 import numpy as np
 import scipy.fft
+import scipy.sparse
 import scipy.ndimage.filters as filt
+from scipy.ndimage import minimum_filter1d
 from scipy.interpolate import interp1d
 from scipy.interpolate import griddata
 from scipy import signal
@@ -21,7 +24,7 @@ import matplotlib.cm as cm
 import matplotlib.colors as colors
 from unidec.modules.fitting import *
 from itertools import cycle
-#from numba import jit
+from numba import njit, prange
 
 try:
     from unidec.modules.mzMLimporter import mzMLimporter
@@ -199,7 +202,7 @@ def find_kernel_file(kernel_path):
         is_mass = False
     else:
         # Otherwise, it might be a mass file. Check if linear
-        kernel_dat = np.loadtxt(kernel_path)
+        kernel_dat = load_txt_cached(kernel_path)
         kernel_diff = np.diff(kernel_dat[:, 0])
         is_mass = np.all(kernel_diff == kernel_diff[0])
 
@@ -211,10 +214,9 @@ def find_kernel_file(kernel_path):
         kernel_path2 = os.path.dirname(kernel_path) + "\\" + bare_name + "_unidecfiles\\" + \
                        bare_name + "_mass.txt"
 
-        try:
-            with open(kernel_path2, "r") as f:
-                return kernel_path2
-        except (IOError, FileNotFoundError) as err:
+        if cached_file_exists(kernel_path2):
+            return kernel_path2
+        else:
             # print("Please deconvolve the m/z file [" + kernel_name + "] with UniDec first.")
             return None
 
@@ -1138,6 +1140,137 @@ def dataexportbin(datatop, fname):
     pass
 
 
+def get_file_stamp(path):
+    """
+    Get a string of the size and modification time of a file or directory, used to key cached data.
+    :param path: File path
+    :return: String of size_mtime or "" if the path does not exist
+    """
+    try:
+        stat = os.stat(path)
+        return str(stat.st_size) + "_" + str(stat.st_mtime_ns)
+    except Exception:
+        return ""
+
+
+def get_cache_name(fname):
+    """
+    Get the name of the binary cache for a text data file.
+    :param fname: Text file name, such as _input.dat or _mass.txt
+    :return: Cache file name with the extension replaced by .npz
+    """
+    return os.path.splitext(fname)[0] + ".npz"
+
+
+def save_cache(fname, datatop, key=""):
+    """
+    Save an array to the binary cache for fname.
+    :param fname: Text file name that the cache stands in for
+    :param datatop: Data array
+    :param key: String used to check that the cache is valid when it is loaded
+    :return: None
+    """
+    try:
+        np.savez(get_cache_name(fname), data=datatop, key=str(key))
+    except Exception as e:
+        print("Could not write cache:", get_cache_name(fname), e)
+
+
+def load_cache(fname, key=None):
+    """
+    Load an array from the binary cache for fname.
+    :param fname: Text file name that the cache stands in for
+    :param key: If not None, the cache is only used if it was saved with the same key
+    :return: Data array or None if there is no valid cache
+    """
+    cachename = get_cache_name(fname)
+    if not os.path.isfile(cachename):
+        return None
+    try:
+        with np.load(cachename, allow_pickle=False) as npz:
+            if key is not None and str(npz["key"]) != str(key):
+                return None
+            return npz["data"]
+    except Exception as e:
+        print("Could not read cache:", cachename, e)
+        return None
+
+
+def cached_file_exists(fname):
+    """
+    Check whether a text data file or its binary cache exists.
+    :param fname: Text file name
+    :return: True if either exists
+    """
+    return os.path.isfile(fname) or os.path.isfile(get_cache_name(fname))
+
+
+def load_txt_cached(fname):
+    """
+    Load a text data file, using the binary cache from get_cache_name if it is current.
+
+    The cache is current if the text file does not exist, if the cache was made from the text file as it is now,
+    or if the cache was written directly and is newer than the text file.
+    Otherwise, the text file is read with np.loadtxt and the cache is rewritten.
+    :param fname: Text file name
+    :return: Data array
+    """
+    cachename = get_cache_name(fname)
+    txtstamp = get_file_stamp(fname)
+    if os.path.isfile(cachename):
+        try:
+            with np.load(cachename, allow_pickle=False) as npz:
+                key = str(npz["key"])
+                if txtstamp == "" or key == txtstamp or (
+                        key == "" and os.stat(cachename).st_mtime_ns >= os.stat(fname).st_mtime_ns):
+                    return npz["data"]
+        except Exception as e:
+            print("Could not read cache:", cachename, e)
+    data = np.loadtxt(fname)
+    save_cache(fname, data, txtstamp)
+    return data
+
+
+def export_txt_from_cache(fname):
+    """
+    Write a text data file from its binary cache if the cache was written without it and is newer.
+    For example, process_data only writes _input.dat to the cache for the in-process core, and the UniDec binary
+    needs the text file.
+    :param fname: Text file name
+    :return: None
+    """
+    cachename = get_cache_name(fname)
+    if not os.path.isfile(cachename):
+        return
+    txtstamp = get_file_stamp(fname)
+    try:
+        with np.load(cachename, allow_pickle=False) as npz:
+            key = str(npz["key"])
+            if key == txtstamp or (key == "" and txtstamp != "" and
+                                   os.stat(fname).st_mtime_ns >= os.stat(cachename).st_mtime_ns):
+                return
+            data = npz["data"]
+    except Exception as e:
+        print("Could not read cache:", cachename, e)
+        return
+    dataexport_cached(data, fname)
+
+
+def dataexport_cached(datatop, fname, text=True):
+    """
+    Write data to the binary cache and optionally also as text with dataexport.
+    :param datatop: Data array
+    :param fname: Text file name
+    :param text: If True, also write the text file
+    :return: None
+    """
+    if text:
+        dataexport(datatop, fname)
+        save_cache(fname, datatop, get_file_stamp(fname))
+    else:
+        save_cache(fname, datatop)
+
+
 def savetxt(fname, datatop):
     try:
         np.savetxt(fname, datatop)
@@ -1315,28 +1448,57 @@ def datacompsub(datatop, buff):
     :param buff: Width parameter
     :return: Subtracted data
     """
-    length = len(datatop)
-    mins = list(range(0, length))
-    indexes = list(range(0, length))
-    for i in indexes:
-        mins[i] = np.amin(datatop[int(max([0, i - abs(buff)])):int(min([i + abs(buff), length])), 1])
-    background = filt.gaussian_filter(mins, abs(buff) * 2)
+    buff = abs(buff)
+    # Running minimum over datatop[i - buff:i + buff, 1], clipped at the edges
+    lower = int(math.ceil(buff))
+    upper = int(math.floor(buff)) - 1
+    size = max(lower + upper + 1, 1)
+    mins = minimum_filter1d(datatop[:, 1], size, mode="nearest", origin=lower - size // 2)
+    background = filt.gaussian_filter(mins, buff * 2)
     datatop[:, 1] = datatop[:, 1] - background
     return datatop
 
 
 def calc_local_mins(data, w):
+    """
+    Find the local minimum in each window of width w across the x-axis.
+    Windows include both of their edges, as in datachop. Empty windows are skipped.
+    :param data: Data array (N x 2)
+    :param w: Width of each window in x units
+    :return: Array of [position, value] of each local minimum (M x 2)
+    """
     start = np.amin(data[:, 0])
     stop = np.amax(data[:, 0])
     windows = np.arange(start, stop, step=w)
 
-    localmins = []
-    for winstart in windows:
-        chopdata = datachop(data, winstart, winstart + w)
-        localmin = np.amin(chopdata[:, 1])
-        localminpos = chopdata[np.argmin(chopdata[:, 1]), 0]
-        localmins.append([localminpos, localmin])
-    return np.array(localmins)
+    xvals = data[:, 0]
+    if np.any(np.diff(xvals) < 0):
+        data = data[np.argsort(xvals, kind="stable")]
+        xvals = data[:, 0]
+    lows = np.searchsorted(xvals, windows, side="left")
+    highs = np.searchsorted(xvals, windows + w, side="right")
+    indexes = segment_argmins(np.ascontiguousarray(data[:, 1], dtype=float), lows, highs)
+    indexes = indexes[indexes >= 0]
+    return np.transpose([data[indexes, 0], data[indexes, 1]])
+
+
+@njit(fastmath=True)
+def segment_argmins(yvals, lows, highs):
+    """
+    Find the index of the first minimum in each segment yvals[lows[k]:highs[k]].
+    :param yvals: Values
+    :param lows: Start of each segment (inclusive)
+    :param highs: End of each segment (exclusive)
+    :return: Index of the minimum for each segment, or -1 if the segment is empty
+    """
+    out = np.empty(len(lows), dtype=np.int64)
+    for k in range(len(lows)):
+        best = -1
+        for j in range(lows[k], highs[k]):
+            if best < 0 or yvals[j] < yvals[best]:
+                best = j
+        out[k] = best
+    return out
 
 
 def polynomial_background_subtract(datatop, polynomial_order=4, width=20, cutoff_percent=0.25):
@@ -1604,33 +1766,79 @@ def lintegrate(datatop, intx, fastmode=False):
     :return: Integration of intensity from original data onto the new x-axis.
     Same shape as the old data but new length.
     """
-    length = len(datatop)
+    intx = np.asarray(intx)
     l2 = len(intx)
     inty = np.zeros_like(intx)
-    for i in range(0, length):
-        x = datatop[i, 0]
-        y = datatop[i, 1]
-        if intx[0] < x < intx[len(intx) - 1]:
-            index = nearest(intx, x)
-            if fastmode:
-                inty[index] += y
-            else:
-                if intx[index] == x:
-                    inty[index] += y
-                elif intx[index] < x and index < l2 - 1:
-                    index2 = index + 1
-                    interpos = linear_interpolation(intx[index], intx[index2], x)
-                    inty[index] += (1 - interpos) * y
-                    inty[index2] += interpos * y
-                elif intx[index] > x and index > 0:
-                    index2 = index - 1
-                    interpos = linear_interpolation(intx[index], intx[index2], x)
-                    inty[index] += (1 - interpos) * y
-                    inty[index2] += interpos * y
+    if l2 == 0:
+        return np.column_stack((intx, inty))
+    b1, index, index2, interpos = lintegrate_weights(datatop[:, 0], intx)
+    y = np.asarray(datatop[:, 1])[b1]
+    if len(y) == 0:
+        return np.column_stack((intx, inty))
+
+    if fastmode:
+        inty += np.bincount(index, weights=y, minlength=l2)[:l2]
+    else:
+        # Split each point between the nearest and the neighboring point on the other side
+        inty += np.bincount(index, weights=(1 - interpos) * y, minlength=l2)[:l2]
+        inty += np.bincount(index2, weights=interpos * y, minlength=l2)[:l2]
     newdat = np.column_stack((intx, inty))
     return newdat
 
 
+def lintegrate_weights(x, intx):
+    """
+    Find how lintegrate splits each point between the new x-axis points.
+    :param x: Old x-axis
+    :param intx: New x-axis, sorted
+    :return: Boolean mask of the points in x that are integrated, nearest index in intx for each of those points,
+    neighboring index on the other side, and the fraction of the point that goes to the neighboring index.
+    """
+    x = np.asarray(x)
+    intx = np.asarray(intx)
+    l2 = len(intx)
+    # Only points strictly inside the new axis are integrated
+    b1 = (x > intx[0]) & (x < intx[l2 - 1])
+    x = x[b1]
+
+    # Vectorized version of nearest for each point
+    index = np.clip(np.searchsorted(intx, x, side="left"), 1, l2 - 1)
+    lower = index - 1
+    closer = (np.abs(intx[index] - x) > np.abs(intx[lower] - x)) & (index < l2 - 1)
+    index[closer] = lower[closer]
+
+    xi = intx[index]
+    index2 = np.where(xi < x, index + 1, index - 1)
+    index2 = np.clip(index2, 0, l2 - 1)
+    exact = (xi == x) | (index2 == index)
+    denom = intx[index2] - xi
+    denom[exact] = 1
+    interpos = (x - xi) / denom
+    interpos[exact] = 0
+    return b1, index, index2, interpos
+
+
+def lintegrate_matrix(x, intx):
+    """
+    Sparse matrix version of lintegrate for a fixed pair of axes.
+
+    For any y, lintegrate_matrix(x, intx) @ y gives lintegrate(np.transpose([x, y]), intx)[:, 1].
+    :param x: Old x-axis
+    :param intx: New x-axis, sorted
+    :return: CSR matrix of shape (len(intx), len(x))
+    """
+    intx = np.asarray(intx)
+    x = np.asarray(x)
+    if len(intx) == 0:
+        return scipy.sparse.csr_matrix((0, len(x)))
+    b1, index, index2, interpos = lintegrate_weights(x, intx)
+    points = np.flatnonzero(b1)
+    rows = np.concatenate((index, index2))
+    cols = np.concatenate((points, points))
+    vals = np.concatenate((1 - interpos, interpos))
+    return scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(intx), len(x)))
+
+
 def linterpolate(datatop, intx):
     """
     Linearize x-axis by interpolation.
@@ -1648,6 +1856,60 @@ def linterpolate(datatop, intx):
     return newdat
 
 
+def linterpolate_weights(x, intx):
+    """
+    Find the two points in x that linterpolate uses for each point on the new x-axis.
+    :param x: Old x-axis, at least two points
+    :param intx: New x-axis
+    :return: Indexes of the points in intx inside the old axis, lower and upper indexes in x for each of those points,
+    and the fraction given to the upper index. Points outside the old axis are filled with zero by linterpolate.
+    """
+    x = np.asarray(x)
+    intx = np.asarray(intx)
+    order = np.argsort(x, kind="stable")
+    xs = x[order]
+    newindex = np.flatnonzero((intx >= xs[0]) & (intx <= xs[-1]))
+    hi = np.clip(np.searchsorted(xs, intx[newindex], side="left"), 1, len(xs) - 1)
+    lo = hi - 1
+    frac = (intx[newindex] - xs[lo]) / (xs[hi] - xs[lo])
+    return newindex, order[lo], order[hi], frac
+
+
+def linterpolate_matrix(x, intx):
+    """
+    Sparse matrix version of linterpolate for a fixed pair of axes.
+
+    For any y, linterpolate_matrix(x, intx) @ y gives linterpolate(np.transpose([x, y]), intx)[:, 1].
+    :param x: Old x-axis, at least two points
+    :param intx: New x-axis
+    :return: CSR matrix of shape (len(intx), len(x))
+    """
+    newindex, lo, hi, frac = linterpolate_weights(x, intx)
+    rows = np.concatenate((newindex, newindex))
+    cols = np.concatenate((lo, hi))
+    vals = np.concatenate((1 - frac, frac))
+    return scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(intx), len(x)))
+
+
+def nearest_array(array, targets):
+    """
+    Vectorized version of nearest for many targets.
+    :param array: Sorted array
+    :param targets: Values
+    :return: Array of indexes, the same as [nearest(array, t) for t in targets]
+    """
+    array = np.asarray(array)
+    targets = np.asarray(targets)
+    i = np.searchsorted(array, targets, side="left")
+    inside = (i > 0) & (i < len(array) - 1)
+    ii = i[inside]
+    t = targets[inside]
+    ii = np.where(np.abs(array[ii] - t) > np.abs(array[ii - 1] - t), ii - 1, ii)
+    out = np.where(i <= 0, 0, len(array) - 1)
+    out[inside] = ii
+    return out
+
+
 def linearize(datatop, binsize, linflag):
     """
     Linearize data by defined x-axis bin size by either interpolation or integration
@@ -1990,40 +2252,123 @@ def peakdetect(data, config=None, window=10, threshold=0, ppm=None, norm=True):
         threshold = config.peakthresh
         norm = config.normthresh
 
-    peaks = []
     length = len(data)
     shape = np.shape(data)
     if length == 0 or shape[1] != 2:
-        return np.array(peaks)
+        return np.array([])
 
     if norm:
         maxval = np.amax(data[:, 1])
     else:
         maxval = 1
-    for i in range(0, length):
-        if data[i, 1] > maxval * threshold:
-            if ppm is not None:
-                ptmass = data[i, 0]
-                newwin = ppm * 1e-6 * ptmass
-                start = nearest(data[:, 0], ptmass - newwin)
-                end = nearest(data[:, 0], ptmass + newwin)
-            else:
-                start = i - window
-                end = i + window
 
-                start = int(start)
-                end = int(end) + 1
+    xvals = np.ascontiguousarray(data[:, 0], dtype=float)
+    yvals = np.ascontiguousarray(data[:, 1], dtype=float)
+    if ppm is not None:
+        indexes = peakdetect_ppm_core(xvals, yvals, maxval * threshold, float(ppm))
+    else:
+        indexes = peakdetect_core(yvals, maxval * threshold, float(window))
+    if len(indexes) == 0:
+        return np.array([])
+    return np.transpose([data[indexes, 0], data[indexes, 1]])
+
+
+@njit(fastmath=True, cache=True)
+def is_window_max(yvals, i, start, end):
+    """
+    Test whether point i is a peak within data[start:end].
+    It must be equal to the max of the window and not equal to any point before it in the window,
+    so that flat tops are only counted once at their first point.
+    :param yvals: Intensity values
+    :param i: Index of the test point
+    :param start: Start of the window (inclusive)
+    :param end: End of the window (exclusive)
+    :return: True if i is a peak
+    """
+    y = yvals[i]
+    if end <= start:
+        return True
+    found = False
+    for j in range(start, end):
+        if yvals[j] > y:
+            return False
+        if yvals[j] == y:
+            found = True
+    if not found:
+        return False
+    for j in range(start, i):
+        if yvals[j] == y:
+            return False
+    return True
 
-                if start < 0:
-                    start = 0
-                if end > length:
-                    end = length
 
-            testmax = np.amax(data[start:end, 1])
-            if data[i, 1] == testmax and np.all(data[i, 1] != data[start:i, 1]):
-                peaks.append([data[i, 0], data[i, 1]])
+@njit(fastmath=True, cache=True)
+def peakdetect_core(yvals, threshold, window):
+    """
+    Find the indexes of local maxima within plus or minus window points. Used by peakdetect.
+    :param yvals: Intensity values
+    :param threshold: Absolute intensity threshold
+    :param window: Window in number of points
+    :return: Array of peak indexes
+    """
+    length = len(yvals)
+    peaks = np.empty(length, dtype=np.int64)
+    n = 0
+    for i in range(0, length):
+        if yvals[i] > threshold:
+            start = int(i - window)
+            end = int(i + window) + 1
+            if start < 0:
+                start = 0
+            if end > length:
+                end = length
+            if is_window_max(yvals, i, start, end):
+                peaks[n] = i
+                n += 1
+    return peaks[:n]
+
+
+@njit(fastmath=True, cache=True)
+def nearest_sorted(array, target):
+    """
+    Compiled version of nearest for a sorted array.
+    :param array: Sorted array
+    :param target: Value
+    :return: Index of the closest element
+    """
+    i = np.searchsorted(array, target)
+    if i <= 0:
+        return 0
+    elif i >= len(array) - 1:
+        return len(array) - 1
+    if np.abs(array[i] - target) > np.abs(array[i - 1] - target):
+        i -= 1
+    return i
 
-    return np.array(peaks)
+
+@njit(fastmath=True, cache=True)
+def peakdetect_ppm_core(xvals, yvals, threshold, ppm):
+    """
+    Find the indexes of local maxima within plus or minus a ppm window of each point. Used by peakdetect.
+    :param xvals: Sorted x values
+    :param yvals: Intensity values
+    :param threshold: Absolute intensity threshold
+    :param ppm: Tolerance window in ppm
+    :return: Array of peak indexes
+    """
+    length = len(yvals)
+    peaks = np.empty(length, dtype=np.int64)
+    n = 0
+    for i in range(0, length):
+        if yvals[i] > threshold:
+            ptmass = xvals[i]
+            newwin = ppm * 1e-6 * ptmass
+            start = nearest_sorted(xvals, ptmass - newwin)
+            end = nearest_sorted(xvals, ptmass + newwin)
+            if is_window_max(yvals, i, start, end):
+                peaks[n] = i
+                n += 1
+    return peaks[:n]
 
 
 def peakdetect_nonlinear(data, config=None, window=1, threshold=0):
@@ -2341,56 +2686,70 @@ def index_to_oname(index, startindex, names):
     return name
 
 
-def combine_all(array2):
-    lens = lengths(array2)
-    tup = tuple(lens)
-    print("Starting combining all: ", np.prod(lens))
-    startindex = array2[:, 2]
-    startindex = startindex.astype(int)
-    basemass = array2[:, 0]
-    basemass = basemass.astype(float)
-    omass = array2[:, 1]
-    omass = omass.astype(float)
-    # names = array2[:, 4]
-
-    # namelist = np.array([index for index in np.ndindex(tup)])
-    namelist = np.array(list(np.ndindex(tup)), dtype=np.dtype((int, len(lens))))
-    # finlist = np.array([np.sum((index + startindex) * omass + basemass) for index in namelist])
-    finlist = np.sum((namelist + startindex) * omass + basemass, axis=1)
-
+@njit(parallel=True)
+def fill_combination_block(start, lens, names):
     """
-    for index in np.ndindex(tup):
-        vals = index + startindex
-        b1 = vals > 0
-        vstr = vals[b1].astype(str)
-        nstr = "[" + np.char.array(names[b1]) + "] "
-        nstr[nstr == "[] "] = ""
-        fstr = vstr + nstr
-        name = ""
-        for i in range(0, len(vstr)):
-            name += fstr[i]
-        namelist.append(name)"""
-    '''
-        for index in np.ndindex(tup):
-        name = ""
-        for i in range(0, len(index)):
-            val = index[i] + startindex[i]
-            if val > 0:
-                if names[i] == "":
-                    name = name + str(val)
-                else:
-                    name = name + str(val) + "[" + names[i] + "] "
-            else:
-                pass
-        total = np.sum((index + startindex) * omass + basemass)
-        if total > 0:
-            finlist.append(total)
-            namelist.append(name)
-            # print index,name'''
-
-    b1 = finlist != 0
-    finlist = finlist[b1]
-    namelist = namelist[b1]
+    Fill a block of the combinations from np.ndindex(lens) in parallel.
+    :param start: Flat index of the first combination in the block
+    :param lens: Number of values for each oligomer
+    :param names: Output array (block length x number of oligomers) for the indexes of each combination
+    :return: None
+    """
+    n, k = names.shape
+    for j in prange(n):
+        flat = start + j
+        for c in range(k - 1, -1, -1):
+            names[j, c] = flat % lens[c]
+            flat //= lens[c]
+
+
+def combine_all_blocks(array2, blocksize=262144, sort=False):
+    """
+    Enumerate every combination of the oligomers in blocks, so the full set of combinations is never held in memory.
+    :param array2: Oligomer array with columns base mass, monomer mass, min number, max number, and name
+    :param blocksize: Number of combinations in each block
+    :param sort: If True, sort each block by mass. If False (default), blocks are in np.ndindex order.
+    :return: Generator of (masses, indexes) for each block, without combinations of zero mass
+    """
+    lens = np.array(lengths(array2), dtype=np.int64)
+    startindex = array2[:, 2].astype(int)
+    basemass = array2[:, 0].astype(float)
+    omass = array2[:, 1].astype(float)
+    total = int(np.prod(lens))
+    for start in range(0, total, blocksize):
+        names = np.empty((min(blocksize, total - start), len(lens)), dtype=int)
+        fill_combination_block(start, lens, names)
+        masses = np.sum((names + startindex) * omass + basemass, axis=1)
+        b1 = masses != 0
+        masses = masses[b1]
+        names = names[b1]
+        if sort:
+            order = np.argsort(masses, kind="stable")
+            masses = masses[order]
+            names = names[order]
+        yield masses, names
+
+
+def combine_all(array2, blocksize=262144):
+    """
+    Find the mass of every combination of the oligomers.
+    :param array2: Oligomer array with columns base mass, monomer mass, min number, max number, and name
+    :param blocksize: Number of combinations to compute at once
+    :return: Masses, Indexes of each oligomer relative to its min number (combinations x oligomers)
+    """
+    lens = lengths(array2)
+    total = int(np.prod(lens))
+    print("Starting combining all: ", total)
+    finlist = np.empty(total, dtype=float)
+    namelist = np.empty((total, len(lens)), dtype=int)
+    n = 0
+    for masses, names in combine_all_blocks(array2, blocksize=blocksize):
+        finlist[n:n + len(masses)] = masses
+        namelist[n:n + len(masses)] = names
+        n += len(masses)
+    if n < total:
+        finlist = finlist[:n].copy()
+        namelist = namelist[:n].copy()
     return finlist, namelist
 
 
@@ -2420,16 +2779,131 @@ def make_isolated_match(oligos):
     return oligomasslist, oligonames
 
 
-def make_all_matches(oligos):
-    if len(oligos) > 1:
-        oligos = np.array(oligos)
-        oligomasslist, oligonames = combine_all(oligos)
-        oligomasslist = np.array(oligomasslist)
+# Results of make_all_matches for recent oligomer lists and their size in bytes, keyed by oligomer_key
+oligomer_cache = {}
+# Maximum total size of the cached results in bytes. Results larger than this are not cached.
+oligomer_cache_bytes = 256 * 2 ** 20
+
+
+def oligomer_key(oligos):
+    """
+    Hash the contents of an oligomer list.
+    :param oligos: Oligomer array or list
+    :return: Hex digest of the oligomer values
+    """
+    oligos = np.array(oligos).astype(str)
+    h = hashlib.sha1(str(oligos.shape).encode())
+    h.update(np.ascontiguousarray(oligos).tobytes())
+    return h.hexdigest()
+
+
+def make_all_matches(oligos, return_order=False, cache=True):
+    """
+    Find the mass of every combination of the oligomers. Results for the most recently used oligomer lists are cached,
+    up to oligomer_cache_bytes in total, so repeating the same list is immediate. Cached arrays are read-only.
+    :param oligos: Oligomer array with columns base mass, monomer mass, min number, max number, and name
+    :param return_order: If True, also return the mass sort order from mass_sort_index
+    :param cache: If True (default), use and update the cache
+    :return: Masses, Indexes of each oligomer relative to its min number, (Mass sort order)
+    """
+    key = oligomer_key(oligos) if cache else None
+    if key in oligomer_cache:
+        # Move to the end so the least recently used list is removed first
+        entry = oligomer_cache.pop(key)
+        oligomer_cache[key] = entry
+        oligomasslist, oligonames, order, size = entry
     else:
-        oligomasslist, oligonames = make_isolated_match(oligos)
+        if len(oligos) > 1:
+            oligos = np.array(oligos)
+            oligomasslist, oligonames = combine_all(oligos)
+            oligomasslist = np.array(oligomasslist)
+        else:
+            oligomasslist, oligonames = make_isolated_match(oligos)
+        order = mass_sort_index(oligomasslist)
+        if cache:
+            size = sum([np.asarray(a).nbytes for a in [oligomasslist, oligonames, order]])
+            if size <= oligomer_cache_bytes:
+                for a in [oligomasslist, oligonames, order]:
+                    if isinstance(a, np.ndarray):
+                        a.setflags(write=False)
+                total = sum([e[3] for e in oligomer_cache.values()])
+                while len(oligomer_cache) > 0 and total + size > oligomer_cache_bytes:
+                    total -= oligomer_cache.pop(next(iter(oligomer_cache)))[3]
+                oligomer_cache[key] = (oligomasslist, oligonames, order, size)
+    if return_order:
+        return oligomasslist, oligonames, order
     return oligomasslist, oligonames
 
 
+def mass_sort_index(masses):
+    """
+    Sort order for fast lookups in an unsorted mass list with nearest_sorted_index and window_sorted_index.
+    :param masses: Mass list
+    :return: Stable sort order of the masses
+    """
+    return np.argsort(np.asarray(masses, dtype=float), kind="stable")
+
+
+def filter_sort_index(order, keep):
+    """
+    Update a sort order from mass_sort_index after filtering the masses, without sorting again.
+    :param order: Sort order of the full mass list
+    :param keep: Boolean array of the masses to keep
+    :return: Sort order of masses[keep]
+    """
+    keep = np.asarray(keep, dtype=bool)
+    newindex = np.cumsum(keep) - 1
+    return newindex[order[keep[order]]]
+
+
+def nearest_sorted_index(masses, order, targets):
+    """
+    For each target, find the position of the closest mass in an unsorted mass list using its sort order.
+    Gives the same result as nearestunsorted, including picking the first position on ties.
+    :param masses: Mass list
+    :param order: Sort order from mass_sort_index
+    :param targets: Target value or array of target values
+    :return: Position in masses of the closest value to each target
+    """
+    masses = np.asarray(masses, dtype=float)
+    sortedmasses = masses[order]
+    targets = np.asarray(targets, dtype=float)
+    n = len(sortedmasses)
+    i = np.searchsorted(sortedmasses, targets, side="left")
+    hi = np.clip(i, 0, n - 1)
+    lo = np.clip(i - 1, 0, n - 1)
+    # Equal masses are in their original order, so take the first copy of the value below the target
+    lo = np.searchsorted(sortedmasses, sortedmasses[lo], side="left")
+    dhi = np.abs(sortedmasses[hi] - targets)
+    dlo = np.abs(sortedmasses[lo] - targets)
+    ihi = order[hi]
+    ilo = order[lo]
+    uselo = np.logical_or(dlo < dhi, np.logical_and(dlo == dhi, ilo < ihi))
+    return np.where(uselo, ilo, ihi)
+
+
+def window_sorted_index(masses, order, target, tolerance, sortedmasses=None):
+    """
+    Find the positions of all masses within a tolerance of the target using the sort order of the mass list.
+    Gives the same result as np.where(np.abs(masses - target) < tolerance)[0].
+    :param masses: Mass list
+    :param order: Sort order from mass_sort_index
+    :param target: Target value
+    :param tolerance: Tolerance
+    :param sortedmasses: masses[order], if it has already been computed
+    :return: Positions in masses, in increasing order
+    """
+    masses = np.asarray(masses, dtype=float)
+    if sortedmasses is None:
+        sortedmasses = masses[order]
+    # Widen the search by a few ulps and then apply the exact test to the candidates
+    eps = 4 * np.spacing(max(abs(target), abs(tolerance)))
+    i1 = np.searchsorted(sortedmasses, target - tolerance - eps, side="left")
+    i2 = np.searchsorted(sortedmasses, target + tolerance + eps, side="right")
+    index = np.sort(order[i1:i2])
+    return index[np.abs(masses[index] - target) < tolerance]
+
+
 def get_glyco_indexes(oligomerlist, printoutput=False):
     names = oligomerlist[:, 4]
     sname = ''
@@ -2489,7 +2963,7 @@ def pair_glyco_matches(oligomasslist, oligonames, oligomerlist):
     return oligomasslist[b3], oligonames[b3]
 
 
-def match(pks, oligomasslist, oligonames, oligomerlist, tolerance=None, return_numbers=False):
+def match(pks, oligomasslist, oligonames, oligomerlist, tolerance=None, return_numbers=False, sortorder=None):
     print("Starting Match")
     starttime = time.perf_counter()
     matches = []
@@ -2502,10 +2976,15 @@ def match(pks, oligomasslist, oligonames, oligomerlist, tolerance=None, return_n
     startindex = oligomerlist[:, 2].astype(int)
     onames = oligomerlist[:, 4]
 
+    oligomasslist = np.asarray(oligomasslist)
+    if sortorder is None or len(sortorder) != len(oligomasslist):
+        sortorder = mass_sort_index(oligomasslist)
+    nearpts = nearest_sorted_index(oligomasslist, sortorder, [pks.peaks[i].mass for i in range(0, pks.plen)])
+
     for i in range(0, pks.plen):
         p = pks.peaks[i]
         target = p.mass
-        nearpt = nearestunsorted(oligomasslist, target)
+        nearpt = nearpts[i]
         match = oligomasslist[nearpt]
         error = target - match
         number = np.zeros(len(startindex))